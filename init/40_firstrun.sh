@@ -405,6 +405,14 @@ else
 	echo "File zm_detect.py already moved"
 fi
 
+# Handle the zm_detect_client.py file
+if [ -f /root/zmeventnotification/zm_detect_client.py ]; then
+	echo "Moving zm_detect_client.py"
+	mv /root/zmeventnotification/zm_detect_client.py /config/hook/zm_detect_client.py
+else
+	echo "File zm_detect_client.py already moved"
+fi
+
 # Handle the zm_detect_old.py file
 if [ -f /root/zmeventnotification/zm_detect_old.py ]; then
 	echo "Moving zm_detect_old.py"
@@ -464,6 +472,7 @@ chown -R www-data:www-data /var/lib/zmeventnotification/models/coral_edgetpu 2>/
 # Symbolic link for hook files in /config
 mkdir -p /var/lib/zmeventnotification/bin
 ln -sf /config/hook/zm_detect.py /var/lib/zmeventnotification/bin/zm_detect.py
+ln -sf /config/hook/zm_detect_client.py /var/lib/zmeventnotification/bin/zm_detect_client.py
 ln -sf /config/hook/zm_detect_old.py /var/lib/zmeventnotification/bin/zm_detect_old.py
 ln -sf /config/hook/zm_train_faces.py /var/lib/zmeventnotification/bin/zm_train_faces.py
 ln -sf /config/hook/train_faces.py /var/lib/zmeventnotification/bin/train_faces.py
@@ -17,7 +17,7 @@ LICENSE = 'GPL'
 INSTALL_REQUIRES = [
     'numpy', 'requests', 'Shapely', 'imutils', 
     'pyzm>=0.3.40', 'scikit-learn', 'future', 'imageio',
-    'imageio-ffmpeg','pygifsicle', 'Pillow'
+    'imageio-ffmpeg', 'Pillow'
 ]
 
 here = os.path.abspath(os.path.dirname(__file__))
@@ -55,5 +55,15 @@ setup(name=NAME,
           'zmes_hook_helpers.log',
           'zmes_hook_helpers.image_manip',
           'zmes_hook_helpers.apigw', 
-          'zmes_hook_helpers.utils'
+          'zmes_hook_helpers.alpr_cache',
+          'zmes_hook_helpers.animation_queue',
+          'zmes_hook_helpers.batcher',
+          'zmes_hook_helpers.gif',
+          'zmes_hook_helpers.httpclient',
+          'zmes_hook_helpers.mlapi_token',
+          'zmes_hook_helpers.model_pool',
+          'zmes_hook_helpers.past_detections',
+          'zmes_hook_helpers.trace',
+          'zmes_hook_helpers.utils',
+          'zmes_hook_helpers.zone_index'
       ])
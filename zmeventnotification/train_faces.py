@@ -3,6 +3,7 @@
 import argparse
 import ssl
 import pyzm.ZMLog as log
+from zmes_hook_helpers.log import ZMLogger
 import zmes_hook_helpers.common_params as g
 import zmes_hook_helpers.utils as utils
 import pyzm.ml.face_train as train
@@ -17,7 +18,7 @@ if __name__ == "__main__":
     args = vars(args)
 
     log.init(name='zm_face_train', dump_console=True)
-    g.logger = log
+    g.logger = ZMLogger(log)
     utils.process_config(args, g.ctx)
    
     train.FaceTrain(options=g.config).train()
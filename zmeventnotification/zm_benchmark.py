@@ -0,0 +1,1435 @@
+#!/usr/bin/python3
+
+# Benchmarks for the hook helpers. These do not need ZM, a config file
+# or models; workloads are generated.
+#   zm_benchmark.py config --keys 5000 --depth 20
+#   zm_benchmark.py animation-fetch --frames 20 --latency-ms 80
+#   zm_benchmark.py animation --width 1920
+#   zm_benchmark.py gif --frames 12
+#   zm_benchmark.py past-detection --boxes 10,100,500
+#   zm_benchmark.py zones --zones 20 --boxes 300
+#   zm_benchmark.py image-manip --boxes 1,100,500 --zones 1,10,50 --saved 0,50,200
+#   zm_benchmark.py logging --calls 2000 --depth 15 --sink-us 200
+# replay runs zm_detect.py end to end on recorded (or generated) events,
+# against stand-ins for ZM and mlapi, and can keep/compare a baseline:
+#   zm_benchmark.py replay --events DIR --concurrency 1,4 --mlapi-latency-ms 300
+#   zm_benchmark.py replay --save-baseline base.json
+#   zm_benchmark.py replay --baseline base.json --tolerance 20
+
+import argparse
+import copy
+import os
+import re
+import sys
+import time
+
+import zmes_hook_helpers.common_params as g
+import zmes_hook_helpers.utils as utils
+
+
+def _timeit(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        diff_time = time.perf_counter() - start
+        best = diff_time if best is None else min(best, diff_time)
+    return best
+
+
+def _loop_substitute(config):
+    # the substitution loop process_config used before resolve_config_vars
+    p = r'{{(\w+?)}}'
+    for gk, gv in config.items():
+        gv = '{}'.format(gv)
+        while True:
+            matches = re.findall(p, gv)
+            replaced = False
+            for match_key in matches:
+                if match_key in config:
+                    replaced = True
+                    new_val = config[gk].replace('{{' + match_key + '}}', str(config[match_key]))
+                    config[gk] = new_val
+                    gv = new_val
+            if not replaced:
+                break
+
+
+def _generate_config(keys, depth):
+    # chains of depth templated keys, each referring to the next one, which
+    # is defined after it. A quarter of the keys are plain ints
+    config = {'base_data_path': '/var/lib/zmeventnotification'}
+    plain = keys // 4
+    for c in range((keys - plain) // depth):
+        for pos in range(depth):
+            if pos == depth - 1:
+                config['key_{}_{}'.format(c, pos)] = '{{base_data_path}}/models/' + str(c)
+            else:
+                config['key_{}_{}'.format(c, pos)] = '{{{{key_{}_{}}}}}/{}'.format(c, pos + 1, pos)
+    for i in range(plain):
+        config['plain_{}'.format(i)] = i
+    return config
+
+
+def bench_config(args):
+    config = _generate_config(args['keys'], args['depth'])
+    expected = copy.deepcopy(config)
+    _loop_substitute(expected)
+    result = copy.deepcopy(config)
+    utils.resolve_config_vars(result)
+    if result != expected:
+        print('resolve_config_vars and the old loop disagree')
+        exit(1)
+
+    t_loop = _timeit(lambda: _loop_substitute(copy.deepcopy(config)), args['repeat'])
+    t_graph = _timeit(lambda: utils.resolve_config_vars(copy.deepcopy(config)), args['repeat'])
+    t_copy = _timeit(lambda: copy.deepcopy(config), args['repeat'])
+    print('config: {} keys, chain depth {}'.format(len(config), args['depth']))
+    print('  substitution loop:   {:8.2f} ms'.format((t_loop - t_copy) * 1000))
+    print('  resolve_config_vars: {:8.2f} ms'.format((t_graph - t_copy) * 1000))
+
+
+class _NullLog:
+    def Debug(self, *args):
+        pass
+
+    def Info(self, *args):
+        pass
+
+    def Error(self, *args):
+        pass
+
+    def enabled(self, level=1):
+        return False
+
+
+def _use_defaults(overrides=None):
+    # config defaults, without a config file
+    g.logger = _NullLog()
+    for k, v in g.config_vals.items():
+        if v.get('default') is not None and v['type'] == 'int':
+            g.config[k] = int(v['default'])
+        else:
+            g.config[k] = v.get('default')
+    g.config.update(overrides or {})
+
+
+class _FrameServer:
+    # stand-in for ZM's index.php?view=image. Each frame is a JPEG filled
+    # with its fid, served after latency_ms. fail_every=n fails every nth
+    # request with a 500. /api/events/<eid>.json describes an event of
+    # event_frames frames at event_fps, alarmed in the middle
+    def __init__(self, latency_ms, width=640, height=480, fail_every=0,
+                 event_frames=100, event_fps=10):
+        import io
+        import json
+        import threading
+        import numpy as np
+        from PIL import Image
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        from urllib.parse import urlparse, parse_qs
+
+        frames = {}
+        counter = {'requests': 0}
+
+        def _jpeg(fid):
+            if fid not in frames:
+                arr = np.full((height, width, 3), fid % 256, dtype=np.uint8)
+                buf = io.BytesIO()
+                Image.fromarray(arr).save(buf, format='JPEG', quality=90)
+                frames[fid] = buf.getvalue()
+            return frames[fid]
+
+        def _event():
+            alarm = event_frames // 2
+            return {'event': {
+                'Event': {'AlarmFrameId': alarm, 'MaxScoreFrameId': alarm},
+                'Frame': [{'FrameId': i, 'Delta': i / event_fps} for i in range(1, event_frames + 1)],
+            }}
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                counter['requests'] += 1
+                time.sleep(latency_ms / 1000.0)
+                if fail_every and counter['requests'] % fail_every == 0:
+                    self.send_response(500)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                path = urlparse(self.path).path
+                if path.startswith('/api/events/'):
+                    body = json.dumps(_event()).encode()
+                    content_type = 'application/json'
+                else:
+                    q = parse_qs(urlparse(self.path).query)
+                    fid = q.get('fid', ['0'])[0]
+                    body = _jpeg(int(fid) if fid.isdigit() else 0)
+                    content_type = 'image/jpeg'
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.api_url = self.url + '/api'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+
+
+def bench_animation_fetch(args):
+    import zmes_hook_helpers.image_manip as img
+
+    server = _FrameServer(args['latency_ms'], fail_every=args['fail_every'])
+    _use_defaults({'portal': server.url, 'http_pool_maxsize': max(args['workers'])})
+    fids = list(range(1, args['frames'] + 1))
+    urls = ['{}/index.php?view=image&eid=1&fid={}'.format(server.url, i) for i in fids]
+    print('animation-fetch: {} frames, {} ms latency per request'.format(len(urls), args['latency_ms']))
+    # warm up: JPEGs get encoded on first request
+    img.fetch_frames(urls, workers=max(args['workers']), retries=args['retries'])
+    for workers in args['workers']:
+        start = time.perf_counter()
+        frames = img.fetch_frames(urls, workers=workers, retries=args['retries'])
+        diff_time = time.perf_counter() - start
+        ok = [f for f in frames if not isinstance(f, Exception)]
+        # frames come back in order: frame n is filled with n
+        in_order = all(int(f[0, 0, 0]) == fid % 256 for fid, f in zip(fids, frames)
+                       if not isinstance(f, Exception))
+        print('  workers={:<3} {:8.1f} ms  frames ok={} failed={} in order={}'.format(
+            workers, diff_time * 1000, len(ok), len(frames) - len(ok), in_order))
+    server.close()
+
+
+def _buffered_animation(frametype, eid, fname, types):
+    # how createAnimation wrote animations before frames were streamed:
+    # every frame is downloaded and kept, then each file is written
+    import imageio
+    import requests
+    import zmes_hook_helpers.image_manip as img
+    from zmes_hook_helpers.httpclient import get_session
+
+    r = get_session().get('{}/events/{}.json'.format(g.config['api_portal'], eid)).json()
+    fid = int(r['event']['Event']['AlarmFrameId'])
+    totframes = len(r['event']['Frame'])
+    fps = round(totframes / round(float(r['event']['Frame'][-1]['Delta'])))
+    target_fps = 2
+    start_frame = int(max(fid - (5 * fps), 1))
+    end_frame = int(min(totframes, fid + (5 * fps)))
+    skip = round(fps / target_fps)
+    url = '{}/index.php?view=image&width={}&eid={}'.format(g.config['portal'], g.config['animation_width'], eid)
+    urls = [url + '&fid={}'.format(frametype)] + [url + '&fid={}'.format(i) for i in range(start_frame, end_frame + 1, skip)]
+    frames = img.fetch_frames(urls, workers=g.config['animation_fetch_workers'])
+    images = frames[1:]
+    if 'mp4' in types:
+        imageio.mimwrite(fname + '.mp4', [frames[0], frames[0]] + images, format='mp4', fps=target_fps)
+    if 'gif' in types:
+        s1 = round((int(max(fid - (2 * fps), 1)) - start_frame) / skip)
+        s2 = round((end_frame - int(min(totframes, fid + (2 * fps)))) / skip)
+        imageio.mimwrite(fname + '.gif', images[s1:len(images) - s2], format='gif', fps=target_fps)
+    return True
+
+
+def _measure(fn):
+    # runs fn in a forked child, so that each run starts from the same
+    # memory state. Returns (wall seconds, peak RSS growth in bytes, result)
+    import json
+    import os
+    import resource
+    from zmes_hook_helpers.model_pool import _rss_bytes
+
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            os.close(r)
+            rss = _rss_bytes()
+            start = time.perf_counter()
+            result = fn()
+            diff_time = time.perf_counter() - start
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            with os.fdopen(w, 'w') as f:
+                json.dump([diff_time, max(peak - rss, 0), bool(result)], f)
+        except Exception:
+            code = 1
+        finally:
+            os._exit(code)
+    os.close(w)
+    with os.fdopen(r) as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    return json.loads(data) if data else (0, 0, False)
+
+
+def bench_animation(args):
+    import os
+    import tempfile
+    import zmes_hook_helpers.image_manip as img
+
+    height = args['width'] * 9 // 16
+    server = _FrameServer(args['latency_ms'], width=args['width'], height=height,
+                          event_frames=args['event_frames'], event_fps=args['event_fps'])
+    _use_defaults({'portal': server.url, 'api_portal': server.api_url, 'user': 'bench',
+                   'password': 'bench', 'animation_width': args['width']})
+    tmp = tempfile.mkdtemp()
+    types = args['types']
+    print('animation: {}x{} frames, {} frame event at {} fps, types={}'.format(
+        args['width'], height, args['event_frames'], args['event_fps'], types))
+    print('  (peak RSS is the growth over the RSS at the start of the run)')
+    # warm up: JPEGs get encoded on first request
+    _measure(lambda: _buffered_animation('alarm', 1, os.path.join(tmp, 'warm'), types))
+    variants = [('buffered', _buffered_animation), ('streaming', img.createAnimation)]
+    for name, fn in variants:
+        best = None
+        for i in range(args['repeat']):
+            fname = os.path.join(tmp, name)
+            diff_time, peak, ok = _measure(lambda: fn('alarm', 1, fname, types))
+            if best is None or diff_time < best[0]:
+                best = (diff_time, peak, ok)
+        sizes = ' '.join('{}={}'.format(t, os.stat(os.path.join(tmp, name + '.' + t)).st_size)
+                         for t in ('mp4', 'gif') if t in types and os.path.exists(os.path.join(tmp, name + '.' + t)))
+        print('  {:<10} {:8.1f} ms  peak RSS +{:7.1f} MB  ok={}  {}'.format(
+            name, best[0] * 1000, best[1] / 1024 / 1024, best[2], sizes))
+    server.close()
+
+
+def _scene_frames(count, width, height, quality):
+    # a static scene with a box moving through it, round-tripped through
+    # JPEG like the frames ZM serves
+    import io
+    import numpy as np
+    from PIL import Image
+
+    y, x = np.mgrid[0:height, 0:width]
+    scene = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+    scene = scene.astype(np.uint8)
+    rng = np.random.default_rng(1)
+    for _ in range(20):
+        x1, y1 = rng.integers(0, width - 60), rng.integers(0, height - 60)
+        scene[y1:y1 + rng.integers(10, 60), x1:x1 + rng.integers(10, 60)] = rng.integers(0, 255, 3)
+    frames = []
+    for i in range(count):
+        frame = scene.copy()
+        bx = int(i * (width - width // 8) / max(count - 1, 1))
+        frame[height // 3:height // 3 + height // 4, bx:bx + width // 8] = (200, 40, 40)
+        buf = io.BytesIO()
+        Image.fromarray(frame).save(buf, format='JPEG', quality=quality)
+        frames.append(np.asarray(Image.open(io.BytesIO(buf.getvalue())).convert('RGB')))
+    return frames
+
+
+def bench_gif(args):
+    import os
+    import tempfile
+    import imageio
+    import numpy as np
+    from PIL import Image, ImageSequence
+    from zmes_hook_helpers.gif import GifWriter
+
+    _use_defaults()
+    height = args['width'] * 9 // 16
+    frames = _scene_frames(args['frames'], args['width'], height, args['quality'])
+    tmp = tempfile.mkdtemp()
+
+    def _psnr(fname):
+        decoded = [np.asarray(f.convert('RGB'), dtype=np.float64) for f in ImageSequence.Iterator(Image.open(fname))]
+        if len(decoded) != len(frames):
+            return float('nan')
+        mse = np.mean([((d - f) ** 2).mean() for d, f in zip(decoded, frames)])
+        return 10 * np.log10(255 ** 2 / mse) if mse else float('inf')
+
+    def _imageio():
+        imageio.mimwrite(os.path.join(tmp, 'imageio.gif'), frames, format='gif', fps=2)
+
+    def _gifsicle():
+        _imageio()
+        from pygifsicle import optimize
+        optimize(source=os.path.join(tmp, 'imageio.gif'), colors=256)
+
+    def _gifwriter():
+        w = GifWriter(os.path.join(tmp, 'gifwriter.gif'), 2)
+        for f in frames:
+            w.append_data(f)
+        w.close()
+
+    print('gif: {} frames {}x{}, JPEG quality {}'.format(len(frames), args['width'], height, args['quality']))
+    variants = [('imageio', _imageio, 'imageio.gif'),
+                ('imageio+gifsicle', _gifsicle, 'imageio.gif'),
+                ('GifWriter', _gifwriter, 'gifwriter.gif')]
+    for name, fn, out in variants:
+        try:
+            diff_time = _timeit(fn, args['repeat'])
+        except Exception as e:
+            print('  {:<17} skipped: {}'.format(name, e))
+            continue
+        fname = os.path.join(tmp, out)
+        print('  {:<17} {:8.1f} ms  {:9d} bytes  PSNR {:5.1f} dB'.format(
+            name, diff_time * 1000, os.stat(fname).st_size, _psnr(fname)))
+
+
+def _shapely_past_detections(bbox, label, conf, saved_bs, saved_ls, max_diff_area, use_percent):
+    # the shapely pair loop processPastDetection used before
+    from shapely.geometry import Polygon
+
+    def _poly(b):
+        it = iter(b)
+        b = list(zip(it, it))
+        b.insert(1, (b[1][0], b[0][1]))
+        b.insert(3, (b[0][0], b[2][1]))
+        return Polygon(b)
+
+    new_bbox, new_label, new_conf = [], [], []
+    for idx, b in enumerate(bbox):
+        obj = _poly(b)
+        found = False
+        for saved_idx, saved_b in enumerate(saved_bs):
+            if saved_ls[saved_idx] != label[idx]:
+                continue
+            saved_obj = _poly(saved_b)
+            max_diff_pixels = max_diff_area
+            if saved_obj.intersects(obj):
+                if obj.contains(saved_obj):
+                    diff_area = obj.difference(saved_obj).area
+                    if use_percent:
+                        max_diff_pixels = obj.area * max_diff_area / 100
+                else:
+                    diff_area = saved_obj.difference(obj).area
+                    if use_percent:
+                        max_diff_pixels = saved_obj.area * max_diff_area / 100
+                if diff_area <= max_diff_pixels:
+                    found = True
+                    break
+        if not found:
+            new_bbox.append(b)
+            new_label.append(label[idx])
+            new_conf.append(conf[idx])
+    return new_bbox, new_label, new_conf
+
+
+def _street_boxes(count, rng, labels):
+    # boxes of a busy street scene: objects of a few sizes, many of them
+    # barely moved since the last event
+    boxes, names = [], []
+    for _ in range(count):
+        w, h = int(rng.integers(20, 300)), int(rng.integers(20, 300))
+        x, y = int(rng.integers(0, 1920 - w)), int(rng.integers(0, 1080 - h))
+        boxes.append([x, y, x + w, y + h])
+        names.append(labels[int(rng.integers(0, len(labels)))])
+    return boxes, names
+
+
+def _moved_boxes(count, saved, saved_ls, rng, labels):
+    # current boxes: every other one is a saved box moved a few pixels, the
+    # rest are new
+    bbox, label = [], []
+    for i in range(count):
+        if i % 2 and i < len(saved):
+            d = rng.integers(-3, 4, 4)
+            bbox.append([int(v + dv) for v, dv in zip(saved[i], d)])
+            label.append(saved_ls[i])
+        else:
+            b, l = _street_boxes(1, rng, labels)
+            bbox.append(b[0])
+            label.append(l[0])
+    return bbox, label
+
+
+def bench_past_detection(args):
+    import numpy as np
+    import zmes_hook_helpers.image_manip as img
+
+    _use_defaults()
+    rng = np.random.default_rng(7)
+    labels = ['person', 'car', 'truck', 'bicycle', 'motorbike', 'bus'][:args['labels']]
+    print('past-detection: {} labels, current and saved box counts equal'.format(len(labels)))
+    for count in args['boxes']:
+        saved, saved_ls = _street_boxes(count, rng, labels)
+        bbox, label = _moved_boxes(count, saved, saved_ls, rng, labels)
+        conf = [0.9] * count
+        for setting in args['max_diff_area']:
+            use_percent = not setting.endswith('px')
+            max_diff = int(setting.rstrip('px%'))
+            run = lambda fn: fn(bbox, label, conf, saved, saved_ls, max_diff, use_percent)
+            old = run(_shapely_past_detections)
+            new = run(img.filter_past_detections)
+            t_old = _timeit(lambda: run(_shapely_past_detections), args['repeat'])
+            t_new = _timeit(lambda: run(img.filter_past_detections), args['repeat'])
+            print('  boxes={:<5} {:<5} shapely {:9.2f} ms  numpy {:7.2f} ms  kept {:<5} same={}'.format(
+                count, setting, t_old * 1000, t_new * 1000, len(new[0]), old == new))
+
+
+def _generate_zones(count, rng, width=1920, height=1080, vertices=(5, 12)):
+    # star shaped polygons of vertices[0]-vertices[1] points scattered over
+    # the frame
+    import numpy as np
+
+    zones = []
+    for i in range(count):
+        cx, cy = rng.uniform(0, width), rng.uniform(0, height)
+        n = int(rng.integers(vertices[0], vertices[1] + 1))
+        angles = np.sort(rng.uniform(0, 2 * np.pi, n))
+        radius = rng.uniform(30, 300, n)
+        points = [(int(cx + r * np.cos(a)), int(cy + r * np.sin(a))) for a, r in zip(angles, radius)]
+        zones.append({'name': 'zone_{}'.format(i), 'value': points, 'pattern': None})
+    return zones
+
+
+def _shapely_zones(bbox, polygons):
+    # the pair loop processFilters used before: a Polygon per zone per box
+    from shapely.geometry import Polygon
+
+    result = []
+    for b in bbox:
+        it = iter(b)
+        b = list(zip(it, it))
+        b.insert(1, (b[1][0], b[0][1]))
+        b.insert(3, (b[0][0], b[2][1]))
+        obj = Polygon(b)
+        result.append([z for z, p in enumerate(polygons) if obj.intersects(Polygon(p['value']))])
+    return result
+
+
+def bench_zones(args):
+    import tempfile
+    import numpy as np
+    from zmes_hook_helpers.zone_index import ZoneIndex, RasterZoneIndex
+
+    _use_defaults({'zone_raster_cell': args['cell'], 'base_data_path': tempfile.mkdtemp(prefix='zm_bench_')})
+    rng = np.random.default_rng(11)
+    print('zones: boxes tested against every zone they intersect, raster cell {}px'.format(args['cell']))
+    print('  zm_detect_old.py builds the index in every event: "event" is build + query, "query" is the')
+    print('  query alone, as in a process that keeps the index. Raster zones are drawn in the "first"')
+    print('  event and read back from base_data_path after that')
+
+    def _first(polygons):
+        # no rasters saved yet
+        g.config['base_data_path'] = tempfile.mkdtemp(prefix='zm_bench_')
+        return RasterZoneIndex(polygons)
+
+    for zcount in args['zones']:
+        polygons = _generate_zones(zcount, rng)
+        for count in args['boxes']:
+            bbox, _ = _street_boxes(count, rng, ['car'])
+            expected = _shapely_zones(bbox, polygons)
+            t_old = _timeit(lambda: _shapely_zones(bbox, polygons), args['repeat'])
+            line = '  zones={:<4} boxes={:<5} shapely {:8.2f} ms'.format(zcount, count, t_old * 1000)
+            for name, cls in (('index', ZoneIndex), ('raster', RasterZoneIndex)):
+                index = cls(polygons)
+                found = index.intersecting(bbox)
+                t_event = _timeit(lambda: cls(polygons).intersecting(bbox), args['repeat'])
+                t_query = _timeit(lambda: index.intersecting(bbox), args['repeat'])
+                # boxes where a zone was missed / reported that shapely does not
+                missed = sum(1 for e, f in zip(expected, found) if set(e) - set(f))
+                extra = sum(1 for e, f in zip(expected, found) if set(f) - set(e))
+                line += ' | {} event {:6.2f} ms query {:6.2f}'.format(name, t_event * 1000, t_query * 1000)
+                if cls is RasterZoneIndex:
+                    base_data_path = g.config['base_data_path']
+                    t_first = _timeit(lambda: _first(polygons).intersecting(bbox), args['repeat'])
+                    g.config['base_data_path'] = base_data_path
+                    line += ' first {:6.2f}'.format(t_first * 1000)
+                line += ' missed={} extra={}'.format(missed, extra)
+            print(line)
+
+
+def _shapely_filters(bbox, label, conf, match, model, polygons):
+    # processFilters before zone_index: a Polygon per zone per box, the
+    # first zone a box intersects decides
+    import re
+    from shapely.geometry import Polygon
+
+    new_bbox, new_label, new_conf = [], [], []
+    for idx, b in enumerate(bbox):
+        old_b = b
+        it = iter(b)
+        b = list(zip(it, it))
+        b.insert(1, (b[1][0], b[0][1]))
+        b.insert(3, (b[0][0], b[2][1]))
+        obj = Polygon(b)
+        for p in polygons:
+            if obj.intersects(Polygon(p['value'])):
+                if model == 'object' and p['pattern'] and p['pattern'] != g.config['object_detection_pattern']:
+                    r = re.compile(p['pattern'])
+                    match = list(filter(r.match, label))
+                if label[idx] in match:
+                    new_label.append(label[idx])
+                    new_bbox.append(old_b)
+                    new_conf.append(conf[idx])
+                break
+    return new_bbox, new_label, new_conf
+
+
+def _shapely_plates(bbox, label, conf, polygons):
+    # getValidPlateDetections before zone_index: a plate is valid in the
+    # first zone it intersects without containing it
+    import re
+    from shapely.geometry import Polygon
+
+    if not len(label):
+        return bbox, label, conf
+    r = re.compile(g.config['alpr_detection_pattern'])
+    match = list(filter(r.match, label))
+    new_bbox, new_label, new_conf = [], [], []
+    for idx, b in enumerate(bbox):
+        if not label[idx] in match:
+            continue
+        old_b = b
+        it = iter(b)
+        b = list(zip(it, it))
+        b.insert(1, (b[1][0], b[0][1]))
+        b.insert(3, (b[0][0], b[2][1]))
+        obj = Polygon(b)
+        for p in polygons:
+            poly = Polygon(p['value'])
+            if obj.intersects(poly) and not obj.contains(poly):
+                new_label.append(label[idx])
+                new_bbox.append(old_b)
+                new_conf.append(conf[idx])
+                break
+    return new_bbox, new_label, new_conf
+
+
+def _reference_draw_bbox(img, bbox, labels, confidence, polygons):
+    # draw_bbox before scaled_polygons: zones drawn from g.polygons as they are
+    import cv2
+    import numpy as np
+
+    colors = [(39, 174, 96), (142, 68, 173), (0, 129, 254), (254, 60, 113), (243, 134, 48), (91, 177, 47)][::-1]
+    if g.config['poly_thickness']:
+        for ps in polygons:
+            cv2.polylines(img, [np.asarray(ps['value'])], True, g.config['poly_color'],
+                          thickness=g.config['poly_thickness'])
+    for i, label in enumerate(labels):
+        color = colors[i % len(colors)]
+        if confidence:
+            label += ' ' + str(format(confidence[i] * 100, '.2f')) + '%'
+        cv2.rectangle(img, (bbox[i][0], bbox[i][1]), (bbox[i][2], bbox[i][3]), color, 2)
+        text_size = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.8, 1)[0]
+        cv2.rectangle(img, (bbox[i][0], bbox[i][1] - text_size[1] - 4), (bbox[i][0] + text_size[0] + 4, bbox[i][1]),
+                      color, -1)
+        cv2.putText(img, label, (bbox[i][0] + 2, bbox[i][1] - 2), cv2.FONT_HERSHEY_SIMPLEX, 0.8, [255, 255, 255], 1)
+    return img
+
+
+def _per_call(fn, rounds):
+    # like pytest-benchmark: enough iterations per round for the timer,
+    # returns (min, median) seconds per call over the rounds
+    import statistics
+
+    iterations = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        if time.perf_counter() - start >= 0.005 or iterations >= 1000:
+            break
+        iterations *= 10
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        times.append((time.perf_counter() - start) / iterations)
+    return min(times), statistics.median(times)
+
+
+def _allocated(fn):
+    # peak bytes allocated during one call, as tracemalloc sees them (numpy
+    # arrays included)
+    import tracemalloc
+
+    tracemalloc.start()
+    try:
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn()
+        return tracemalloc.get_traced_memory()[1] - size
+    finally:
+        tracemalloc.stop()
+
+
+def bench_image_manip(args):
+    import tempfile
+    import numpy as np
+    import zmes_hook_helpers.image_manip as img
+    import zmes_hook_helpers.past_detections as past_detections
+    import zmes_hook_helpers.zone_index as zone_index
+
+    _use_defaults({'base_data_path': tempfile.mkdtemp(prefix='zm_bench_'), 'poly_color': (127, 140, 141),
+                   'past_det_max_diff_area': args['max_diff_area']})
+    rng = np.random.default_rng(5)
+    labels = ['person', 'car', 'truck', 'bicycle']
+    size = (1920, 1080)
+    frame = np.asarray(_scene_frames(1, size[0], size[1], 90)[0])[:, :, ::-1].copy()
+    functions = args['functions']
+    print('image-manip: per call min/median over {} rounds, reference is the shapely implementation;'
+          ' alloc is the peak traced allocation of one call'.format(args['rounds']))
+    print('  (draw_bbox copies the 1080p frame each call, that is most of its time and allocation)')
+    print('  "current" is what a zm_detect_old.py event pays: the zone index and scaled zones are built')
+    print('  in every call. "cached" is the median with them kept, as in a process handling many events')
+    print('  {:<24}{:>6}{:>6}{:>6} {:>20} {:>20} {:>9} {:>9} {:>19}  same'.format(
+        'function', 'boxes', 'zones', 'saved', 'reference ms', 'current ms', 'cached', 'speedup',
+        'alloc KiB ref/cur'))
+    failed = 0
+
+    def _cold(fn):
+        # like a new process: no zone index or scaled zones kept yet
+        def call():
+            zone_index._indexes.clear()
+            zone_index._scaled.clear()
+            return fn()
+        return call
+
+    def _report(name, count, zcount, saved, ref, cur, ok, cached=True):
+        # ref and cur are (fn, result). cached=False if cur keeps nothing
+        # between calls
+        nonlocal failed
+        t_ref = _per_call(ref, args['rounds'])
+        t_cur = _per_call(_cold(cur) if cached else cur, args['rounds'])
+        t_cached = '{:9.3f}'.format(_per_call(cur, args['rounds'])[1] * 1000) if cached else '-'
+        a_ref = _allocated(ref)
+        a_cur = _allocated(_cold(cur) if cached else cur)
+        failed += not ok
+        print('  {:<24}{:>6}{:>6}{:>6} {:>9.3f} /{:>9.3f} {:>9.3f} /{:>9.3f} {:>9} {:>8.1f}x {:>9.1f}/{:>9.1f}  {}'.format(
+            name, count, zcount, saved, t_ref[0] * 1000, t_ref[1] * 1000, t_cur[0] * 1000, t_cur[1] * 1000,
+            t_cached, t_ref[1] / t_cur[1] if t_cur[1] else 0, a_ref / 1024, a_cur / 1024, ok))
+
+    if 'past' in functions:
+        m = re.match(r'(\d+)(px|%)?$', args['max_diff_area'])
+        max_diff, use_percent = int(m.group(1)), m.group(2) != 'px'
+        for saved in args['saved']:
+            saved_bs, saved_ls = _street_boxes(saved, rng, labels)
+            mid = 'bench{}'.format(saved)
+            if saved:
+                past_detections.save(mid, saved_bs, saved_ls, [0.9] * saved)
+            for count in args['boxes']:
+                bbox, label = _moved_boxes(count, saved_bs, saved_ls, rng, labels)
+                conf = [0.9] * count
+                # the current one reads the saved detections from the DB
+                ref = lambda: _shapely_past_detections(bbox, label, conf, saved_bs, saved_ls, max_diff, use_percent)
+                cur = lambda: img.processPastDetection(bbox, label, conf, mid)
+                _report('processPastDetection', count, '-', saved, ref, cur, ref() == cur(), cached=False)
+
+    for zcount in args['zones']:
+        polygons = _generate_zones(zcount, rng, size[0], size[1], args['vertices'])
+        # zones with their own pattern
+        for p in polygons[::4]:
+            p['pattern'] = '(person|car)'
+        g.polygons = polygons
+        g.polygons_size = size
+        for count in args['boxes']:
+            bbox, label = _street_boxes(count, rng, labels)
+            conf = [round(float(c), 2) for c in rng.uniform(0.5, 1, count)]
+            if 'filters' in functions:
+                match = [l for l in label if l != 'bicycle']
+                for mode in args['modes']:
+                    g.config['zone_filter_mode'] = mode
+                    ref = lambda: _shapely_filters(bbox, label, conf, match, 'object', polygons)
+                    cur = lambda: img.processFilters(bbox, label, conf, match, 'object', 'bench', size)
+                    _report('processFilters' + ('' if mode == 'shapely' else ' ' + mode),
+                            count, zcount, '-', ref, cur, ref() == cur())
+                g.config['zone_filter_mode'] = 'shapely'
+            if 'plates' in functions:
+                plates = ['ABC{:03d}'.format(i) for i in range(count)]
+                ref = lambda: _shapely_plates(bbox, plates, conf, polygons)
+                cur = lambda: img.getValidPlateDetections(bbox, plates, conf, 'bench', size)
+                _report('getValidPlateDetections', count, zcount, '-', ref, cur, ref() == cur())
+            if 'draw' in functions:
+                ref = lambda: _reference_draw_bbox(frame.copy(), bbox, list(label), conf, polygons)
+                cur = lambda: img.draw_bbox(frame.copy(), bbox, list(label), None, conf, mid='bench')
+                _report('draw_bbox', count, zcount, '-', ref, cur, bool(np.array_equal(ref(), cur())))
+    if failed:
+        print('  {} results differ from the reference'.format(failed))
+        sys.exit(1)
+
+
+class _StandInZMLog:
+    # the parts of pyzm.ZMLog a log call goes through: the level check, the
+    # caller lookup with inspect.stack() and formatting the log line, which
+    # is written to a list instead of a file, taking sink_us per line
+    def __init__(self, debug, sink_us=0):
+        self.sink_us = sink_us
+        self.config = {'log_debug': debug, 'log_level_debug': 5, 'log_debug_target': None,
+                       'log_level_syslog': -5, 'log_level_db': -5, 'log_level_file': 1,
+                       'dump_console': False}
+        self.levels = {'DBG': 1, 'INF': 0, 'WAR': -1, 'ERR': -2, 'FAT': -3, 'PNC': -4}
+        self.process_name = 'zmesdetect_m1'
+        self.lines = []
+
+    def _log(self, level, message, caller, debug_level=1):
+        import os
+        from inspect import getframeinfo, stack
+
+        if not caller:
+            idx = min(len(stack()), 2)
+            caller = getframeinfo(stack()[idx][0])
+        self.lines.append('{} [{}] {}:{} [{}]'.format(
+            'DBG{}'.format(debug_level), self.process_name, os.path.split(caller.filename)[1],
+            caller.lineno, message))
+        if self.sink_us:
+            time.sleep(self.sink_us / 1e6)
+
+    def Debug(self, level=1, message=None, caller=None):
+        if self.config['log_debug'] and level <= self.config['log_level_debug']:
+            self._log('DBG', message, caller, level)
+
+    def Info(self, message=None, caller=None):
+        self._log('INF', message, caller)
+
+    def close(self):
+        pass
+
+
+def _ml_options(rng):
+    # an ml_sequence sized payload, like the ones zm_detect logs
+    return {'general': {'model_sequence': 'object,face,alpr', 'disable_locks': 'no'},
+            'object': {'sequence': [{'object_weights': '/var/lib/zmeventnotification/models/yolov4/yolov4.weights',
+                                     'object_config': '/var/lib/zmeventnotification/models/yolov4/yolov4.cfg',
+                                     'object_min_confidence': float(rng.uniform(0.3, 0.6)),
+                                     'object_framework': 'opencv', 'object_processor': 'cpu'}
+                                    for _ in range(4)]},
+            'polygons': [{'name': 'zone_{}'.format(i), 'value': [(int(x), int(y)) for x, y in rng.integers(0, 1920, (8, 2))]}
+                         for i in range(10)]}
+
+
+def _nested(depth, fn):
+    # calls fn depth frames down, hooks run a few levels deep
+    if depth <= 0:
+        return fn()
+    return _nested(depth - 1, fn)
+
+
+def bench_logging(args):
+    import numpy as np
+    from zmes_hook_helpers.log import ZMLogger
+
+    payload = _ml_options(np.random.default_rng(5))
+    calls = args['calls']
+    print('logging: {} Debug(2) calls of a {} character payload, {} frames deep, {} us per written line, per call'.format(
+        calls, len(str(payload)), args['depth'], args['sink_us']))
+    for debug in (True, False):
+        old = _StandInZMLog(debug, args['sink_us'])
+        new = ZMLogger(_StandInZMLog(debug, args['sink_us']))
+
+        def run_old():
+            for _ in range(calls):
+                old.Debug(2, 'ml options: {}'.format(payload))
+
+        def run_new():
+            for _ in range(calls):
+                new.Debug(2, 'ml options: %s', payload)
+
+        t_old = _timeit(lambda: _nested(args['depth'], run_old), args['repeat'])
+        t_new = _timeit(lambda: _nested(args['depth'], run_new), args['repeat'])
+        # same line, apart from the caller's line number
+        strip_line = lambda l: re.sub(r':\d+ \[', ' [', l, count=1)
+        if debug and strip_line(old.lines[-1]) != strip_line(new.zmlog.lines[-1]):
+            print('the wrapper wrote a different line:\n  {}\n  {}'.format(old.lines[-1], new.zmlog.lines[-1]))
+            exit(1)
+        line = '  debug {:3}: ZMLog + str.format {:8.2f} us | ZMLogger + %-args {:8.2f} us'.format(
+            'on' if debug else 'off', t_old / calls * 1e6, t_new / calls * 1e6)
+        if debug:
+            # time spent in the calls; the writer thread does the rest
+            buffered = ZMLogger(_StandInZMLog(debug, args['sink_us']))
+            buffered.start_buffer(calls * args['repeat'] + 1, 250)
+            t_buf = _timeit(lambda: _nested(args['depth'], lambda: [
+                buffered.Debug(2, 'ml options: %s', payload) for _ in range(calls)]), args['repeat'])
+            buffered.close()
+            line += ' | buffered {:8.2f} us, {} dropped'.format(t_buf / calls * 1e6, buffered.dropped)
+        print(line)
+
+
+# Recorded events for replay are directories named after the event ID:
+#   <eid>/<fid>.jpg   frames, snapshot.jpg and alarm.jpg are optional
+#   <eid>/event.json  optional, what ZM's /api/events/<eid>.json returned
+#   <eid>/mlapi.json  optional, what mlapi answered for the event
+#   <eid>/meta.json   optional, {"monitorid": "1", "reason": "Motion: All"}
+# Without --events, events are generated in that layout.
+
+def _generate_events(path, count, frames, width, height):
+    import json
+    import os
+    import numpy as np
+    from PIL import Image
+
+    scene = _scene_frames(frames, width, height, 90)
+    rng = np.random.default_rng(3)
+    for i in range(count):
+        eid = str(1000 + i)
+        os.makedirs(os.path.join(path, eid))
+        for fid, frame in enumerate(scene, 1):
+            Image.fromarray(frame).save(os.path.join(path, eid, '{}.jpg'.format(fid)), quality=90)
+        boxes, labels = _street_boxes(int(rng.integers(1, 6)), rng, ['person', 'car', 'truck'])
+        boxes = [[b[0] * width // 1920, b[1] * height // 1080, b[2] * width // 1920, b[3] * height // 1080]
+                 for b in boxes]
+        mlapi = {'matched_data': {
+            'boxes': boxes, 'labels': labels,
+            'confidences': [round(float(c), 2) for c in rng.uniform(0.5, 1, len(labels))],
+            'frame_id': 'snapshot', 'image_dimensions': {'original': [height, width], 'resized': [height, width]},
+            'polygons': [], 'error_boxes': [], 'image': None,
+        }, 'all_matches': []}
+        with open(os.path.join(path, eid, 'mlapi.json'), 'w') as f:
+            json.dump(mlapi, f)
+        with open(os.path.join(path, eid, 'meta.json'), 'w') as f:
+            json.dump({'monitorid': str(1 + i % 3), 'reason': 'Motion: All'}, f)
+
+
+def _event_frames(path):
+    # fids of the numbered frames of a recorded event
+    import os
+    return sorted(int(f[:-4]) for f in os.listdir(path) if f.endswith('.jpg') and f[:-4].isdigit())
+
+
+class _ReplayZM:
+    # stand-in for the ZM API and index.php?view=image, serving recorded
+    # events. Without event.json, an event is described from its frames:
+    # 10 fps, alarmed and best scored in the middle
+    def __init__(self, events_dir, latency_ms=0):
+        import json
+        import os
+        import threading
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        from urllib.parse import urlparse, parse_qs
+
+        def _event(eid):
+            path = os.path.join(events_dir, eid)
+            if os.path.exists(os.path.join(path, 'event.json')):
+                with open(os.path.join(path, 'event.json')) as f:
+                    return json.load(f)
+            fids = _event_frames(path)
+            middle = fids[len(fids) // 2] if fids else 1
+            return {'event': {
+                'Event': {'Id': eid, 'Notes': '', 'AlarmFrameId': middle, 'MaxScoreFrameId': middle,
+                          'Frames': len(fids)},
+                'Frame': [{'FrameId': i, 'Delta': i / 10.0} for i in fids],
+            }}
+
+        def _frame(eid, fid):
+            path = os.path.join(events_dir, eid)
+            if fid in ('snapshot', 'alarm') and not os.path.exists(os.path.join(path, fid + '.jpg')):
+                e = _event(eid)['event']['Event']
+                fid = e['MaxScoreFrameId' if fid == 'snapshot' else 'AlarmFrameId']
+            try:
+                with open(os.path.join(path, '{}.jpg'.format(fid)), 'rb') as f:
+                    return f.read()
+            except OSError:
+                return None
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def _reply(self, body, content_type='application/json'):
+                if body is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _read_body(self):
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+            def do_GET(self):
+                time.sleep(latency_ms / 1000.0)
+                url = urlparse(self.path)
+                parts = url.path.rstrip('/').split('/')
+                if url.path.endswith('/host/getVersion.json'):
+                    return self._reply({'version': '1.36.12', 'apiversion': '2.0'})
+                if url.path.endswith('/host/gettimezone.json'):
+                    return self._reply({'tz': 'UTC'})
+                if '/zones/forMonitor/' in url.path:
+                    return self._reply({'zones': []})
+                if '/events/' in url.path:
+                    return self._reply(_event(parts[-1][:-len('.json')]))
+                if url.path.endswith('index.php'):
+                    q = parse_qs(url.query)
+                    return self._reply(_frame(q.get('eid', [''])[0], q.get('fid', [''])[0]), 'image/jpeg')
+                return self._reply({})
+
+            def do_POST(self):
+                self._read_body()
+                time.sleep(latency_ms / 1000.0)
+                if self.path.split('?')[0].endswith('/host/login.json'):
+                    return self._reply({'apiversion': '2.0', 'version': '1.36.12',
+                                        'access_token': 'replay', 'access_token_expires': 3600,
+                                        'refresh_token': 'replay', 'refresh_token_expires': 86400})
+                return self._reply({})
+
+            def do_PUT(self):
+                # notes updates
+                self._read_body()
+                time.sleep(latency_ms / 1000.0)
+                return self._reply({})
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.api_url = self.url + '/api'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+
+
+class _FakeMlapi:
+    # stand-in for mlapi. /login hands out a token, /detect/object answers
+    # after latency_ms with the event's mlapi.json, the --mlapi-response
+    # file, or no detections. Requests that carried a trace ID are counted
+    def __init__(self, events_dir, latency_ms=0, response_file=None):
+        import json
+        import os
+        import threading
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+        fixed = None
+        if response_file:
+            with open(response_file) as f:
+                fixed = json.load(f)
+        empty = {'matched_data': {'boxes': [], 'labels': [], 'confidences': [], 'frame_id': None,
+                                  'image_dimensions': {}, 'polygons': [], 'error_boxes': [], 'image': None},
+                 'all_matches': []}
+        self.counts = counts = {'detect': 0, 'traced': 0}
+        lock = threading.Lock()
+
+        def _response(request):
+            if fixed is not None:
+                return fixed
+            path = os.path.join(events_dir, str(request.get('stream')), 'mlapi.json')
+            try:
+                with open(path) as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                return empty
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if self.path.split('?')[0].endswith('/login'):
+                    reply = {'access_token': 'replay', 'expires': 3600}
+                else:
+                    time.sleep(latency_ms / 1000.0)
+                    try:
+                        request = json.loads(body)
+                    except ValueError:
+                        # --file uploads are multipart
+                        request = {}
+                    with lock:
+                        counts['detect'] += 1
+                        counts['traced'] += bool(self.headers.get('X-Trace-Id'))
+                    reply = _response(request)
+                reply = json.dumps(reply).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}/api/v1'.format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+
+
+def _replay_config(args, tmp, zm, mlapi, mode):
+    # the config under test (--config), pointed at the stand-ins. Paths
+    # under {{base_data_path}}, like models, stay where they are, what the
+    # hook writes goes to tmp
+    import configparser
+    import getpass
+    import grp
+    import os
+
+    config = configparser.ConfigParser(interpolation=None, inline_comment_prefixes='#')
+    config.read(args['config'])
+    base_data_path = config.get('general', 'base_data_path', fallback='/var/lib/zmeventnotification')
+    for sec in config.sections():
+        for k, v in config.items(sec):
+            config.set(sec, k, v.replace('{{base_data_path}}', base_data_path))
+
+    secrets = configparser.ConfigParser(interpolation=None, inline_comment_prefixes='#')
+    secrets_file = config.get('general', 'secrets', fallback=None)
+    if not secrets_file or not os.path.exists(secrets_file):
+        secrets_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'secrets.ini')
+    secrets.read(secrets_file)
+    if not secrets.has_section('secrets'):
+        secrets.add_section('secrets')
+    for k, v in (('ZM_PORTAL', zm.url), ('ZM_API_PORTAL', zm.api_url), ('ZM_USER', 'replay'),
+                 ('ZM_PASSWORD', 'replay'), ('ML_USER', 'replay'), ('ML_PASSWORD', 'replay')):
+        secrets.set('secrets', k, v)
+    with open(os.path.join(tmp, 'secrets.ini'), 'w') as f:
+        secrets.write(f)
+
+    # pyzm reads zm.conf for where to log. There is no ZM DB: the sqlite
+    # driver fails to take the MySQL URL and pyzm turns DB logging off
+    os.makedirs(os.path.join(tmp, 'logs'), exist_ok=True)
+    with open(os.path.join(tmp, 'zm.conf'), 'w') as f:
+        f.write('ZM_PATH_LOGS={}\nZM_DB_HOST=127.0.0.1:1\nZM_WEB_USER={}\nZM_WEB_GROUP={}\n'.format(
+            os.path.join(tmp, 'logs'), getpass.getuser(), grp.getgrgid(os.getgid()).gr_name))
+    try:
+        overrides = eval(config.get('general', 'pyzm_overrides', fallback='{}'))
+    except Exception:
+        overrides = {}
+    overrides.update({'conf_path': tmp, 'driver': 'sqlite', 'log_level_syslog': -5, 'log_level_db': -5,
+                      'log_level_file': 1})
+
+    general = {
+        'secrets': os.path.join(tmp, 'secrets.ini'),
+        'portal': zm.url, 'api_portal': zm.api_url, 'user': 'replay', 'password': 'replay',
+        'base_data_path': tmp, 'trace_file': os.path.join(tmp, 'misc', 'traces.jsonl'),
+        'server_socket': os.path.join(tmp, 'zm_detect.sock'),
+        'pyzm_overrides': repr(overrides), 'wait': '0', 'allow_self_signed': 'yes',
+    }
+    for k, v in general.items():
+        config.set('general', k, v)
+    if not config.has_section('animation'):
+        config.add_section('animation')
+    config.set('animation', 'create_animation', 'no')
+    if not config.has_section('remote'):
+        config.add_section('remote')
+    config.set('remote', 'ml_gateway', mlapi.url if mode == 'remote' else '')
+    config.set('remote', 'ml_fallback_local', 'no')
+    config.set('remote', 'ml_user', 'replay')
+    config.set('remote', 'ml_password', 'replay')
+    # a monitor section of the config must not send the hook elsewhere
+    for sec in config.sections():
+        if sec.startswith('monitor-'):
+            for k in ('ml_gateway', 'wait', 'create_animation'):
+                config.remove_option(sec, k)
+    path = os.path.join(tmp, 'objectconfig.ini')
+    with open(path, 'w') as f:
+        config.write(f)
+    return path
+
+
+def _run_event(cmd, env, log_dir):
+    # runs one hook process. Returns (wall seconds, exit code, output tail)
+    import subprocess
+    import tempfile
+
+    with tempfile.TemporaryFile(dir=log_dir) as out:
+        start = time.perf_counter()
+        code = subprocess.call(cmd, env=env, stdout=out, stderr=subprocess.STDOUT)
+        diff_time = time.perf_counter() - start
+        out.seek(0)
+        tail = out.read()[-600:].decode('utf-8', 'replace')
+    return diff_time, code, tail
+
+
+def _percentile(values, p):
+    # nearest rank
+    import math
+    values = sorted(values)
+    return values[max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)]
+
+
+def _read_traces(trace_file):
+    import json
+    traces = {}
+    try:
+        with open(trace_file) as f:
+            for line in f:
+                t = json.loads(line)
+                traces[t['trace_id']] = t
+    except FileNotFoundError:
+        pass
+    return traces
+
+
+def _replay_batch(args, events, cfg, tmp, concurrency, mode, serve):
+    import json
+    import os
+    import uuid
+    from concurrent.futures import ThreadPoolExecutor
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    if serve:
+        script = [sys.executable, os.path.join(here, 'zm_detect_client.py'), '--config', cfg]
+    else:
+        script = [sys.executable, os.path.join(here, 'zm_detect.py'), '--config', cfg]
+
+    def _one(job):
+        n, (eid, meta) = job
+        trace_id = 'replay-{}'.format(uuid.uuid4().hex[:12])
+        out = os.path.join(tmp, 'out', '{}-{}'.format(eid, n))
+        os.makedirs(out, exist_ok=True)
+        cmd = script + ['--eventid', eid, '--monitorid', str(meta.get('monitorid', '1')), '--eventpath', out,
+                        '--reason', meta.get('reason', 'Motion: All'), '--notes']
+        env = dict(os.environ, ZMES_TRACE_ID=trace_id)
+        return (trace_id,) + _run_event(cmd, env, tmp)
+
+    jobs = list(enumerate(events * args['rounds']))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        runs = list(pool.map(_one, jobs))
+    wall = time.perf_counter() - start
+
+    traces = _read_traces(os.path.join(tmp, 'misc', 'traces.jsonl'))
+    stages = {'process': []}
+    failed = []
+    rss = [0]
+    for trace_id, diff_time, code, tail in runs:
+        t = traces.get(trace_id)
+        if code or t is None or t.get('error'):
+            failed.append(t.get('error') if t and t.get('error') else 'exit {}: {}'.format(code, tail.strip()))
+            continue
+        # the hook's own peak, from its trace
+        rss.append(t.get('peak_rss_mb') or 0)
+        stages['process'].append(diff_time * 1000)
+        stages.setdefault('total', []).append(t['duration_ms'])
+        per_event = {}
+        for s in t['spans']:
+            per_event[s['name']] = per_event.get(s['name'], 0) + s.get('duration_ms', 0)
+        for name, ms in per_event.items():
+            stages.setdefault(name, []).append(ms)
+    return {
+        'events': len(runs),
+        'failed': len(failed),
+        'errors': failed[:3],
+        'seconds': round(wall, 3),
+        'throughput': round(len(runs) / wall, 3),
+        'peak_rss_mb': max(rss),
+        'stages': {name: {'count': len(v), 'p50': round(_percentile(v, 50), 2), 'p95': round(_percentile(v, 95), 2),
+                          'p99': round(_percentile(v, 99), 2)} for name, v in stages.items() if v},
+    }
+
+
+def _compare_baseline(results, baseline, tolerance):
+    # regressions of throughput and of the p95 of each stage, beyond
+    # tolerance percent. Stages under 1 ms are noise
+    regressions = []
+    for key, r in results.items():
+        b = baseline.get(key)
+        if not b:
+            continue
+        if r['throughput'] < b['throughput'] * (1 - tolerance / 100.0):
+            regressions.append('{}: throughput {} events/s, baseline {}'.format(key, r['throughput'], b['throughput']))
+        for name, s in r['stages'].items():
+            old = b['stages'].get(name)
+            if old and old['p95'] >= 1 and s['p95'] > old['p95'] * (1 + tolerance / 100.0):
+                regressions.append('{}: {} p95 {} ms, baseline {} ms'.format(key, name, s['p95'], old['p95']))
+    return regressions
+
+
+def bench_replay(args):
+    import json
+    import os
+    import shutil
+    import signal
+    import subprocess
+    import tempfile
+
+    tmp = tempfile.mkdtemp(prefix='zm_replay_')
+    events_dir = args['events']
+    if not events_dir:
+        events_dir = os.path.join(tmp, 'events')
+        _generate_events(events_dir, args['generate'], args['frames'], args['width'], args['width'] * 9 // 16)
+    events = []
+    for eid in sorted(os.listdir(events_dir)):
+        if not os.path.isdir(os.path.join(events_dir, eid)):
+            continue
+        meta = {}
+        if os.path.exists(os.path.join(events_dir, eid, 'meta.json')):
+            with open(os.path.join(events_dir, eid, 'meta.json')) as f:
+                meta = json.load(f)
+        events.append((eid, meta))
+
+    zm = _ReplayZM(events_dir, args['zm_latency_ms'])
+    mlapi = _FakeMlapi(events_dir, args['mlapi_latency_ms'], args['mlapi_response'])
+    print('replay: {} events x {} rounds from {}, ZM latency {} ms, mlapi latency {} ms{}'.format(
+        len(events), args['rounds'], events_dir, args['zm_latency_ms'], args['mlapi_latency_ms'],
+        ', through --serve' if args['serve'] else ''))
+    print('  process is the hook process as seen from outside, total is its trace;'
+          ' peak RSS is the largest of the hook processes (the server\'s children with --serve)')
+    results = {}
+    try:
+        for mode in args['mode']:
+            cfg = _replay_config(args, tmp, zm, mlapi, mode)
+            server = None
+            if args['serve']:
+                sock = os.path.join(tmp, 'zm_detect.sock')
+                server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                           'zm_detect.py'), '--serve', '--config', cfg],
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                for _ in range(600):
+                    if os.path.exists(sock) or server.poll() is not None:
+                        break
+                    time.sleep(0.1)
+            try:
+                for concurrency in args['concurrency']:
+                    r = _replay_batch(args, events, cfg, tmp, concurrency, mode, args['serve'])
+                    key = '{}/c{}'.format(mode, concurrency)
+                    results[key] = r
+                    print('  {:<10} {} events in {:.1f} s, {:.2f} events/s, peak RSS {} MB, {} failed'.format(
+                        key, r['events'], r['seconds'], r['throughput'], r['peak_rss_mb'], r['failed']))
+                    for e in r['errors']:
+                        print('    failed: {}'.format(e[-300:]))
+                    print('    {:<22}{:>6}{:>10}{:>10}{:>10}'.format('stage', 'count', 'p50 ms', 'p95 ms', 'p99 ms'))
+                    for name, s in r['stages'].items():
+                        print('    {:<22}{:>6}{:>10.1f}{:>10.1f}{:>10.1f}'.format(
+                            name, s['count'], s['p50'], s['p95'], s['p99']))
+            finally:
+                if server:
+                    server.send_signal(signal.SIGTERM)
+                    server.wait()
+        if mlapi.counts['detect']:
+            print('  mlapi: {} detect requests, {} with a trace ID'.format(
+                mlapi.counts['detect'], mlapi.counts['traced']))
+    finally:
+        zm.close()
+        mlapi.close()
+        if not args['keep']:
+            shutil.rmtree(tmp, ignore_errors=True)
+        else:
+            print('  kept {}'.format(tmp))
+
+    if args['save_baseline']:
+        with open(args['save_baseline'], 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('  baseline saved to {}'.format(args['save_baseline']))
+    if args['baseline']:
+        with open(args['baseline']) as f:
+            regressions = _compare_baseline(results, json.load(f), args['tolerance'])
+        for line in regressions:
+            print('  REGRESSION {}'.format(line))
+        if regressions:
+            sys.exit(1)
+        print('  no regressions over {} beyond {}%'.format(args['baseline'], args['tolerance']))
+    if any(r['failed'] for r in results.values()):
+        sys.exit(1)
+
+
+def main():
+    ap = argparse.ArgumentParser(description='zmes_hook_helpers benchmarks')
+    sub = ap.add_subparsers(dest='bench')
+    sp = sub.add_parser('config', help='{{var}} substitution on a generated config')
+    sp.add_argument('--keys', type=int, default=2000, help='number of config keys')
+    sp.add_argument('--depth', type=int, default=10, help='length of {{var}} reference chains')
+    sp.add_argument('--repeat', type=int, default=3, help='runs per measurement, best is reported')
+    sp = sub.add_parser('animation-fetch', help='createAnimation frame download against a local stand-in ZM')
+    sp.add_argument('--frames', type=int, default=20, help='frames to fetch')
+    sp.add_argument('--latency-ms', type=float, default=80, help='latency added to every request')
+    sp.add_argument('--workers', type=lambda v: [int(x) for x in v.split(',')], default=[1, 4, 8],
+                    help='comma separated worker counts to compare')
+    sp.add_argument('--retries', type=int, default=1, help='retries per frame')
+    sp.add_argument('--fail-every', type=int, default=0, help='fail every nth request with a 500')
+    sp = sub.add_parser('animation', help='createAnimation end to end, streaming vs buffering every frame')
+    sp.add_argument('--width', type=int, default=1280, help='frame width, height is 16:9')
+    sp.add_argument('--event-frames', type=int, default=200, help='frames in the event')
+    sp.add_argument('--event-fps', type=int, default=10, help='fps of the event')
+    sp.add_argument('--latency-ms', type=float, default=5, help='latency added to every request')
+    sp.add_argument('--types', default='mp4,gif', help='animation types to write')
+    sp.add_argument('--repeat', type=int, default=3, help='runs per measurement, best is reported')
+    sp = sub.add_parser('gif', help='GIF encoding of a generated scene: imageio (+gifsicle) vs GifWriter')
+    sp.add_argument('--frames', type=int, default=12, help='frames in the GIF')
+    sp.add_argument('--width', type=int, default=800, help='frame width, height is 16:9')
+    sp.add_argument('--quality', type=int, default=85, help='JPEG quality of the source frames')
+    sp.add_argument('--repeat', type=int, default=3, help='runs per measurement, best is reported')
+    sp = sub.add_parser('past-detection', help='past detection matching, shapely pair loop vs numpy')
+    sp.add_argument('--boxes', type=lambda v: [int(x) for x in v.split(',')], default=[10, 100, 300, 1000],
+                    help='comma separated box counts (current and saved)')
+    sp.add_argument('--labels', type=int, default=3, help='number of distinct labels, at most 6')
+    sp.add_argument('--max-diff-area', type=lambda v: v.split(','), default=['5%', '400px'],
+                    help='comma separated past_det_max_diff_area values')
+    sp.add_argument('--repeat', type=int, default=3, help='runs per measurement, best is reported')
+    sp = sub.add_parser('zones', help='box/zone intersection, shapely pair loop vs zone_index and raster mode')
+    sp.add_argument('--zones', type=lambda v: [int(x) for x in v.split(',')], default=[5, 20, 100],
+                    help='comma separated zone counts')
+    sp.add_argument('--boxes', type=lambda v: [int(x) for x in v.split(',')], default=[10, 100, 500],
+                    help='comma separated box counts')
+    sp.add_argument('--cell', type=int, default=4, help='zone_raster_cell for the raster mode')
+    sp.add_argument('--repeat', type=int, default=3, help='runs per measurement, best is reported')
+    sp = sub.add_parser('image-manip', help='per event image_manip functions vs their shapely implementations')
+    sp.add_argument('--functions', type=lambda v: v.split(','), default=['past', 'filters', 'plates', 'draw'],
+                    help='comma separated: past, filters, plates, draw')
+    sp.add_argument('--boxes', type=lambda v: [int(x) for x in v.split(',')], default=[1, 10, 100, 500],
+                    help='comma separated box counts')
+    sp.add_argument('--zones', type=lambda v: [int(x) for x in v.split(',')], default=[1, 10, 50],
+                    help='comma separated zone counts')
+    sp.add_argument('--vertices', type=lambda v: [int(x) for x in v.split(',')], default=[4, 24],
+                    help='min,max points per zone')
+    sp.add_argument('--saved', type=lambda v: [int(x) for x in v.split(',')], default=[0, 50, 200],
+                    help='comma separated saved (past) detection counts')
+    sp.add_argument('--max-diff-area', default='5%', help='past_det_max_diff_area')
+    sp.add_argument('--modes', type=lambda v: v.split(','), default=['shapely', 'raster'],
+                    help='zone_filter_mode values for processFilters')
+    sp.add_argument('--rounds', type=int, default=5, help='rounds per measurement')
+    sp = sub.add_parser('logging', help='Debug call overhead, ZMLog caller lookup vs zmes_hook_helpers.log')
+    sp.add_argument('--calls', type=int, default=2000, help='Debug calls per measurement')
+    sp.add_argument('--depth', type=int, default=15, help='stack depth the calls are made from')
+    sp.add_argument('--sink-us', type=int, default=0, help='time the log sink takes per written line')
+    sp.add_argument('--repeat', type=int, default=3, help='runs per measurement, best is reported')
+    sp = sub.add_parser('replay', help='zm_detect.py end to end on recorded events, stand-in ZM and mlapi')
+    sp.add_argument('--events', help='directory of recorded events (default: generate them)')
+    sp.add_argument('--generate', type=int, default=8, help='events to generate without --events')
+    sp.add_argument('--frames', type=int, default=10, help='frames per generated event')
+    sp.add_argument('--width', type=int, default=1280, help='frame width of generated events, height is 16:9')
+    sp.add_argument('--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'objectconfig.ini'),
+                    help='config to replay with; local mode needs its models')
+    sp.add_argument('--mode', type=lambda v: v.split(','), default=['remote'],
+                    help='comma separated: remote (fake mlapi) and/or local (DetectSequence)')
+    sp.add_argument('--concurrency', type=lambda v: [int(x) for x in v.split(',')], default=[1, 4],
+                    help='comma separated numbers of events run at once')
+    sp.add_argument('--rounds', type=int, default=2, help='times each event is replayed per batch')
+    sp.add_argument('--serve', action='store_true', help='run events through zm_detect.py --serve and the client')
+    sp.add_argument('--zm-latency-ms', type=float, default=10, help='latency added to every ZM request')
+    sp.add_argument('--mlapi-latency-ms', type=float, default=300, help='time mlapi takes per detection')
+    sp.add_argument('--mlapi-response', help='JSON file mlapi answers every detection with')
+    sp.add_argument('--save-baseline', help='write the results to this JSON file')
+    sp.add_argument('--baseline', help='compare with this baseline, exit 1 on regressions')
+    sp.add_argument('--tolerance', type=float, default=20, help='percent a result may be worse than the baseline')
+    sp.add_argument('--keep', action='store_true', help='keep the work directory (config, logs, traces, output)')
+    args = vars(ap.parse_args())
+
+    if args['bench'] == 'config':
+        bench_config(args)
+    elif args['bench'] == 'animation-fetch':
+        bench_animation_fetch(args)
+    elif args['bench'] == 'animation':
+        bench_animation(args)
+    elif args['bench'] == 'gif':
+        bench_gif(args)
+    elif args['bench'] == 'past-detection':
+        bench_past_detection(args)
+    elif args['bench'] == 'zones':
+        bench_zones(args)
+    elif args['bench'] == 'image-manip':
+        bench_image_manip(args)
+    elif args['bench'] == 'logging':
+        bench_logging(args)
+    elif args['bench'] == 'replay':
+        bench_replay(args)
+    else:
+        ap.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,119 +10,82 @@ import sys
 import argparse
 import datetime
 import os
-import numpy as np
 import re
-import imutils
-import ssl
-import pickle
 import json
 import time
-import requests
-import subprocess
 import traceback
 import ast 
-# Modules that load cv2 will go later 
-# so we can log misses
-import pyzm.ZMLog as log 
+# Heavy modules (cv2, numpy, pyzm.ZMLog/api/ml, requests...) are imported
+# where they are used, so --version and friends don't pay for them
+# and cv2 misses get logged
 import zmes_hook_helpers.utils as utils
-import pyzm.helpers.utils as pyzmutils
 import zmes_hook_helpers.common_params as g
+import zmes_hook_helpers.httpclient as httpclient
+import zmes_hook_helpers.mlapi_token as mlapi_token
+import zmes_hook_helpers.trace as trace
 from pyzm import __version__ as pyzm_version
 
 auth_header = None
 
 __app_version__ = '6.1.16'
 
+def mlapi_image(path):
+    # what remote_detect uploads for --file: the file itself if it is a
+    # JPEG that needs no resizing, else the image decoded, resized and
+    # encoded again. The encoded buffer is uploaded without copying it
+    import cv2
+    import imutils
+    from PIL import Image
+
+    width = int(g.config['resize']) if g.config['resize'] and g.config['resize'] != 'no' else None
+    try:
+        # reads the header only
+        with Image.open(path) as im:
+            as_is = im.format == 'JPEG' and (not width or im.size[0] <= width) and \
+                im.getexif().get(0x0112, 1) == 1  # cv2 would rotate by EXIF orientation
+    except Exception as e:
+        g.logger.Debug(2, 'could not read the image header of %s: %s', path, e)
+        as_is = False
+    if as_is:
+        g.logger.Debug(2, 'Sending %s as it is', path)
+        return path
+
+    g.logger.Debug (2, "Reading image from %s", path)
+    image = cv2.imread(path)
+    if image is None:
+        raise ValueError('could not read image {}'.format(path))
+    if width and image.shape[1] > width:
+        g.logger.Debug (2,'Resizing image before sending')
+        image = imutils.resize(image, width=width)
+    ret, jpeg = cv2.imencode('.jpg', image)
+    return jpeg
+
 def remote_detect(stream=None, options=None, api=None, args=None):
     # This uses mlapi (https://github.com/pliablepixels/mlapi) to run inferencing and converts format to what is required by the rest of the code.
 
-    import requests
     import cv2
-    
+    import numpy as np
+    import imutils
+    from zmes_hook_helpers.httpclient import get_session
+
+    session = get_session()
     bbox = []
     label = []
     conf = []
     model = 'object'
-    files={}
     api_url = g.config['ml_gateway']
     g.logger.Info('Detecting using remote API Gateway {}'.format(api_url))
-    login_url = api_url + '/login'
     object_url = api_url + '/detect/object?type='+model
-    access_token = None
     global auth_header
 
-    data_file = g.config['base_data_path'] + '/zm_login.json'
-    if os.path.exists(data_file):
-        g.logger.Debug(2,'Found token file, checking if token has not expired')
-        with open(data_file) as json_file:
-            try:
-                data = json.load(json_file)
-                json_file.close()
-            except Exception as e: 
-                g.logger.Error ('Error loading login.json: {}'.format(e))
-                os.remove(data_file)
-                access_token = None
-            else:
-                generated = data['time']
-                expires = data['expires']
-                access_token = data['token']
-                now = time.time()
-                # lets make sure there is at least 30 secs left
-                if int(now + 30 - generated) >= expires:
-                    g.logger.Debug(
-                        1,'Found access token, but it has expired (or is about to expire)'
-                    )
-                    access_token = None
-                else:
-                    g.logger.Debug(1,'Access token is valid for {} more seconds'.format(
-                        int(now - generated)))
-                    # Get API access token
-    if not access_token:
-        g.logger.Debug(1,'Invoking remote API login')
-        r = requests.post(url=login_url,
-                          data=json.dumps({
-                              'username': g.config['ml_user'],
-                              'password': g.config['ml_password'],
-                             
-
-                          }),
-                          headers={'content-type': 'application/json'})
-        data = r.json()
-        access_token = data.get('access_token')
-        if not access_token:
-            raise ValueError('Error getting remote API token {}'.format(data))
-            return
-        g.logger.Debug(2,'Writing new token for future use')
-        with open(data_file, 'w') as json_file:
-            wdata = {
-                'token': access_token,
-                'expires': data.get('expires'),
-                'time': time.time()
-            }
-            json.dump(wdata, json_file)
-            json_file.close()
-
+    with trace.span('mlapi_token'):
+        access_token = mlapi_token.get_token(session, api_url)
     auth_header = {'Authorization': 'Bearer ' + access_token}
     
     params = {'delete': True, 'response_format': 'zm_detect'}
 
-    if args.get('file'):
-        g.logger.Debug (2, "Reading image from {}".format(args.get('file')))
-        image = cv2.imread(args.get('file'))
-        if g.config['resize'] and g.config['resize'] != 'no':
-            g.logger.Debug (2,'Resizing image before sending')
-            img_new = imutils.resize(image,
-                                     width=min(int(g.config['resize']),
-                                               image.shape[1]))
-            image = img_new
-            ret, jpeg = cv2.imencode('.jpg', image)
-            files = {'file': ('image.jpg', jpeg.tobytes())}
-
-    else:
-        files = {}
-    #print (object_url)
+    image = mlapi_image(args.get('file')) if args.get('file') else None
 
-    
     ml_overrides = {
         'model_sequence':g.config['ml_sequence'].get('general',{}).get('model_sequence'),
         'object': {
@@ -137,22 +100,44 @@ def remote_detect(stream=None, options=None, api=None, args=None):
     }
     mid = args.get('monitorid')
     reason = args.get('reason')
-    g.logger.Debug(2,f'Invoking mlapi with url:{object_url} and json: mid={mid} reason={reason} stream={stream}, stream_options={options} ml_overrides={ml_overrides} headers={auth_header} params={params} ')
+    g.logger.Debug(2,'Invoking mlapi with url:%s and json: mid=%s reason=%s stream=%s, stream_options=%s ml_overrides=%s headers=%s params=%s ',
+        object_url, mid, reason, stream, options, ml_overrides, auth_header, params)
     start = datetime.datetime.now()
-    try:
-        r = requests.post(url=object_url,
-                        headers=auth_header,
-                        params=params,
-                        files=files,
-                        json = {
+    def _post():
+        headers = dict(auth_header, **trace.headers())
+        body = None
+        if image is not None:
+            # as with files=, an uploaded image replaces the json
+            body = httpclient.MultipartFile('file', 'image.jpg', image)
+            headers['Content-Type'] = body.content_type
+            payload = {'data': body}
+        else:
+            payload = {'json': {
                             'version': __app_version__, 
                             'mid': mid,
                             'reason': reason,
                             'stream': stream,
                             'stream_options':options,
                             'ml_overrides':ml_overrides
-                        }
-                        )
+                        }}
+        try:
+            with trace.span('mlapi_post'):
+                return session.post(url=object_url,
+                            headers=headers,
+                            params=params,
+                            **payload
+                            )
+        finally:
+            if body is not None:
+                body.close()
+    try:
+        r = _post()
+        if r.status_code == 401:
+            g.logger.Debug(1,'mlapi rejected the access token, logging in again')
+            mlapi_token.invalidate(access_token)
+            access_token = mlapi_token.get_token(session, api_url)
+            auth_header = {'Authorization': 'Bearer ' + access_token}
+            r = _post()
         r.raise_for_status()
     except Exception as e:
         g.logger.Error ('Error during remote post: {}'.format(str(e)))
@@ -160,15 +145,16 @@ def remote_detect(stream=None, options=None, api=None, args=None):
         raise
 
     diff_time = (datetime.datetime.now() - start)
-    g.logger.Debug(1,'remote detection inferencing took: {}'.format(diff_time))
+    g.logger.Debug(1,'remote detection inferencing took: %s', diff_time)
     data = r.json()
     #print(r)
     matched_data = data['matched_data']
     if g.config['write_image_to_zm'] == 'yes'  and matched_data['frame_id']:
         url = '{}/index.php?view=image&eid={}&fid={}'.format(g.config['portal'], stream,matched_data['frame_id'] )
-        g.logger.Debug(2,'Grabbing image from {} as we need to write objdetect.jpg'.format(url))
+        g.logger.Debug(2,'Grabbing image from %s as we need to write objdetect.jpg', url)
         try:
-            response = api._make_request(url=url,  type='get')
+            with trace.span('fetch', kind='frame'):
+                response = api._make_request(url=url,  type='get')
             img = np.asarray(bytearray(response.content), dtype='uint8')
             img = cv2.imdecode (img, cv2.IMREAD_COLOR)
             if options.get('resize') and options.get('resize') != 'no':
@@ -189,8 +175,7 @@ def append_suffix(filename, token):
 
 # main handler
 
-def main_handler():
-    # set up logging to syslog
+def parse_args(argv=None):
     # construct the argument parse and parse the arguments
   
     ap = argparse.ArgumentParser()
@@ -223,25 +208,34 @@ def main_handler():
     ap.add_argument('-n', '--notes', help='updates notes field in ZM with detections', action='store_true')
     ap.add_argument('-d', '--debug', help='enables debug on console', action='store_true')
 
-    args, u = ap.parse_known_args()
-    args = vars(args)
+    ap.add_argument('--serve', help='stay resident and serve detection requests over a local socket', action='store_true')
+    ap.add_argument('--socket', help='unix socket path for --serve (overrides server_socket in config)')
+    ap.add_argument('--startup-profile', help='print the import cost of each module the hook loads and quit', action='store_true')
+    ap.add_argument('--animation-worker', help='build queued animations in the background (started by zm_detect itself)', action='store_true')
+    ap.add_argument('--invalidate-zones', nargs='?', const='all', metavar='MONITORID',
+                    help='remove cached ZM zones of a monitor (or of all monitors) and quit')
+    ap.add_argument('--trace-id', help='trace ID of the event, for its log lines and trace (default: $ZMES_TRACE_ID or a new one)')
+    ap.add_argument('--startup-limit', type=float, help='with --startup-profile, exit with 1 if importing zm_detect takes longer than this many ms')
 
-    if args.get('version'):
-        print('app:{}, pyzm:{}'.format(__app_version__,pyzm_version))
-        exit(0)
+    args, u = ap.parse_known_args(argv)
+    return vars(args)
 
-    if args.get('bareversion'):
-        print('{}'.format(__app_version__))
-        exit(0)
 
-    if not args.get('config'):
-        print ('--config required')
-        exit(1)
+def init_logs(args):
+    import pyzm.ZMLog as log
+    if args.get('monitorid'):
+        log.init(name='zmesdetect_' + 'm' + args.get('monitorid'), override=g.config['pyzm_overrides'])
+    else:
+        log.init(name='zmesdetect',override=g.config['pyzm_overrides'])
+    from zmes_hook_helpers.log import ZMLogger
+    g.logger = ZMLogger(log)
+    g.logger.trace_id = trace.current_id()
+    if g.config.get('log_buffer') == 'yes':
+        g.logger.start_buffer(int(g.config['log_buffer_size']), int(g.config['log_flush_interval_ms']))
 
-    if not args.get('file')and not args.get('eventid'):
-        print ('--eventid required')
-        exit(1)
 
+def init_handler(args):
+    # one time setup: logs, OpenCV and the helpers that depend on it
     utils.get_pyzm_config(args)
 
     if args.get('debug'):
@@ -250,17 +244,9 @@ def main_handler():
         g.config['pyzm_overrides']['log_level_debug'] = 5
         g.config['pyzm_overrides']['log_debug_target'] = None
 
-    if args.get('monitorid'):
-        log.init(name='zmesdetect_' + 'm' + args.get('monitorid'), override=g.config['pyzm_overrides'])
-    else:
-        log.init(name='zmesdetect',override=g.config['pyzm_overrides'])
-    g.logger = log
+    init_logs(args)
     
-    es_version='(?)'
-    try:
-        es_version=subprocess.check_output(['/usr/bin/zmeventnotification.pl', '--version']).decode('ascii')
-    except:
-        pass
+    es_version = utils.get_es_version()
 
 
     try:
@@ -278,11 +264,103 @@ def main_handler():
     except Exception as e:
         g.logger.Error (f'{e}')
         exit(1)
+
+
+def get_zmapi():
+    import pyzm.api as zmapi
+    api_options  = {
+    'apiurl': g.config['api_portal'],
+    'portalurl': g.config['portal'],
+    'user': g.config['user'],
+    'password': g.config['password'] ,
+    'logger': g.logger, # use none if you don't want to log to ZM,
+    'disable_ssl_cert_check': False if g.config['allow_self_signed']=='no' else True
+    }
+
+    g.logger.Info('Connecting with ZM APIs')
+    return httpclient.use_for(zmapi.ZMApi(options=api_options))
+
+
+def get_ml_options():
+    ml_options = {}
+    secrets = None 
+    
+    if g.config['ml_sequence'] and g.config['use_sequence'] == 'yes':
+        g.logger.Debug(2,'using ml_sequence')
+        ml_options = utils.get_compiled('ml_options')
+        if ml_options is None:
+            import pyzm.helpers.utils as pyzmutils
+            ml_options = g.config['ml_sequence']
+            secrets = pyzmutils.read_config(g.config['secrets'])
+            ml_options = pyzmutils.template_fill(input_str=ml_options, config=None, secrets=secrets._sections.get('secrets'))
+            ml_options = ast.literal_eval(ml_options)
+            utils.set_compiled('ml_options', ml_options)
+        g.config['ml_sequence'] = ml_options
+    else:
+        g.logger.Debug(2,'mapping legacy ml data from config')
+        ml_options = utils.convert_config_to_ml_sequence()
+        g.config['ml_sequence'] = ml_options
+    return ml_options
+
+
+def get_detect_sequence(ml_options, mid=None):
+    # models come from the process wide pool, so a resident zm_detect
+    # does not reload weights for every event
+    from pyzm.ml.detect_sequence import DetectSequence
+    from zmes_hook_helpers.model_pool import pool
+
+    m = DetectSequence(options=ml_options, logger=g.logger)
+    pool.set_budget(g.config['model_pool_max_mb'])
+    m.models = pool.get_models(ml_options)
+    if g.config['object_batch_window_ms'] > 0:
+        from zmes_hook_helpers.batcher import use_batching
+        m.models = use_batching(ml_options, m.models)
+    if g.config['alpr_cache'] == 'yes':
+        from zmes_hook_helpers.alpr_cache import use_cache
+        m.models = use_cache(m.models, mid)
+    if trace.active():
+        m.models = trace.traced_models(m.models)
+    g.logger.Debug(1,'model_pool: %s', pool.stats())
+    return m
+
+
+def process_event(args, zmapi=None, out=None):
+    # runs detection for one event and prints the detected:...--SPLIT--{json}
+    # result to out (stdout by default)
+    if not trace.active():
+        trace.start(args.get('trace_id'))
+    trace.set_attrs(eid=args.get('eventid'), mid=args.get('monitorid'), file=args.get('file'))
+    g.logger.trace_id = trace.current_id()
+    http_start = httpclient.stats()
+    error = None
+    try:
+        detect_event(args, zmapi, out)
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+        raise
+    finally:
+        http = httpclient.stats_since(http_start)
+        g.logger.Debug(1,'http: %(opened)s connections opened, %(reused)s reused for %(requests)s requests', http)
+        trace.set_attrs(http=http)
+        trace.finish(error)
+
+
+def detect_event(args, zmapi=None, out=None):
+    import ssl
+    import cv2
+    import pyzm.helpers.utils as pyzmutils
+    import zmes_hook_helpers.image_manip as img
+    import zmes_hook_helpers.past_detections as past_detections
+
+    if out is None:
+        out = sys.stdout
     g.polygons = []
+    g.polygons_size = None
 
     # process config file
     g.ctx = ssl.create_default_context()
-    utils.process_config(args, g.ctx)
+    with trace.span('config'):
+        utils.process_config(args, g.ctx)
 
 
     # misc came later, so lets be safe
@@ -306,39 +384,22 @@ def main_handler():
 
     obj_json = []
 
-    import pyzm.api as zmapi
-    api_options  = {
-    'apiurl': g.config['api_portal'],
-    'portalurl': g.config['portal'],
-    'user': g.config['user'],
-    'password': g.config['password'] ,
-    'logger': g.logger, # use none if you don't want to log to ZM,
-    'disable_ssl_cert_check': False if g.config['allow_self_signed']=='no' else True
-    }
-
-    g.logger.Info('Connecting with ZM APIs')
-    zmapi = zmapi.ZMApi(options=api_options)
+    if zmapi is None:
+        with trace.span('zm_login'):
+            zmapi = get_zmapi()
+    else:
+        # handed over by the --serve parent
+        httpclient.use_for(zmapi)
     stream = args.get('eventid') or args.get('file')
-    ml_options = {}
     stream_options={}
-    secrets = None 
-    
-    if g.config['ml_sequence'] and g.config['use_sequence'] == 'yes':
-        g.logger.Debug(2,'using ml_sequence')
-        ml_options = g.config['ml_sequence']
-        secrets = pyzmutils.read_config(g.config['secrets'])
-        ml_options = pyzmutils.template_fill(input_str=ml_options, config=None, secrets=secrets._sections.get('secrets'))
-        ml_options = ast.literal_eval(ml_options)
-        g.config['ml_sequence'] = ml_options
-    else:
-        g.logger.Debug(2,'mapping legacy ml data from config')
-        ml_options = utils.convert_config_to_ml_sequence()
-        g.config['ml_sequence'] = ml_options
+    ml_options = get_ml_options()
 
     if g.config['stream_sequence'] and g.config['use_sequence'] == 'yes': # new sequence
         g.logger.Debug(2,'using stream_sequence')
-        stream_options = g.config['stream_sequence']
-        stream_options = ast.literal_eval(stream_options)
+        stream_options = utils.get_compiled('stream_options')
+        if stream_options is None:
+            stream_options = ast.literal_eval(g.config['stream_sequence'])
+            utils.set_compiled('stream_options', stream_options)
     else: # legacy
         g.logger.Debug(2,'mapping legacy stream data from config')
         if g.config['detection_mode'] == 'all':
@@ -357,7 +418,7 @@ def main_handler():
 
 
     # These are stream options that need to be set outside of supplied configs         
-    stream_options['api'] = zmapi
+    stream_options['api'] = trace.TracedApi(zmapi) if trace.active() else zmapi
     stream_options['polygons'] = g.polygons
     g.config['stream_sequence'] = stream_options
 
@@ -383,32 +444,36 @@ def main_handler():
     if not args['file'] and int(g.config['wait']) > 0:
         g.logger.Info('Sleeping for {} seconds before inferencing'.format(
             g.config['wait']))
-        time.sleep(g.config['wait'])
+        with trace.span('wait'):
+            time.sleep(g.config['wait'])
 
     if g.config['ml_gateway']:
         stream_options['api'] = None
         stream_options['monitorid'] = args.get('monitorid')
         start = datetime.datetime.now()
         try:
-            matched_data,all_data = remote_detect(stream=stream, options=stream_options, api=zmapi, args=args)
+            with trace.span('mlapi'):
+                matched_data,all_data = remote_detect(stream=stream, options=stream_options, api=zmapi, args=args)
             diff_time = (datetime.datetime.now() - start)
-            g.logger.Debug(1,'Total remote detection detection took: {}'.format(diff_time))
+            g.logger.Debug(1,'Total remote detection detection took: %s', diff_time)
         except Exception as e:
             g.logger.Error ("Error with remote mlapi:{}".format(e))
             g.logger.Debug(2,traceback.format_exc())
 
             if g.config['ml_fallback_local'] == 'yes':
                 g.logger.Debug (1, "Falling back to local detection")
-                stream_options['api'] = zmapi
-                from pyzm.ml.detect_sequence import DetectSequence
-                m = DetectSequence(options=ml_options, logger=g.logger)
-                matched_data,all_data = m.detect_stream(stream=stream, options=stream_options)
+                stream_options['api'] = trace.TracedApi(zmapi) if trace.active() else zmapi
+                with trace.span('detect', fallback=True):
+                    with trace.span('load_models'):
+                        m = get_detect_sequence(ml_options, args.get('monitorid'))
+                    matched_data,all_data = m.detect_stream(stream=stream, options=stream_options)
     
 
     else:
-        from pyzm.ml.detect_sequence import DetectSequence
-        m = DetectSequence(options=ml_options, logger=g.logger)
-        matched_data,all_data = m.detect_stream(stream=stream, options=stream_options)
+        with trace.span('detect'):
+            with trace.span('load_models'):
+                m = get_detect_sequence(ml_options, args.get('monitorid'))
+            matched_data,all_data = m.detect_stream(stream=stream, options=stream_options)
     
 
 
@@ -430,22 +495,19 @@ def main_handler():
     if g.config['match_past_detections'] == 'yes' and args.get('monitorid'):
         # point detections to post processed data set
         g.logger.Info('Removing matches to past detections')
-        bbox_t, label_t, conf_t = img.processPastDetection(
-            matched_data['boxes'], matched_data['labels'], matched_data['confidences'], args.get('monitorid'))
+        with trace.span('past_detections'):
+            bbox_t, label_t, conf_t = img.processPastDetection(
+                matched_data['boxes'], matched_data['labels'], matched_data['confidences'], args.get('monitorid'))
         # save current objects for future comparisons
         g.logger.Debug(1,
-            'Saving detections for monitor {} for future match'.format(
-                args.get('monitorid')))
+            'Saving detections for monitor %s for future match', args.get('monitorid'))
         try:
-            mon_file = g.config['image_path'] + '/monitor-' + args.get(
-            'monitorid') + '-data.pkl'
-            f = open(mon_file, "wb")
-            pickle.dump(matched_data['boxes'], f)
-            pickle.dump(matched_data['labels'], f)
-            pickle.dump(matched_data['confidences'], f)
-            f.close()
+            with trace.span('past_detections_save'):
+                past_detections.save(args.get('monitorid'), matched_data['boxes'],
+                                     matched_data['labels'], matched_data['confidences'],
+                                     eid=args.get('eventid'))
         except Exception as e:
-            g.logger.Error(f'Error writing to {mon_file}, past detections not recorded:{e}')
+            g.logger.Error(f'Error saving past detections, past detections not recorded:{e}')
 
         matched_data['boxes'] = bbox_t
         matched_data['labels'] = label_t
@@ -486,12 +548,14 @@ def main_handler():
         pred = prefix + 'detected:' + pred
         g.logger.Info('Prediction string:{}'.format(pred))
         jos = json.dumps(obj_json)
-        g.logger.Debug(1,'Prediction string JSON:{}'.format(jos))
-        print(pred + '--SPLIT--' + jos)
+        g.logger.Debug(1,'Prediction string JSON:%s', jos)
+        trace.set_attrs(result=pred)
+        print(pred + '--SPLIT--' + jos, file=out)
 
         if (matched_data['image'] is not None) and (g.config['write_image_to_zm'] == 'yes' or g.config['write_debug_image'] == 'yes'):
             #print (f'********* REMOTE POLY: {remote_polygons}')
-            debug_image = pyzmutils.draw_bbox(image=matched_data['image'],boxes=matched_data['boxes'], 
+            with trace.span('draw_bbox'):
+                debug_image = pyzmutils.draw_bbox(image=matched_data['image'],boxes=matched_data['boxes'], 
                                               labels=matched_data['labels'], confidences=matched_data['confidences'],
                                               polygons=matched_data['polygons'], poly_thickness = g.config['poly_thickness'],
                                               write_conf=True if g.config['show_percent'] == 'yes' else False )
@@ -501,30 +565,33 @@ def main_handler():
                     cv2.rectangle(debug_image, (_b[0], _b[1]), (_b[2], _b[3]),
                         (0,0,255), 1)
                 filename_debug = g.config['image_path']+'/'+os.path.basename(append_suffix(stream, '-{}-debug'.format(matched_data['frame_id'])))
-                g.logger.Debug (1,'Writing bound boxes to debug image: {}'.format(filename_debug))
-                cv2.imwrite(filename_debug,debug_image)
+                g.logger.Debug (1,'Writing bound boxes to debug image: %s', filename_debug)
+                with trace.span('write_debug_image'):
+                    cv2.imwrite(filename_debug,debug_image)
 
             if g.config['write_image_to_zm'] == 'yes' and args.get('eventpath'):
-                g.logger.Debug(1,'Writing detected image to {}/objdetect.jpg'.format(
-                    args.get('eventpath')))
-                cv2.imwrite(args.get('eventpath') + '/objdetect.jpg', debug_image)
+                g.logger.Debug(1,'Writing detected image to %s/objdetect.jpg', args.get('eventpath'))
+                with trace.span('write_image'):
+                    cv2.imwrite(args.get('eventpath') + '/objdetect.jpg', debug_image)
                 jf = args.get('eventpath')+ '/objects.json'
-                g.logger.Debug(1,'Writing JSON output to {}'.format(jf))
+                g.logger.Debug(1,'Writing JSON output to %s', jf)
                 try:
-                    with open(jf, 'w') as jo:
-                        json.dump(obj_json, jo)
-                        jo.close()
+                    with trace.span('write_json'):
+                        with open(jf, 'w') as jo:
+                            json.dump(obj_json, jo)
+                            jo.close()
                 except Exception as e:
                     g.logger.Error(f'Error creating {jf}:{e}')
                     
         if args.get('notes'):
             url = '{}/events/{}.json'.format(g.config['api_portal'], args['eventid'])
             try:
-                ev = zmapi._make_request(url=url,  type='get')
+                with trace.span('notes', step='get'):
+                    ev = zmapi._make_request(url=url,  type='get')
             except Exception as e:
                 g.logger.Error ('Error during event notes retrieval: {}'.format(str(e)))
                 g.logger.Debug(2,traceback.format_exc())
-                exit(0) # Let's continue with zmdetect
+                return # Let's continue with zmdetect
 
             new_notes = pred
             if ev.get('event',{}).get('Event',{}).get('Notes'): 
@@ -536,13 +603,14 @@ def main_handler():
                 except IndexError:
                     old_m = ''
                 new_notes = pred + 'Motion:'+ old_m
-                g.logger.Debug (1,'Replacing old note:{} with new note:{}'.format(old_notes, new_notes))
+                g.logger.Debug (1,'Replacing old note:%s with new note:%s', old_notes, new_notes)
                 
 
             payload = {}
             payload['Event[Notes]'] = new_notes
             try:
-                ev = zmapi._make_request(url=url, payload=payload, type='put')
+                with trace.span('notes', step='update'):
+                    ev = zmapi._make_request(url=url, payload=payload, type='put')
             except Exception as e:
                 g.logger.Error ('Error during notes update: {}'.format(str(e)))
                 g.logger.Debug(2,traceback.format_exc())
@@ -551,13 +619,241 @@ def main_handler():
             if not args.get('eventid'):
                 g.logger.Error ('Cannot create animation as you did not pass an event ID')
             else:
+                if g.config['animation_background'] == 'yes':
+                    g.logger.Debug(1,'animation: Queueing burst...')
+                    try:
+                        import zmes_hook_helpers.animation_queue as animation_queue
+                        with trace.span('animation', background=True):
+                            animation_queue.enqueue(args.get('eventid'), matched_data['frame_id'],
+                                                    args.get('eventpath')+'/objdetect', g.config['animation_types'],
+                                                    mid=args.get('monitorid'), trace_id=trace.current_id())
+                            animation_queue.ensure_worker([sys.executable, os.path.abspath(__file__),
+                                                           '--config', args.get('config'), '--animation-worker'])
+                    except Exception as e:
+                        g.logger.Error('Error queueing animation:{}'.format(e))
+                        g.logger.Error('animation: Traceback:{}'.format(traceback.format_exc()))
+                    return
+
                 g.logger.Debug(1,'animation: Creating burst...')
                 try:
-                    img.createAnimation(matched_data['frame_id'], args.get('eventid'), args.get('eventpath')+'/objdetect', g.config['animation_types'])
+                    with trace.span('animation', background=False):
+                        img.createAnimation(matched_data['frame_id'], args.get('eventid'), args.get('eventpath')+'/objdetect', g.config['animation_types'])
                 except Exception as e:
                     g.logger.Error('Error creating animation:{}'.format(e))
                     g.logger.Error('animation: Traceback:{}'.format(traceback.format_exc()))
-                
+
+
+def serve(args):
+    # Resident mode. OpenCV/pyzm imports, the parsed config and the ZM API
+    # login stay warm in this process. Each request is handled in a forked
+    # child, so every event still gets its own g.config and g.polygons
+    import io
+    import ssl
+    import signal
+    import socketserver
+    import pyzm.ZMLog as log
+
+    log_overrides = g.config['pyzm_overrides']
+    g.ctx = ssl.create_default_context()
+    utils.process_config(args, g.ctx)
+    sock_path = args.get('socket') or g.config['server_socket']
+    api = {'zmapi': get_zmapi(), 'time': time.time()}
+    parent_logs = []
+
+    batcher = None
+    if not g.config['ml_gateway'] or g.config['ml_fallback_local'] == 'yes':
+        from zmes_hook_helpers.model_pool import pool
+        ml_options = get_ml_options()
+        exclude = None
+        if g.config['object_batch_window_ms'] > 0:
+            from zmes_hook_helpers.batcher import FrameBatcher, batch_address, can_batch
+            def batcher_logs():
+                # same as for requests: keep our DB log connection, open its own
+                g.config['pyzm_overrides'] = log_overrides
+                parent_logs.append((log.engine, log.conn))
+                log.inited = False
+                init_logs({})
+
+            batcher = FrameBatcher(batch_address(), window_ms=g.config['object_batch_window_ms'],
+                                   max_size=g.config['object_batch_max_size'])
+            batcher.start(ml_options, after_fork=batcher_logs)
+            exclude = can_batch
+            g.logger.Info('serve: batching object frames on {}'.format(batch_address()))
+        pool.set_budget(g.config['model_pool_max_mb'])
+        # GPU/TPU handles don't survive a fork, children load those themselves
+        pool.warm(ml_options, processors=('cpu',), exclude=exclude)
+        g.logger.Info('serve: preloaded models: {}'.format(pool.stats()))
+
+    class DetectRequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            returncode = 0
+            out = io.StringIO()
+            try:
+                req = json.loads(self.rfile.readline().decode('utf-8'))
+                ev_args = dict(args)
+                ev_args['serve'] = False
+                for k in ('eventid', 'monitorid', 'eventpath', 'reason', 'notes', 'file', 'output_path', 'trace_id'):
+                    if k in req:
+                        ev_args[k] = req[k]
+                if not ev_args.get('eventpath'):
+                    ev_args['eventpath'] = ''
+                g.config['pyzm_overrides'] = log_overrides
+                # the DB log connection is shared with the parent. Keep a reference
+                # so it is never closed (or garbage collected) here and open our own
+                parent_logs.append((log.engine, log.conn))
+                log.inited = False
+                init_logs(ev_args)
+                # pooled models are the ones loaded before the fork, count
+                # only what this event loads and reuses
+                from zmes_hook_helpers.model_pool import pool
+                pool.reset_stats()
+                g.logger.Debug(1,'serve: processing request %s', req)
+                process_event(ev_args, zmapi=api['zmapi'], out=out)
+            except SystemExit as e:
+                returncode = e.code if isinstance(e.code, int) else 1
+            except Exception as e:
+                g.logger.Error('serve: error processing request:{} Traceback:{}'.format(e, traceback.format_exc()))
+                returncode = 1
+            reply = {'output': out.getvalue(), 'returncode': returncode}
+            try:
+                self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+            finally:
+                g.logger.close()
+
+    class DetectServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+        def service_actions(self):
+            super().service_actions()
+            # children inherit our login, so keep it fresh
+            if time.time() - api['time'] > 1800:
+                try:
+                    api['zmapi'] = get_zmapi()
+                except Exception as e:
+                    g.logger.Error('serve: could not refresh ZM API login: {}'.format(e))
+                api['time'] = time.time()
+
+    if os.path.exists(sock_path):
+        os.remove(sock_path)
+    server = DetectServer(sock_path, DetectRequestHandler)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    g.logger.Info('serve: listening for detection requests on {}'.format(sock_path))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if batcher:
+            batcher.close()
+        if os.path.exists(sock_path):
+            os.remove(sock_path)
+
+
+def animation_worker(args):
+    # builds queued animations until the queue stays empty, see animation_queue
+    import ssl
+    import pyzm.ZMLog as log
+    import zmes_hook_helpers.animation_queue as animation_queue
+
+    log_overrides = g.config['pyzm_overrides']
+    g.ctx = ssl.create_default_context()
+    utils.process_config(args, g.ctx)
+    parent_logs = []
+
+    def after_fork(job_file):
+        # same as serve: keep the parent's DB log connection, open our own
+        g.config['pyzm_overrides'] = log_overrides
+        parent_logs.append((log.engine, log.conn))
+        log.inited = False
+        init_logs({})
+
+    animation_queue.run_worker(after_fork)
+
+
+def startup_profile(limit_ms=None):
+    # Runs the imports of the hook entry point, and what an event loads later,
+    # in a fresh interpreter with -X importtime and summarizes them
+    import subprocess
+
+    stages = ['zm_detect', 'pyzm.ZMLog', 'cv2', 'zmes_hook_helpers.image_manip',
+              'pyzm.helpers.utils', 'pyzm.api', 'pyzm.ml.detect_sequence']
+    code = ''.join('try:\n import {0}\nexcept Exception as e:\n print("{0}: %s" % e)\n'.format(m) for m in stages)
+    here = os.path.dirname(os.path.abspath(__file__))
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=here,
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if p.stdout:
+        print('Import errors:\n{}'.format(p.stdout))
+
+    top = {}
+    modules = []
+    for line in p.stderr.splitlines():
+        m = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)', line)
+        if not m:
+            continue
+        self_us, cumulative_us, indent, name = int(m.group(1)), int(m.group(2)), len(m.group(3)), m.group(4)
+        modules.append((self_us, cumulative_us, name))
+        if indent == 1:
+            top[name] = cumulative_us
+
+    print('Cold import cost per stage (cumulative ms):')
+    for stage in stages:
+        if stage in top:
+            print('  {:<35} {:>10.1f}'.format(stage, top[stage] / 1000))
+        else:
+            print('  {:<35} {:>10}'.format(stage, 'already loaded' if any(x[2] == stage for x in modules) else 'n/a'))
+    print('Most expensive modules (self ms):')
+    for self_us, cumulative_us, name in sorted(modules, reverse=True)[:20]:
+        print('  {:<35} {:>10.1f}'.format(name, self_us / 1000))
+
+    entry_ms = top.get('zm_detect', 0) / 1000
+    if limit_ms is not None and entry_ms > limit_ms:
+        print('zm_detect import took {:.1f}ms, over the limit of {}ms'.format(entry_ms, limit_ms))
+        exit(1)
+
+
+def main_handler():
+    args = parse_args()
+
+    if args.get('startup_profile'):
+        startup_profile(args.get('startup_limit'))
+        exit(0)
+
+    if args.get('version'):
+        print('app:{}, pyzm:{}'.format(__app_version__,pyzm_version))
+        exit(0)
+
+    if args.get('bareversion'):
+        print('{}'.format(__app_version__))
+        exit(0)
+
+    if not args.get('config'):
+        print ('--config required')
+        exit(1)
+
+    if args.get('invalidate_zones'):
+        utils.get_pyzm_config(args)
+        init_logs(args)
+        mid = args.get('invalidate_zones')
+        for f in utils.invalidate_zone_cache(None if mid == 'all' else mid):
+            print('removed {}'.format(f))
+        return
+
+    if args.get('animation_worker'):
+        utils.get_pyzm_config(args)
+        init_logs(args)
+        animation_worker(args)
+        return
+
+    if args.get('serve'):
+        init_handler(args)
+        serve(args)
+        return
+
+    if not args.get('file')and not args.get('eventid'):
+        print ('--eventid required')
+        exit(1)
+
+    trace.start(args.get('trace_id'))
+    with trace.span('init'):
+        init_handler(args)
+    process_event(args)
             
 
 if __name__ == '__main__':
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+
+# Thin client for a resident "zm_detect.py --serve" process
+# It takes the same arguments as zm_detect.py, sends the event to the
+# server over its unix socket and prints the same detected:...--SPLIT--{json}
+# result. If no server is listening, it runs zm_detect.py directly.
+# Only standard modules are imported here so that it starts fast.
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+from configparser import ConfigParser
+
+DEFAULT_SOCKET = '/var/lib/zmeventnotification/zm_detect.sock'
+
+
+def get_socket_path(args):
+    if args.get('socket'):
+        return args.get('socket')
+    config_file = ConfigParser(interpolation=None, inline_comment_prefixes='#')
+    try:
+        config_file.read(args.get('config'))
+        sock_path = config_file.get('general', 'server_socket', fallback=DEFAULT_SOCKET)
+        base_data_path = config_file.get('general', 'base_data_path', fallback='/var/lib/zmeventnotification')
+    except Exception:
+        return DEFAULT_SOCKET
+    return sock_path.replace('{{base_data_path}}', base_data_path)
+
+
+def run_local():
+    detect_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'zm_detect.py')
+    os.execv(sys.executable, [sys.executable, detect_script] + sys.argv[1:])
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-c', '--config', help='config file with path')
+    ap.add_argument('-e', '--eventid', help='event ID to retrieve')
+    ap.add_argument('-p', '--eventpath', help='path to store object image file', default='')
+    ap.add_argument('-m', '--monitorid', help='monitor id - needed for mask')
+    ap.add_argument('-r', '--reason', help='reason for event (notes field in ZM)')
+    ap.add_argument('-n', '--notes', help='updates notes field in ZM with detections', action='store_true')
+    ap.add_argument('-f', '--file', help='internal testing use only - skips event download')
+    ap.add_argument('-o', '--output-path', help='internal testing use only - path for debug images to be written')
+    ap.add_argument('--socket', help='unix socket of the resident zm_detect.py')
+    ap.add_argument('--trace-id', help='trace ID of the event (default: $ZMES_TRACE_ID)')
+    args, u = ap.parse_known_args()
+    args = vars(args)
+
+    # anything unusual (version, debug etc.) is left to zm_detect.py
+    if u or not args.get('config') or not (args.get('eventid') or args.get('file')):
+        run_local()
+
+    sock_path = get_socket_path(args)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sock_path)
+    except OSError:
+        sock.close()
+        run_local()
+
+    req = {k: args.get(k) for k in ('eventid', 'monitorid', 'eventpath', 'reason', 'notes', 'file', 'output_path')}
+    req['trace_id'] = args.get('trace_id') or os.environ.get('ZMES_TRACE_ID')
+    with sock:
+        sock.sendall((json.dumps(req) + '\n').encode('utf-8'))
+        with sock.makefile('rb') as f:
+            line = f.readline()
+
+    if not line:
+        print('zm_detect server closed the connection without a result', file=sys.stderr)
+        exit(1)
+    reply = json.loads(line.decode('utf-8'))
+    sys.stdout.write(reply.get('output', ''))
+    exit(reply.get('returncode', 1))
+
+
+if __name__ == '__main__':
+    main()
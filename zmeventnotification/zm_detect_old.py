@@ -14,7 +14,6 @@ import numpy as np
 import re
 import imutils
 import ssl
-import pickle
 import json
 import time
 import requests
@@ -24,8 +23,10 @@ import traceback
 # Modules that load cv2 will go later 
 # so we can log misses
 import pyzm.ZMLog as log 
+from zmes_hook_helpers.log import ZMLogger
 import zmes_hook_helpers.utils as utils
 import zmes_hook_helpers.common_params as g
+import zmes_hook_helpers.alpr_cache as alpr_cache
 from pyzm import __version__ as pyzm_version
 from zmes_hook_helpers import __version__ as hooks_version
 
@@ -191,7 +192,7 @@ def main_handler():
         log.init(name='zmesdetect_' + 'm' + args.get('monitorid'), override=g.config['pyzm_overrides'])
     else:
         log.init(name='zmesdetect',override=g.config['pyzm_overrides'])
-    g.logger = log
+    g.logger = ZMLogger(log)
     
     es_version='(?)'
     try:
@@ -217,6 +218,7 @@ def main_handler():
         g.logger.Error (f'{e}')
         exit(1)
     g.polygons = []
+    g.polygons_size = None
 
     # process config file
     g.ctx = ssl.create_default_context()
@@ -304,8 +306,8 @@ def main_handler():
                                     width=min(int(g.config['resize']),
                                             image2.shape[1]))
 
-        newh, neww = image1.shape[:2]
-        utils.rescale_polygons(neww / oldw, newh / oldh)
+        # polygons are scaled to the resized image where they are used
+        g.polygons_size = (oldw, oldh)
 
     # Apply all configured models to each file
 
@@ -471,7 +473,8 @@ def main_handler():
                 '''
             # now filter these with polygon areas
             #g.logger.Debug (1,"INTERIM BOX = {} {}".format(b,l))
-            b, l, c = img.processFilters(b, l, c, match, model)
+            b, l, c = img.processFilters(b, l, c, match, model, args.get('monitorid'),
+                                         (image.shape[1], image.shape[0]))
             if use_alpr:
                 vehicle_labels = ['car', 'motorbike', 'bus', 'truck', 'boat']
                 if not set(l).isdisjoint(vehicle_labels) or try_next_image:
@@ -486,7 +489,18 @@ def main_handler():
                         alpr_obj = alpr.Alpr(logger=g.logger,options=g.config)
                         
 
-                    if g.config['ml_gateway'] and not remote_failed:
+                    # same vehicles as in a recent event: reuse its plates
+                    cached = None
+                    use_alpr_cache = g.config['alpr_cache'] == 'yes' and args.get('monitorid')
+                    if use_alpr_cache:
+                        vehicle_boxes = alpr_cache.vehicles(b, l) or \
+                            [[0, 0, original_image.shape[1], original_image.shape[0]]]
+                        cached = alpr_cache.lookup(args.get('monitorid'), original_image, vehicle_boxes,
+                                                   g.config['ml_gateway'] or g.config['alpr_api_type'] == 'cloud')
+
+                    if cached:
+                        alpr_b, alpr_l, alpr_c = cached
+                    elif g.config['ml_gateway'] and not remote_failed:
                         try:
                             alpr_b, alpr_l, alpr_c = remote_detect(original_image, 'alpr')
                         except Exception as e:
@@ -501,8 +515,12 @@ def main_handler():
 
                     else: # not ml_gateway
                         alpr_b, alpr_l, alpr_c = alpr_obj.detect(original_image)
+                    if use_alpr_cache and not cached:
+                        alpr_cache.store(args.get('monitorid'), original_image, vehicle_boxes,
+                                         alpr_b, alpr_l, alpr_c)
                     alpr_b, alpr_l, alpr_c = img.getValidPlateDetections(
-                        alpr_b, alpr_l, alpr_c)
+                        alpr_b, alpr_l, alpr_c, args.get('monitorid'),
+                        (image.shape[1], image.shape[0]))
                     if len(alpr_l):
                         #g.logger.Debug (1,'ALPR returned: {}, {}, {}'.format(alpr_b, alpr_l, alpr_c))
                         try_next_image = False
@@ -684,15 +702,11 @@ def main_handler():
                 'Saving detections for monitor {} for future match'.format(
                     args.get('monitorid')))
             try:
-                mon_file = g.config['image_path'] + '/monitor-' + args.get(
-                'monitorid') + '-data.pkl'
-                f = open(mon_file, "wb")
-                pickle.dump(bbox, f)
-                pickle.dump(label, f)
-                pickle.dump(conf, f)
-                f.close()
+                import zmes_hook_helpers.past_detections as past_detections
+                past_detections.save(args.get('monitorid'), bbox, label, conf,
+                                     eid=args.get('eventid'))
             except Exception as e:
-                g.logger.Error(f'Error writing to {mon_file}, past detections not recorded:{e}')
+                g.logger.Error(f'Error saving past detections, past detections not recorded:{e}')
 
             bbox = bbox_t
             label = label_t
@@ -702,7 +716,7 @@ def main_handler():
         # now we draw boxes
         g.logger.Debug (2, "Drawing boxes around objects")
         out = img.draw_bbox(image, bbox, label, classes, conf, None,
-                            g.config['show_percent'] == 'yes')
+                            g.config['show_percent'] == 'yes', args.get('monitorid'))
         image = out
 
         if g.config['frame_id'] == 'bestmatch':
@@ -20,8 +20,11 @@ EVENT_PATH="$5"
 REASON="$4"
 
 
+# zm_detect_client.py hands the event to a resident "zm_detect.py --serve"
+# if one is running (see server_socket in objectconfig.ini) and runs
+# zm_detect.py directly otherwise
 # use arrays instead of strings to avoid quote hell
-DETECTION_SCRIPT=(/var/lib/zmeventnotification/bin/zm_detect.py --monitorid $2 --eventid $1 --config "${CONFIG_FILE}" --eventpath "${EVENT_PATH}" --reason "${REASON}"  )
+DETECTION_SCRIPT=(/var/lib/zmeventnotification/bin/zm_detect_client.py --monitorid $2 --eventid $1 --config "${CONFIG_FILE}" --eventpath "${EVENT_PATH}" --reason "${REASON}"  )
 
 RESULTS=$("${DETECTION_SCRIPT[@]}" | grep "detected:")
 
@@ -0,0 +1,259 @@
+import os
+import json
+import time
+import fcntl
+from contextlib import contextmanager
+import zmes_hook_helpers.common_params as g
+
+# Cache of ALPR results per monitor, so that the same parked car does not go
+# to the plate recognition service (or the alpr binary) on every event.
+# An entry is a vehicle: its box, a 64 bit difference hash (dHash) of the
+# image inside the box, and the plates ALPR found inside it. A frame is a
+# hit if every vehicle in it matches an entry of the monitor: same image
+# size, boxes overlapping by MIN_IOU or more and hashes differing in at most
+# alpr_cache_hash_distance bits. Then the entries' plates are used instead
+# of calling ALPR. Entries expire after alpr_cache_ttl seconds.
+# Entries and hit/miss counts are kept in
+# {{base_data_path}}/misc/alpr_cache/m<mid>.json, which is read and written
+# while holding m<mid>.json.lock, as events of a monitor can run together.
+
+MIN_IOU = 0.8
+MAX_ENTRIES = 50
+VEHICLE_LABELS = ['car', 'motorbike', 'bus', 'truck', 'boat']
+
+
+def _cache_file(mid):
+    return os.path.join(g.config['base_data_path'], 'misc', 'alpr_cache', 'm{}.json'.format(mid))
+
+
+@contextmanager
+def _locked(mid):
+    cache_file = _cache_file(mid)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(cache_file + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _load(mid):
+    try:
+        with open(_cache_file(mid)) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        data = {}
+    except Exception as e:
+        g.logger.Error('alpr_cache: ignoring unreadable {}: {}'.format(_cache_file(mid), e))
+        data = {}
+    data.setdefault('entries', [])
+    data.setdefault('stats', {'hits': 0, 'misses': 0, 'cloud_calls_avoided': 0})
+    now = time.time()
+    data['entries'] = [e for e in data['entries'] if now - e['time'] < g.config['alpr_cache_ttl']]
+    return data
+
+
+def _save(mid, data):
+    cache_file = _cache_file(mid)
+    tmp_file = '{}.{}'.format(cache_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_file, cache_file)
+
+
+def dhash(image, box):
+    # 64 bit difference hash of the image inside box [x1,y1,x2,y2]
+    import cv2
+    import numpy as np
+
+    h, w = image.shape[:2]
+    x1, y1 = max(int(box[0]), 0), max(int(box[1]), 0)
+    x2, y2 = min(int(box[2]), w), min(int(box[3]), h)
+    crop = image[y1:y2, x1:x2]
+    if not crop.size:
+        return 0
+    if crop.ndim == 3:
+        crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(crop, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def _iou(a, b):
+    iw = min(a[2], b[2]) - max(a[0], b[0])
+    ih = min(a[3], b[3]) - max(a[1], b[1])
+    if iw <= 0 or ih <= 0:
+        return 0.0
+    inter = iw * ih
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def _find(entries, size, box, phash):
+    for e in entries:
+        if e['size'] == size and _iou(e['box'], box) >= MIN_IOU and \
+                bin(e['hash'] ^ phash).count('1') <= g.config['alpr_cache_hash_distance']:
+            return e
+    return None
+
+
+def vehicles(boxes, labels):
+    return [b for b, l in zip(boxes, labels) if l in VEHICLE_LABELS]
+
+
+def lookup(mid, image, vehicle_boxes, cloud=True):
+    # returns (boxes, labels, confidences) of the cached plates, or None.
+    # cloud says whether a miss would call a cloud service
+    size = list(image.shape[1::-1])
+    hashes = [dhash(image, box) for box in vehicle_boxes]
+    with _locked(mid):
+        data = _load(mid)
+        plates = []
+        hit = bool(vehicle_boxes)
+        for box, phash in zip(vehicle_boxes, hashes):
+            e = _find(data['entries'], size, box, phash)
+            if not e:
+                hit = False
+                break
+            plates.extend(p for p in e['plates'] if p not in plates)
+
+        stats = data['stats']
+        if hit:
+            stats['hits'] += 1
+            if cloud:
+                stats['cloud_calls_avoided'] += 1
+        else:
+            stats['misses'] += 1
+        _save(mid, data)
+    total = stats['hits'] + stats['misses']
+    g.logger.Debug(1,'alpr_cache: %s for monitor %s, hit rate %.0f%% (%s hits, %s misses), %s cloud calls avoided',
+        'hit' if hit else 'miss', mid, 100.0 * stats['hits'] / total, stats['hits'], stats['misses'],
+        stats['cloud_calls_avoided'])
+    if not hit:
+        return None
+    return [p['box'] for p in plates], [p['label'] for p in plates], [p['conf'] for p in plates]
+
+
+def _distance(box, x, y):
+    # from point x,y to box, 0 inside it
+    dx = max(box[0] - x, 0, x - box[2])
+    dy = max(box[1] - y, 0, y - box[3])
+    return dx * dx + dy * dy
+
+
+def store(mid, image, vehicle_boxes, boxes, labels, confs):
+    # remembers the plates found in image. Each plate belongs to the vehicle
+    # its center is in, or the nearest one, so a hit on all vehicles gives
+    # back every plate. Vehicles without plates are remembered too
+    if not vehicle_boxes:
+        return
+    size = list(image.shape[1::-1])
+    now = time.time()
+    vehicle_boxes = [[int(v) for v in vbox] for vbox in vehicle_boxes]
+    plates = [[] for _ in vehicle_boxes]
+    for b, l, c in zip(boxes, labels, confs):
+        cx, cy = (b[0] + b[2]) / 2, (b[1] + b[3]) / 2
+        nearest = min(range(len(vehicle_boxes)), key=lambda i: _distance(vehicle_boxes[i], cx, cy))
+        plates[nearest].append({'box': [int(v) for v in b], 'label': l, 'conf': float(c)})
+    hashes = [dhash(image, vbox) for vbox in vehicle_boxes]
+    with _locked(mid):
+        data = _load(mid)
+        for vbox, phash, vplates in zip(vehicle_boxes, hashes, plates):
+            old = _find(data['entries'], size, vbox, phash)
+            if old:
+                data['entries'].remove(old)
+            data['entries'].append({'size': size, 'box': vbox, 'hash': phash, 'time': now, 'plates': vplates})
+        data['entries'] = data['entries'][-MAX_ENTRIES:]
+        _save(mid, data)
+
+
+def stats(mid):
+    return _load(mid)['stats']
+
+
+def _frame_key(image):
+    # identifies a frame by its content, so a copy of it has the same key
+    import zlib
+    return image.shape, zlib.crc32(image[::16, ::16].tobytes())
+
+
+class _Vehicles:
+    # vehicles the object models of one models dict found in a frame, for
+    # the CachedAlpr models of the same dict. Keeps a key of the frame, not
+    # the frame itself
+    def __init__(self):
+        self.frame = None
+        self.boxes = []
+
+    def put(self, image, boxes):
+        key = _frame_key(image)
+        if key != self.frame:
+            self.frame, self.boxes = key, []
+        self.boxes.extend(boxes)
+
+    def take(self, image):
+        # the vehicles found in image, and forgets them
+        boxes = self.boxes if self.frame is not None and self.frame == _frame_key(image) else []
+        self.frame, self.boxes = None, []
+        return boxes
+
+
+class _ObjectTap:
+    # stands in for an object model and hands the vehicles it finds to
+    # CachedAlpr through vehicles
+    def __init__(self, model, vehicles):
+        self.model = model
+        self.vehicles = vehicles
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def detect(self, image=None):
+        b, l, c = self.model.detect(image=image)
+        self.vehicles.put(image, vehicles(b, l))
+        return b, l, c
+
+
+class CachedAlpr:
+    # stands in for a pyzm Alpr model. pyzm runs ALPR on the whole frame,
+    # so the vehicles come from the object model that ran on the same frame,
+    # or, if there is none, the whole frame is the "vehicle"
+    def __init__(self, model, mid, vehicles=None):
+        self.model = model
+        self.mid = mid
+        self.vehicles = vehicles
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def detect(self, image=None):
+        vehicle_boxes = self.vehicles.take(image) if self.vehicles else []
+        if not vehicle_boxes:
+            vehicle_boxes = [[0, 0, image.shape[1], image.shape[0]]]
+        options = getattr(self.model, 'options', None) or {}
+        cloud = options.get('alpr_api_type', 'cloud') == 'cloud'
+        try:
+            cached = lookup(self.mid, image, vehicle_boxes, cloud)
+        except Exception as e:
+            g.logger.Error('alpr_cache: lookup failed: {}'.format(e))
+            cached = None
+        if cached:
+            return cached
+        b, l, c = self.model.detect(image=image)
+        try:
+            store(self.mid, image, vehicle_boxes, b, l, c)
+        except Exception as e:
+            g.logger.Error('alpr_cache: could not store result: {}'.format(e))
+        return b, l, c
+
+
+def use_cache(models, mid):
+    # wraps the alpr models of a pyzm DetectSequence models dict
+    if not mid:
+        return models
+    if models.get('alpr'):
+        found = _Vehicles()
+        models['object'] = [_ObjectTap(m, found) for m in models.get('object', [])]
+        models['alpr'] = [CachedAlpr(m, mid, found) for m in models['alpr']]
+    return models
@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import fcntl
+import traceback
+import zmes_hook_helpers.common_params as g
+
+# Persistent queue of animation jobs, so that zm_detect can print its result
+# and exit while the animation is built in the background.
+# Jobs are JSON files in {{base_data_path}}/misc/animation_jobs:
+#   queue/<eid>.json    waiting, or waiting for a retry (next_run)
+#   running/<eid>.json  being built
+#   failed/<eid>.json   gave up after animation_job_max_attempts, kept for
+#                       FAILED_MAX_AGE seconds, at most MAX_FAILED of them
+# There is at most one event per job file, so an event is never queued twice.
+# Job files are only readable by their owner and hold no credentials: the
+# worker reads those from its own --config.
+# A single worker process (holding worker.lock) builds up to
+# animation_job_workers animations at a time, each in a forked child,
+# and exits once the queue has been empty for IDLE_EXIT seconds.
+
+IDLE_EXIT = 30
+POLL = 1
+FAILED_MAX_AGE = 7 * 24 * 3600
+MAX_FAILED = 50
+
+# what a job needs from the config of the event that queued it
+_general_keys = ['portal', 'api_portal', 'allow_self_signed', 'base_data_path',
+                 'http_connect_timeout', 'http_read_timeout', 'http_pool_maxsize']
+
+
+def _dir(*parts):
+    return os.path.join(g.config['base_data_path'], 'misc', 'animation_jobs', *parts)
+
+
+def _job_config():
+    keys = _general_keys + [k for k, v in g.config_vals.items() if v['section'] == 'animation']
+    return {k: g.config.get(k) for k in keys}
+
+
+def _makedirs(*dirs):
+    for d in dirs:
+        os.makedirs(_dir(d), mode=0o700, exist_ok=True)
+
+
+def _dump(job, path):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(job, f)
+
+
+def _write(job, path):
+    tmp_file = '{}.{}'.format(path, os.getpid())
+    _dump(job, tmp_file)
+    os.replace(tmp_file, path)
+
+
+def _prune_failed():
+    # drops failed jobs older than FAILED_MAX_AGE, and the oldest beyond
+    # MAX_FAILED
+    try:
+        names = [f for f in os.listdir(_dir('failed')) if f.endswith('.json')]
+    except FileNotFoundError:
+        return
+    files = []
+    for f in names:
+        try:
+            files.append((os.stat(_dir('failed', f)).st_mtime, f))
+        except FileNotFoundError:
+            pass
+    files.sort(reverse=True)
+    now = time.time()
+    for i, (mtime, f) in enumerate(files):
+        if i >= MAX_FAILED or now - mtime > FAILED_MAX_AGE:
+            try:
+                os.remove(_dir('failed', f))
+            except FileNotFoundError:
+                pass
+
+
+def enqueue(eid, frametype, fname, types, mid=None, trace_id=None):
+    # returns False if the event already has a queued or running job
+    _makedirs('queue', 'running')
+    job_file = _dir('queue', '{}.json'.format(eid))
+    if os.path.exists(_dir('running', '{}.json'.format(eid))):
+        g.logger.Debug(1,'animation: event %s is already being animated', eid)
+        return False
+    job = {
+        'eid': eid,
+        'mid': mid,
+        'trace_id': trace_id,
+        'frametype': frametype,
+        'fname': fname,
+        'types': types,
+        'attempts': 0,
+        'next_run': time.time(),
+        'config': _job_config(),
+    }
+    tmp_file = '{}.{}'.format(job_file, os.getpid())
+    _dump(job, tmp_file)
+    try:
+        # link fails if the file exists, which makes this a dedupe
+        os.link(tmp_file, job_file)
+    except FileExistsError:
+        g.logger.Debug(1,'animation: event %s is already queued', eid)
+        return False
+    finally:
+        os.remove(tmp_file)
+    g.logger.Debug(1,'animation: queued %s', job_file)
+    return True
+
+
+def _lock_worker():
+    lock = open(_dir('worker.lock'), 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+
+def ensure_worker(cmd):
+    # starts the worker (cmd) unless one is running. The job must be queued
+    # before this is called, see the idle exit in run_worker
+    import subprocess
+
+    lock = _lock_worker()
+    if not lock:
+        return
+    lock.close()
+    g.logger.Debug(1,'animation: starting worker')
+    subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def _due_jobs():
+    now = time.time()
+    jobs = []
+    for f in sorted(os.listdir(_dir('queue'))):
+        if not f.endswith('.json'):
+            continue
+        try:
+            with open(_dir('queue', f)) as fh:
+                job = json.load(fh)
+        except Exception:
+            continue
+        if job['next_run'] <= now:
+            jobs.append((job['next_run'], f))
+    return [f for _, f in sorted(jobs)]
+
+
+def _pending():
+    return any(f.endswith('.json') for f in os.listdir(_dir('queue')))
+
+
+def _finish(job_file, ok):
+    running = _dir('running', job_file)
+    if ok:
+        os.remove(running)
+        return
+    with open(running) as f:
+        job = json.load(f)
+    job['attempts'] += 1
+    if job['attempts'] >= g.config['animation_job_max_attempts']:
+        _makedirs('failed')
+        _write(job, _dir('failed', job_file))
+        _prune_failed()
+        g.logger.Error('animation: giving up on event {} after {} attempts'.format(job['eid'], job['attempts']))
+    else:
+        delay = job['config']['animation_retry_sleep'] * 2 ** (job['attempts'] - 1)
+        job['next_run'] = time.time() + delay
+        _write(job, _dir('queue', job_file))
+        g.logger.Debug(1,'animation: event %s failed, retrying in %ss', job['eid'], delay)
+    os.remove(running)
+
+
+def _run_job(job_file):
+    # runs in a forked child, returns the exit code
+    import ssl
+    import zmes_hook_helpers.image_manip as img
+
+    try:
+        with open(_dir('running', job_file)) as f:
+            job = json.load(f)
+        g.config.update(job['config'])
+        # log lines carry the trace ID of the event that queued the job
+        g.logger.trace_id = job.get('trace_id')
+        g.ctx = ssl.create_default_context()
+        if g.config['allow_self_signed'] == 'yes':
+            g.ctx.check_hostname = False
+            g.ctx.verify_mode = ssl.CERT_NONE
+        g.logger.Debug(1,'animation: building animation for event %s, attempt %s',
+            job['eid'], job['attempts'] + 1)
+        return 0 if img.createAnimation(job['frametype'], job['eid'], job['fname'], job['types']) else 1
+    except Exception as e:
+        g.logger.Error('animation: job {} failed:{} Traceback:{}'.format(job_file, e, traceback.format_exc()))
+        return 1
+
+
+def run_worker(after_fork=None):
+    # after_fork(job_file) is called in each child before the job runs
+    _makedirs('queue', 'running')
+    lock = _lock_worker()
+    if not lock:
+        g.logger.Debug(1,'animation: a worker is already running')
+        return
+    # whatever is in running/ was left by a worker that died
+    for f in os.listdir(_dir('running')):
+        g.logger.Debug(1,'animation: requeueing interrupted job %s', f)
+        os.replace(_dir('running', f), _dir('queue', f))
+    _prune_failed()
+
+    children = {}  # pid -> job file
+    idle_since = time.time()
+    while True:
+        while children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                break
+            _finish(children.pop(pid), os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0)
+
+        for job_file in _due_jobs():
+            if len(children) >= g.config['animation_job_workers']:
+                break
+            try:
+                os.rename(_dir('queue', job_file), _dir('running', job_file))
+            except FileNotFoundError:
+                continue
+            pid = os.fork()
+            if pid == 0:
+                code = 1
+                try:
+                    if after_fork:
+                        after_fork(job_file)
+                    code = _run_job(job_file)
+                    g.logger.close()
+                finally:
+                    os._exit(code)
+            children[pid] = job_file
+
+        if children or _pending():
+            idle_since = time.time()
+        elif time.time() - idle_since > IDLE_EXIT:
+            lock.close()
+            # a job queued while we were deciding to exit would see the
+            # lock held and not start a worker, so look once more
+            if not _pending():
+                g.logger.Debug(1,'animation: queue is empty, worker exiting')
+                return
+            lock = _lock_worker()
+            if not lock:
+                return
+            idle_since = time.time()
+        time.sleep(POLL)
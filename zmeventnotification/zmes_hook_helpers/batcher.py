@@ -0,0 +1,286 @@
+import os
+import time
+import queue
+import signal
+import threading
+import traceback
+import numpy as np
+from multiprocessing.connection import Listener, Client
+import zmes_hook_helpers.common_params as g
+from zmes_hook_helpers.model_pool import model_key, processor_of
+
+# Cross event micro-batching for OpenCV DNN (yolo) object models.
+# The resident zm_detect (--serve) runs a FrameBatcher in a process of its
+# own, so the serve process it forks event handlers from has no threads.
+# Forked event handlers swap their opencv/cpu object models for BatchedYolo,
+# which sends the frame to the batcher. Frames that arrive within object_batch_window_ms for the same
+# model are run as one NCHW blob. Each handler gets its own boxes back and
+# applies its monitor's polygons and patterns itself, as before.
+
+
+def batch_address():
+    return g.config['server_socket'] + '.batch'
+
+
+def can_batch(model_type, entry):
+    return model_type == 'object' and \
+        (entry.get('object_framework') or 'opencv') == 'opencv' and \
+        processor_of(model_type, entry) == 'cpu'
+
+
+class _Request:
+    def __init__(self, entry, image):
+        self.entry = entry
+        self.image = image
+        self.result = None
+        self.done = threading.Event()
+
+
+class _YoloNet:
+    # same pre/post processing as pyzm.ml.yolo.Yolo, for a batch of frames
+    def __init__(self, entry):
+        import cv2
+        self.net = cv2.dnn.readNet(entry.get('object_weights'), entry.get('object_config'))
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        with open(entry.get('object_labels')) as f:
+            self.classes = [line.strip() for line in f.readlines()]
+        layer_names = self.net.getLayerNames()
+        self.out_layers = [layer_names[i - 1] for i in np.array(self.net.getUnconnectedOutLayers()).flatten()]
+        self.width = int(entry.get('model_width', 416))
+        self.height = int(entry.get('model_height', 416))
+
+    def _downscale(self, r):
+        # like Yolo: frames wider than the model's max_size are scaled down
+        # first, returns the frame and the factors to scale boxes back up
+        import cv2
+
+        height, width = r.image.shape[:2]
+        max_size = int(r.entry.get('max_size') or width)
+        if width <= max_size:
+            return r.image, 1.0, 1.0
+        image = cv2.resize(r.image, (max_size, int(height * max_size / width)), interpolation=cv2.INTER_AREA)
+        return image, width / image.shape[1], height / image.shape[0]
+
+    def detect(self, requests):
+        import cv2
+
+        scaled = [self._downscale(r) for r in requests]
+        images = [s[0] for s in scaled]
+        blob = cv2.dnn.blobFromImages(images, 0.00392, (self.width, self.height), (0, 0, 0), True, crop=False)
+        self.net.setInput(blob)
+        outs = self.net.forward(self.out_layers)
+        n = len(images)
+        # batched yolo outputs are (N, rows, 85), some OpenCV versions give (N*rows, 85)
+        outs = [o.reshape(n, -1, o.shape[-1]) for o in outs]
+
+        results = []
+        for idx, r in enumerate(requests):
+            height, width = images[idx].shape[:2]
+            xfactor, yfactor = scaled[idx][1:]
+            conf_threshold = min(0.2, float(r.entry.get('object_min_confidence')))
+            dets = np.concatenate([o[idx] for o in outs])
+            scores = dets[:, 5:]
+            class_ids = np.argmax(scores, axis=1)
+            confs = scores[np.arange(len(class_ids)), class_ids]
+            keep = confs >= conf_threshold
+            dets, class_ids, confs = dets[keep], class_ids[keep], confs[keep]
+            w = (dets[:, 2] * width).astype(int)
+            h = (dets[:, 3] * height).astype(int)
+            x = (dets[:, 0] * width).astype(int) - w / 2
+            y = (dets[:, 1] * height).astype(int) - h / 2
+            boxes = np.stack([x, y, w, h], axis=1).tolist()
+            confs = confs.astype(float).tolist()
+            indices = cv2.dnn.NMSBoxes(boxes, confs, conf_threshold, 0.4)
+
+            prefix = '(yolo) ' if r.entry.get('show_models') == 'yes' else ''
+            bbox, label, conf = [], [], []
+            for i in np.array(indices).flatten():
+                bx, by, bw, bh = boxes[i]
+                b = [int(round(bx)), int(round(by)), int(round(bx + bw)), int(round(by + bh))]
+                if xfactor != 1.0 or yfactor != 1.0:
+                    b = [round(b[0] * xfactor), round(b[1] * yfactor), round(b[2] * xfactor), round(b[3] * yfactor)]
+                bbox.append(b)
+                label.append(prefix + str(self.classes[class_ids[i]]))
+                conf.append(confs[i])
+            results.append({'boxes': bbox, 'labels': label, 'confidences': conf})
+        return results
+
+
+class FrameBatcher:
+    def __init__(self, address, window_ms=5, max_size=8):
+        self.address = address
+        self.window = window_ms / 1000.0
+        self.max_size = max_size
+        self.queue = queue.Queue()
+        self.nets = {}
+        self.batches = 0
+        self.frames = 0
+        self.pid = None
+
+    def start(self, ml_options, after_fork=None):
+        # forks the batcher process, which preloads the models of ml_options
+        # and serves until close() or until the parent goes away. The caller
+        # keeps no batcher threads: a fork of a process with threads (e.g. in
+        # the middle of an OpenCV forward pass) can leave the child with locks
+        # nobody will release. after_fork() is called first in the new process
+        self.pid = os.fork()
+        if self.pid:
+            return
+        parent = os.getppid()
+        status = 0
+        try:
+            if after_fork:
+                after_fork()
+            self.warm(ml_options)
+            self._listen()
+            while os.getppid() == parent:
+                time.sleep(1)
+        except BaseException as e:
+            g.logger.Error('batcher: frame batcher stopped: {}'.format(e))
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _listen(self):
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        self.listener = Listener(self.address, family='AF_UNIX')
+        threading.Thread(target=self._accept, daemon=True).start()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def warm(self, ml_options):
+        for entry in ml_options.get('object', {}).get('sequence', []):
+            key = model_key('object', entry) + (entry.get('model_width'), entry.get('model_height'))
+            if can_batch('object', entry) and key not in self.nets:
+                try:
+                    self.nets[key] = _YoloNet(entry)
+                except Exception as e:
+                    g.logger.Error('batcher: could not preload {}: {}'.format(entry.get('object_weights'), e))
+
+    def close(self):
+        if self.pid:
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+                os.waitpid(self.pid, 0)
+            except OSError:
+                pass
+            self.pid = None
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        try:
+            while True:
+                msg = conn.recv()
+                req = _Request(msg['entry'], msg['image'])
+                self.queue.put(req)
+                req.done.wait()
+                conn.send(req.result)
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def _collect(self):
+        reqs = [self.queue.get()]
+        deadline = time.time() + self.window
+        while len(reqs) < self.max_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                reqs.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return reqs
+
+    def _run(self):
+        while True:
+            reqs = self._collect()
+            groups = {}
+            for r in reqs:
+                key = model_key('object', r.entry) + (r.entry.get('model_width'), r.entry.get('model_height'))
+                groups.setdefault(key, []).append(r)
+            for key, group in groups.items():
+                try:
+                    if key not in self.nets:
+                        self.nets[key] = _YoloNet(group[0].entry)
+                    results = self.nets[key].detect(group)
+                except Exception as e:
+                    results = [{'error': '{}: {}'.format(e, traceback.format_exc())}] * len(group)
+                self.batches += 1
+                self.frames += len(group)
+                for r, res in zip(group, results):
+                    r.result = res
+                    r.done.set()
+
+    def stats(self):
+        return {'batches': self.batches, 'frames': self.frames}
+
+
+class BatchedYolo:
+    # stands in for pyzm.ml.yolo.Yolo inside a pyzm Object, so pyzm's own
+    # size/confidence filtering still applies to what comes back
+    def __init__(self, options, address, fallback):
+        self.options = options
+        self.address = address
+        self.fallback = fallback
+        self.conn = None
+        self.classes = None
+
+    def get_classes(self):
+        # the fallback model is only loaded if it is used
+        if self.classes is None:
+            with open(self.options.get('object_labels')) as f:
+                self.classes = [line.strip() for line in f.readlines()]
+        return self.classes
+
+    # the batcher runs one forward pass at a time, no need for the cpu lock
+    def acquire_lock(self):
+        pass
+
+    def release_lock(self):
+        pass
+
+    def load_model(self):
+        pass
+
+    def detect(self, image=None):
+        try:
+            if not self.conn:
+                self.conn = Client(self.address, family='AF_UNIX')
+            self.conn.send({'entry': self.options, 'image': image})
+            res = self.conn.recv()
+        except Exception as e:
+            g.logger.Error('batcher: could not reach frame batcher, detecting locally: {}'.format(e))
+            self.conn = None
+            return self.fallback.detect(image=image)
+        if res.get('error'):
+            g.logger.Error('batcher: batched detection failed, detecting locally: {}'.format(res['error']))
+            return self.fallback.detect(image=image)
+        g.logger.Debug(2,'batcher: got %s detections from frame batcher', len(res['labels']))
+        return res['boxes'], res['labels'], res['confidences']
+
+
+def use_batching(ml_options, models):
+    # swaps in batched yolo for object models the resident batcher can run
+    import pyzm.ml.object as ObjectDetect
+
+    address = batch_address()
+    if not os.path.exists(address):
+        return models
+    for ndx, entry in enumerate(ml_options.get('object', {}).get('sequence', [])):
+        if ndx < len(models.get('object', [])) and can_batch('object', entry):
+            m = ObjectDetect.Object(options=entry, logger=g.logger)
+            m.model = BatchedYolo(entry, address, m.model)
+            models['object'][ndx] = m
+    return models
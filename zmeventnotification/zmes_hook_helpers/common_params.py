@@ -5,6 +5,7 @@ ctx = None  # SSL context
 logger = None  # logging handler
 config = {}  # object that will hold config values
 polygons = []  # will contain mask(s) for a monitor
+polygons_size = None  # (width, height) of the image polygons are defined for, if known
 
 # valid config keys and defaults
 config_vals = {
@@ -65,6 +66,21 @@ config_vals = {
             'type': 'dict',
 
         },
+        'log_buffer': {
+            'section': 'general',
+            'default': 'yes',
+            'type': 'string',
+        },
+        'log_buffer_size': {
+            'section': 'general',
+            'default': '2000',
+            'type': 'int',
+        },
+        'log_flush_interval_ms': {
+            'section': 'general',
+            'default': '250',
+            'type': 'int',
+        },
         'portal':{
             'section': 'general',
             'default': '',
@@ -112,6 +128,26 @@ config_vals = {
             'default': '5%',
             'type': 'string'
         },
+        'past_det_history_events':{
+            'section': 'general',
+            'default': '1',
+            'type': 'int'
+        },
+        'past_det_max_age':{
+            'section': 'general',
+            'default': '0',
+            'type': 'int'
+        },
+        'zone_filter_mode':{
+            'section': 'general',
+            'default': 'shapely',
+            'type': 'string'
+        },
+        'zone_raster_cell':{
+            'section': 'general',
+            'default': '4',
+            'type': 'int'
+        },
         'max_detection_size':{
             'section': 'general',
             'default': '',
@@ -153,6 +189,21 @@ config_vals = {
             'default': 'yes',
             'type': 'string'
         },
+        'http_connect_timeout':{
+            'section': 'general',
+            'default': '10',
+            'type': 'int'
+        },
+        'http_read_timeout':{
+            'section': 'general',
+            'default': '120',
+            'type': 'int'
+        },
+        'http_pool_maxsize':{
+            'section': 'general',
+            'default': '4',
+            'type': 'int'
+        },
         'write_image_to_zm':{
             'section': 'general',
             'default': 'yes',
@@ -183,6 +234,11 @@ config_vals = {
             'default': 'no',
             'type': 'string',
         },
+        'zm_zones_cache_ttl':{
+            'section': 'general',
+            'default': '3600',
+            'type': 'int',
+        },
         'poly_color':{
             'section': 'general',
             'default': '(127,140,141)',
@@ -193,6 +249,26 @@ config_vals = {
             'default': '2',
             'type': 'int'
         },
+        'server_socket':{
+            'section': 'general',
+            'default': '/var/lib/zmeventnotification/zm_detect.sock',
+            'type': 'string'
+        },
+        'config_snapshot':{
+            'section': 'general',
+            'default': 'yes',
+            'type': 'string'
+        },
+        'trace_file':{
+            'section': 'general',
+            'default': '/var/lib/zmeventnotification/misc/traces.jsonl',
+            'type': 'string'
+        },
+        'trace_file_max_mb':{
+            'section': 'general',
+            'default': '20',
+            'type': 'int'
+        },
 
         # animation for push
 
@@ -226,6 +302,31 @@ config_vals = {
             'default': 'no',
             'type': 'string'
         },
+        'animation_fetch_workers':{
+            'section': 'animation',
+            'default': '4',
+            'type': 'int'
+        },
+        'animation_frame_retries':{
+            'section': 'animation',
+            'default': '1',
+            'type': 'int'
+        },
+        'animation_background':{
+            'section': 'animation',
+            'default': 'yes',
+            'type': 'string'
+        },
+        'animation_job_workers':{
+            'section': 'animation',
+            'default': '2',
+            'type': 'int'
+        },
+        'animation_job_max_attempts':{
+            'section': 'animation',
+            'default': '3',
+            'type': 'int'
+        },
 
         # remote ML
      
@@ -273,6 +374,21 @@ config_vals = {
             'default': None,
             'type': 'string'
         },
+        'model_pool_max_mb': {
+            'section': 'ml',
+            'default': '0',
+            'type': 'int'
+        },
+        'object_batch_window_ms': {
+            'section': 'ml',
+            'default': '0',
+            'type': 'int'
+        },
+        'object_batch_max_size': {
+            'section': 'ml',
+            'default': '8',
+            'type': 'int'
+        },
      
      
        
@@ -425,6 +541,22 @@ config_vals = {
             'type': 'string'
         },
 
+        'alpr_cache':{
+            'section': 'alpr',
+            'default': 'no',
+            'type': 'string'
+        },
+        'alpr_cache_ttl':{
+            'section': 'alpr',
+            'default': '3600',
+            'type': 'int'
+        },
+        'alpr_cache_hash_distance':{
+            'section': 'alpr',
+            'default': '6',
+            'type': 'int'
+        },
+
         # Plate recognition specific
         'platerec_stats':{
             'section': 'alpr',
@@ -0,0 +1,149 @@
+import zmes_hook_helpers.common_params as g
+
+# GIF writer for animations. It has the append_data/close interface of an
+# imageio writer and writes the file in one go when it is closed:
+#  - every frame goes into a 5 bit per channel color histogram, and one
+#    global palette of up to 255 colors is cut out of it (median cut)
+#  - frames are kept as histogram bins (uint16), not RGB, until then
+#  - after the first frame, pixels that did not change are written as the
+#    transparent color (index 255), so Pillow crops the frame to what changed
+#    and LZW compresses the unchanged runs to almost nothing. Frames that did
+#    not change at all are merged into the previous one
+# This replaces writing with imageio and re-writing with gifsicle.
+
+BITS = 5
+COLORS = 255
+TRANSPARENT = 255
+
+
+def _bins(frame):
+    # RGB frame -> 15 bit histogram bin per pixel
+    import numpy as np
+
+    frame = np.asarray(frame)
+    if frame.ndim == 2:
+        frame = np.stack([frame] * 3, axis=-1)
+    shift = 8 - BITS
+    rgb = frame[..., :3].astype(np.uint16) >> shift
+    return (rgb[..., 0] << (2 * BITS)) | (rgb[..., 1] << BITS) | rgb[..., 2], frame[..., :3]
+
+
+def median_cut(counts, sums, colors=COLORS):
+    # counts[bin] pixels and sums[bin] RGB sums per histogram bin.
+    # Returns (palette as colors x 3 uint8, lut mapping bin -> palette index)
+    import numpy as np
+
+    nbins = 1 << (3 * BITS)
+    used = np.nonzero(counts)[0]
+    mask = (1 << BITS) - 1
+    coords = np.stack([(used >> (2 * BITS)) & mask, (used >> BITS) & mask, used & mask], axis=1)
+    weights = counts[used]
+
+    boxes = [np.arange(len(used))]
+    box_weights = [int(weights.sum())]
+    while len(boxes) < colors:
+        # split the most populated box that still has more than one bin
+        best = None
+        for i, box in enumerate(boxes):
+            if len(box) > 1 and (best is None or box_weights[i] > box_weights[best]):
+                best = i
+        if best is None:
+            break
+        box = boxes.pop(best)
+        box_weights.pop(best)
+        c = coords[box]
+        axis = int(np.argmax(c.max(axis=0) - c.min(axis=0)))
+        order = box[np.argsort(c[:, axis], kind='stable')]
+        cum = np.cumsum(weights[order])
+        cut = int(np.searchsorted(cum, cum[-1] / 2.0)) + 1
+        cut = min(max(cut, 1), len(order) - 1)
+        boxes.extend([order[:cut], order[cut:]])
+        box_weights.extend([int(cum[cut - 1]), int(cum[-1] - cum[cut - 1])])
+
+    palette = np.zeros((len(boxes), 3), dtype=np.float64)
+    for i, box in enumerate(boxes):
+        palette[i] = sums[used[box]].sum(axis=0) / max(weights[box].sum(), 1)
+    palette = np.clip(np.rint(palette), 0, 255).astype(np.uint8)
+
+    # every bin, used or not, maps to its nearest palette color
+    centers = np.stack([(np.arange(nbins) >> (2 * BITS)) & mask,
+                        (np.arange(nbins) >> BITS) & mask,
+                        np.arange(nbins) & mask], axis=1).astype(np.float32)
+    centers = centers * (1 << (8 - BITS)) + (1 << (8 - BITS)) / 2.0
+    lut = np.empty(nbins, dtype=np.uint8)
+    pal = palette.astype(np.float32)
+    for start in range(0, nbins, 4096):
+        d = ((centers[start:start + 4096, None, :] - pal[None, :, :]) ** 2).sum(axis=2)
+        lut[start:start + 4096] = np.argmin(d, axis=1)
+    # bins that were seen map to the box they ended up in
+    for i, box in enumerate(boxes):
+        lut[used[box]] = i
+    return palette, lut
+
+
+class GifWriter:
+    def __init__(self, fname, fps):
+        import numpy as np
+
+        self.fname = fname
+        self.duration = int(round(1000.0 / fps))
+        self.frames = []
+        self.counts = np.zeros(1 << (3 * BITS), dtype=np.int64)
+        self.sums = np.zeros((1 << (3 * BITS), 3), dtype=np.float64)
+        self.colors = 0
+        self.closed = False
+
+    def append_data(self, frame):
+        import numpy as np
+
+        bins, rgb = _bins(frame)
+        flat = bins.ravel()
+        self.counts += np.bincount(flat, minlength=len(self.counts))
+        rgb = rgb.reshape(-1, 3)
+        for c in range(3):
+            self.sums[:, c] += np.bincount(flat, weights=rgb[:, c], minlength=len(self.counts))
+        self.frames.append(bins)
+
+    def _encode(self):
+        # returns [(P mode image, duration)] with delta frames
+        import numpy as np
+        from PIL import Image
+
+        palette, lut = median_cut(self.counts, self.sums)
+        self.colors = len(palette)
+        flat_palette = palette.ravel().tolist()
+        flat_palette += [0] * (768 - len(flat_palette))
+
+        out = []
+        previous = None
+        for bins in self.frames:
+            idx = lut[bins]
+            if previous is None:
+                frame = idx
+            else:
+                changed = idx != previous
+                if not changed.any():
+                    out[-1][1] += self.duration
+                    continue
+                frame = np.where(changed, idx, np.uint8(TRANSPARENT))
+            im = Image.frombytes('P', (frame.shape[1], frame.shape[0]), np.ascontiguousarray(frame).tobytes())
+            im.putpalette(flat_palette)
+            out.append([im, self.duration])
+            previous = idx
+        return out
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if not self.frames:
+            return
+        frames = self._encode()
+        self.frames = []
+        first = frames[0][0]
+        first.save(self.fname, format='GIF', save_all=True,
+                   append_images=[f[0] for f in frames[1:]],
+                   duration=[f[1] for f in frames], loop=0, disposal=1,
+                   transparency=TRANSPARENT, optimize=False)
+        g.logger.Debug(2,'gif: wrote %s frames with %s colors to %s',
+            len(frames), self.colors, self.fname)
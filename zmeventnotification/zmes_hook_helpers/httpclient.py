@@ -0,0 +1,165 @@
+import os
+import uuid
+import zmes_hook_helpers.common_params as g
+
+# One keep-alive HTTP client (requests.Session) per process for all ZM and
+# mlapi traffic, so that repeated requests to the same host reuse their
+# TCP/TLS connection. It uses g.ctx for https, the basic auth settings for
+# the ZM portal, http_connect_timeout/http_read_timeout as default timeouts
+# and keeps at most http_pool_maxsize connections per host.
+
+_session = None
+_pid = None
+_closed = {'opened': 0, 'requests': 0}  # counts of pools that were discarded
+
+
+def _make_adapter():
+    from requests.adapters import HTTPAdapter
+
+    class PooledAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            if g.ctx:
+                kwargs['ssl_context'] = g.ctx
+            super().init_poolmanager(*args, **kwargs)
+            self.poolmanager.pools.dispose_func = _dispose_pool
+
+        def send(self, request, **kwargs):
+            if kwargs.get('timeout') is None:
+                kwargs['timeout'] = (g.config['http_connect_timeout'], g.config['http_read_timeout'])
+            return super().send(request, **kwargs)
+
+    return PooledAdapter(pool_connections=10, pool_maxsize=g.config['http_pool_maxsize'])
+
+
+def _dispose_pool(pool):
+    _closed['opened'] += pool.num_connections
+    _closed['requests'] += pool.num_requests
+    pool.close()
+
+
+def _portal_auth(r):
+    # basic auth is only for the ZM portal, not for mlapi
+    if g.config.get('basic_user') and r.url.startswith(g.config['portal']):
+        from requests.auth import HTTPBasicAuth
+        return HTTPBasicAuth(g.config['basic_user'], g.config['basic_password'])(r)
+    return r
+
+
+def _drop_inherited():
+    global _session
+    # connections must not be shared with a parent/child after a fork
+    if _session is not None and _pid != os.getpid():
+        _session.close()
+        _session = None
+        _closed.update(opened=0, requests=0)
+
+
+def get_session():
+    global _session, _pid
+    _drop_inherited()
+    if _session is None:
+        import requests
+        _session = requests.Session()
+        adapter = _make_adapter()
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+        _session.auth = _portal_auth
+        if g.config.get('allow_self_signed') == 'yes':
+            from urllib3.exceptions import InsecureRequestWarning
+            _session.verify = False
+            requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
+        _pid = os.getpid()
+    return _session
+
+
+def use_for(api):
+    # makes a pyzm ZMApi send its requests through the shared session.
+    # pyzm logs in with its own session, so its cookies are carried over
+    s = get_session()
+    if api.session is not s:
+        s.cookies.update(api.session.cookies)
+        api.session.close()
+        api.session = s
+    return api
+
+
+def stats():
+    # connections opened and requests sent by this process so far
+    _drop_inherited()
+    opened = _closed['opened']
+    requests = _closed['requests']
+    if _session is not None and _pid == os.getpid():
+        adapter = _session.get_adapter('http://')
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool:
+                opened += pool.num_connections
+                requests += pool.num_requests
+    return {'opened': opened, 'reused': max(requests - opened, 0), 'requests': requests}
+
+
+def stats_since(start):
+    now = stats()
+    return {k: now[k] - start[k] for k in now}
+
+
+class MultipartFile:
+    # multipart/form-data request body with one file, for data=. requests
+    # and urllib3 read it block by block as they send it, so the file is
+    # never copied into the body as it is with files=. source is a path
+    # (read from disk) or a buffer such as a cv2.imencode result (read
+    # through a memoryview). Send it with content_type as the Content-Type
+    # header and close() it afterwards
+    def __init__(self, field, filename, source, file_type='image/jpeg'):
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={}'.format(boundary)
+        head = '--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\nContent-Type: {}\r\n\r\n'.format(
+            boundary, field, filename, file_type).encode()
+        tail = '\r\n--{}--\r\n'.format(boundary).encode()
+        if isinstance(source, str):
+            body = open(source, 'rb')
+            size = os.fstat(body.fileno()).st_size
+        else:
+            body = memoryview(source).cast('B')
+            size = len(body)
+        self._parts = [memoryview(head), body, memoryview(tail)]
+        self._len = len(head) + size + len(tail)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(64 * 1024)
+            if not chunk:
+                return
+            yield chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._len
+        chunks = []
+        while size > 0 and self._parts:
+            part = self._parts[0]
+            if isinstance(part, memoryview):
+                chunk = part[:size]
+                if len(chunk) < len(part):
+                    self._parts[0] = part[len(chunk):]
+                else:
+                    self._parts.pop(0)
+            else:
+                chunk = part.read(size)
+                if not chunk:
+                    part.close()
+                    self._parts.pop(0)
+                    continue
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        for part in self._parts:
+            if not isinstance(part, memoryview):
+                part.close()
+        self._parts = []
@@ -1,20 +1,67 @@
-from configparser import ConfigParser
 import zmes_hook_helpers.common_params as g
-from shapely.geometry import Polygon
-import cv2
-import numpy as np
-import pickle
 import re
-import requests
 import time
 import os
 import traceback
 import urllib.parse
 # Generic image related algorithms
+# shapely, cv2, numpy etc. are imported by the functions that need them
+# so that importing this module stays cheap
+
+
+def _fetch_frame(session, url, retries):
+    import imageio
+
+    for attempt in range(retries + 1):
+        try:
+            resp = session.get(url)
+            resp.raise_for_status()
+            return imageio.imread(resp.content)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            g.logger.Debug (2,'animation: retrying frame after error:%s', e)
+
+
+def iter_frames(urls, workers=4, retries=1):
+    # downloads and decodes frames with a pool of workers and yields them in
+    # the order of urls, with the exception in place of a frame that failed.
+    # At most 2*workers frames are downloaded ahead of the consumer
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    from zmes_hook_helpers.httpclient import get_session
+
+    session = get_session()
+
+    def _get(url):
+        try:
+            return _fetch_frame(session, url, retries)
+        except Exception as e:
+            return e
+
+    workers = max(1, workers)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for url in urls:
+            pending.append(executor.submit(_get, url))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def fetch_frames(urls, workers=4, retries=1):
+    return list(iter_frames(urls, workers=workers, retries=retries))
 
 
 def createAnimation(frametype, eid, fname, types):
+    # returns True if the animation(s) were written
     import imageio
+    import requests
+    from zmes_hook_helpers.httpclient import get_session
+    from zmes_hook_helpers.gif import GifWriter
+
+    session = get_session()
 
     url = '{}/index.php?view=image&width={}&eid={}&username={}&password={}'.format(g.config['portal'],g.config['animation_width'],eid,g.config['user'],urllib.parse.quote(g.config['password'], safe=''))
     api_url = '{}/events/{}.json?username={}&password={}'.format(g.config['api_portal'],eid,g.config['user'],urllib.parse.quote(g.config['password'], safe=''))
@@ -34,14 +81,16 @@ def createAnimation(frametype, eid, fname, types):
         fast_gif = True
 
     while True and rtries:
-        g.logger.Debug (1,f"animation: Try:{g.config['animation_max_tries']-rtries+1} Getting {disp_api_url}")
+        g.logger.Debug (1,'animation: Try:%s Getting %s', g.config['animation_max_tries']-rtries+1, disp_api_url)
         r = None
         try:
-            resp = requests.get(api_url)
+            resp = session.get(api_url)
             resp.raise_for_status()
             r = resp.json()
         except requests.exceptions.RequestException as e:
             g.logger.Error(f'{e}')
+            rtries = rtries - 1
+            time.sleep(sleep_secs)
             continue
 
         r_event = r['event']['Event']
@@ -57,7 +106,7 @@ def createAnimation(frametype, eid, fname, types):
 
         #g.logger.Debug (1,f'animation: Response {r}')
         if r_frame is None or not r_frame_len:
-            g.logger.Debug (1,f'No frames found yet via API, deferring check for {sleep_secs} seconds...')
+            g.logger.Debug (1,'No frames found yet via API, deferring check for %s seconds...', sleep_secs)
             rtries = rtries - 1
             time.sleep(sleep_secs)
             continue
@@ -67,131 +116,136 @@ def createAnimation(frametype, eid, fname, types):
         fps=round(totframes/total_time)
 
         if not r_frame_len >= fid+fps*buffer_seconds:
-            g.logger.Debug (1,f'I\'ve got {r_frame_len} frames, but that\'s not enough as anchor frame is type:{frametype}:{fid}, deferring check for {sleep_secs} seconds...')
+            g.logger.Debug (1,'I\'ve got %s frames, but that\'s not enough as anchor frame is type:%s:%s, deferring check for %s seconds...', r_frame_len, frametype, fid, sleep_secs)
             rtries = rtries - 1
             time.sleep(sleep_secs)
             continue
 
-        g.logger.Debug (1,'animation: Got {} frames'.format(r_frame_len))
+        g.logger.Debug (1,'animation: Got %s frames', r_frame_len)
         break
         # fid is the anchor frame
     if not rtries:
         g.logger.Error ('animation: Bailing, failed too many times')
-        return
+        return False
   
 
   
-    g.logger.Debug (1,'animation: event fps={}'.format(fps))
+    g.logger.Debug (1,'animation: event fps=%s', fps)
     start_frame = int(max(fid - (buffer_seconds*fps),1))
     end_frame = int(min(totframes, fid + (buffer_seconds*fps)))
     skip = round(fps/target_fps)
 
-    g.logger.Debug (1,f'animation: anchor={frametype} start={start_frame} end={end_frame} skip={skip}')
+    g.logger.Debug (1,'animation: anchor=%s start=%s end=%s skip=%s', frametype, start_frame, end_frame, skip)
     g.logger.Debug(1,'animation: Grabbing frames...')
-    images = []
-    od_images = []
 
     # use frametype  (alarm/snapshot) to get od anchor, because fid can be wrong when translating from videos
     od_url= '{}/index.php?view=image&eid={}&fid={}&username={}&password={}&width={}'.format(g.config['portal'],eid,frametype,g.config['user'],urllib.parse.quote(g.config['password'], safe=''),g.config['animation_width'])
-    g.logger.Debug (1,f'Grabbing anchor frame: {frametype}...')
-    try:
-        od_frame = imageio.imread(od_url)
-        # 1 second @ 2fps
-        od_images.append(od_frame)
-        od_images.append(od_frame)
-    except Exception as e:
-        g.logger.Error (f'Error downloading anchor  frame: Error:{e}')
-
-    for i in range(start_frame, end_frame+1, skip):
-        p_url=url+'&fid={}'.format(i)
-        g.logger.Debug (2,f'animation: Grabbing Frame:{i}')
-        try:
-            images.append(imageio.imread(p_url))
-        except Exception as e:
-            g.logger.Error (f'Error downloading frame {i}: Error:{e}')
+    frame_ids = list(range(start_frame, end_frame+1, skip))
+    urls = [od_url] + [url+'&fid={}'.format(i) for i in frame_ids]
+
+    types = types.lower()
+    gif_fps = target_fps
+    gif_range = None
+    if 'gif' in types:
+        # GIF uses a +- 2 second buffer
+        gif_buffer_seconds=2
+        if fast_gif:
+            gif_buffer_seconds = gif_buffer_seconds * 1.5
+            gif_fps = target_fps * 2
+        gif_start_frame = int(max(fid - (gif_buffer_seconds*fps),1))
+        gif_end_frame = int(min(totframes, fid + (gif_buffer_seconds*fps)))
+        s1 = round((gif_start_frame - start_frame)/skip)
+        s2 = round((end_frame - gif_end_frame)/skip)
+        if s1 >=0 and s2 >=0:
+            gif_range = (s1, len(frame_ids) - s2)
+            g.logger.Debug (1,'For GIF, using frames %s to -%s from a total of %s', s1, s2, len(frame_ids))
+        else:
+            g.logger.Debug (1,'Bailing in GIF creation, range is weird start:%s:end offset %s', s1, -s2)
 
-    g.logger.Debug (1,f'animation: Saving {fname}...')
+    # Frames are handed to the MP4 and GIF writers as they are downloaded,
+    # in one pass, so only the download window is held in memory
+    writers = {}
+    counts = {'frames': 0, 'mp4': 0, 'gif': 0}
+    g.logger.Debug (1,'animation: Saving %s...', fname)
     try:
-        if 'mp4' in types.lower():
+        if 'mp4' in types:
             g.logger.Debug (1,'Creating MP4...')
-            mp4_final = od_images.copy()
-            mp4_final.extend(images)
-            imageio.mimwrite(fname+'.mp4', mp4_final, format='mp4', fps=target_fps)
-            size = os.stat(fname+'.mp4').st_size
-            g.logger.Debug (1,f'animation: saved to {fname}.mp4, size {size} bytes, frames: {len(images)}')
-
-        if 'gif' in types.lower():
-            from pygifsicle import optimize
+            writers['mp4'] = imageio.get_writer(fname+'.mp4', format='mp4', fps=target_fps)
+        if gif_range:
             g.logger.Debug (1,'Creating GIF...')
+            writers['gif'] = GifWriter(fname+'.gif', gif_fps)
+
+        g.logger.Debug (1,'Grabbing anchor frame: %s...', frametype)
+        frames = iter_frames(urls, workers=g.config['animation_fetch_workers'],
+                             retries=g.config['animation_frame_retries'])
+        for pos, frame in enumerate(frames):
+            if pos == 0:
+                if isinstance(frame, Exception):
+                    g.logger.Error (f'Error downloading anchor  frame: Error:{frame}')
+                elif 'mp4' in writers:
+                    # 1 second @ 2fps
+                    writers['mp4'].append_data(frame)
+                    writers['mp4'].append_data(frame)
+                continue
+
+            pos = pos - 1
+            if isinstance(frame, Exception):
+                g.logger.Error (f'Error downloading frame {frame_ids[pos]}: Error:{frame}')
+                continue
+            counts['frames'] += 1
+            if 'mp4' in writers:
+                writers['mp4'].append_data(frame)
+                counts['mp4'] += 1
+            if 'gif' in writers and gif_range[0] <= pos < gif_range[1] and \
+                    (not fast_gif or (pos - gif_range[0]) % 2 == 0):
+                writers['gif'].append_data(frame)
+                counts['gif'] += 1
+
+        for t in list(writers):
+            writers.pop(t).close()
+    except Exception as e:
+        g.logger.Error('animation: Traceback:{}'.format(traceback.format_exc()))
+        return False
+    finally:
+        for w in writers.values():
+            w.close()
 
-            # Let's slice the right amount from images
-            # GIF uses a +- 2 second buffer
-            gif_buffer_seconds=2
-            if fast_gif:
-                gif_buffer_seconds = gif_buffer_seconds * 1.5
-                target_fps = target_fps * 2
-            gif_start_frame = int(max(fid - (gif_buffer_seconds*fps),1))
-            gif_end_frame = int(min(totframes, fid + (gif_buffer_seconds*fps)))
-            s1 = round((gif_start_frame - start_frame)/skip)
-            s2 = round((end_frame - gif_end_frame)/skip)
-            if s1 >=0 and s2 >=0:
-                gif_images = None
-                if fast_gif and 'gif' in types.lower():
-                    gif_images = images[0+s1:-s2:2]
-                else:
-                    gif_images = images[0+s1:-s2]
-                g.logger.Debug (1,f'For GIF, slicing {s1} to -{s2} from a total of {len(images)}')
-                g.logger.Debug (1,'animation:Saving...')
-                gif_final = gif_images.copy()
-                imageio.mimwrite(fname+'.gif', gif_final, format='gif', fps=target_fps)
-                g.logger.Debug (1,'animation:Optimizing...')
-                optimize(source=fname+'.gif', colors=256)
-                size = os.stat(fname+'.gif').st_size
-                g.logger.Debug (1,f'animation: saved to {fname}.gif, size {size} bytes, frames:{len(gif_images)}')
-            else:
-                g.logger.Debug (1,f'Bailing in GIF creation, range is weird start:{s1}:end offset {-s2}')
+    g.logger.Debug (1,'animation: Got %s of %s frames', counts['frames'], len(frame_ids))
+    if not counts['frames']:
+        g.logger.Error ('animation: no frames could be downloaded')
+        return False
 
-        
-        
+    try:
+        if 'mp4' in types:
+            size = os.stat(fname+'.mp4').st_size
+            g.logger.Debug (1,'animation: saved to %s.mp4, size %s bytes, frames: %s', fname, size, counts['mp4'])
+        if gif_range:
+            size = os.stat(fname+'.gif').st_size
+            g.logger.Debug (1,'animation: saved to %s.gif, size %s bytes, frames:%s', fname, size, counts['gif'])
     except Exception as e:
         g.logger.Error('animation: Traceback:{}'.format(traceback.format_exc()))
+        return False
+    return True
 
 # once all bounding boxes are detected, we check to see if any of them
 # intersect the polygons, if specified
 # it also makes sure only patterns specified in detect_pattern are drawn
 def processPastDetection(bbox, label, conf, mid):
-
-    try:
-        FileNotFoundError
-    except NameError:
-        FileNotFoundError = IOError
+    import zmes_hook_helpers.past_detections as past_detections
 
     if not mid:
         g.logger.Debug(1,
             'Monitor ID not specified, cannot match past detections')
         return bbox, label, conf
-    mon_file = g.config['image_path'] + '/monitor-' + mid + '-data.pkl'
-    g.logger.Debug(2,'trying to load ' + mon_file)
     try:
-        fh = open(mon_file, "rb")
-        saved_bs = pickle.load(fh)
-        saved_ls = pickle.load(fh)
-        saved_cs = pickle.load(fh)
-    except FileNotFoundError:
-        g.logger.Debug(1,'No history data file found for monitor {}'.format(mid))
-        return bbox, label, conf
-    except EOFError:
-        g.logger.Debug(1,'Empty file found for monitor {}'.format(mid))
-        g.logger.Debug (1,'Going to remove {}'.format(mon_file))
-        try:
-            os.remove(mon_file)
-        except Exception as e:
-            g.logger.Error (f'Could not delete: {e}')
-            pass
+        saved_bs, saved_ls, saved_cs = past_detections.load(mid)
     except Exception as e:
         g.logger.Error(f'Error in processPastDetection: {e}')
         #g.logger.Error('Traceback:{}'.format(traceback.format_exc()))
         return bbox, label, conf
+    if not saved_bs:
+        g.logger.Debug(1,'No past detections found for monitor %s', mid)
+        return bbox, label, conf
 
     # load past detection
 
@@ -214,127 +268,138 @@ def processPastDetection(bbox, label, conf, mid):
         return bbox, label, conf
 
     #g.logger.Debug (1,'loaded past: bbox={}, labels={}'.format(saved_bs, saved_ls));
-    g.logger.Debug (4, 'process_past_detections: use_percent:{}, max_diff_area:{}'.format(use_percent,max_diff_area))
-    new_label = []
-    new_bbox = []
-    new_conf = []
+    g.logger.Debug (4, 'process_past_detections: use_percent:%s, max_diff_area:%s', use_percent, max_diff_area)
+    return filter_past_detections(bbox, label, conf, saved_bs, saved_ls, max_diff_area, use_percent)
 
-    for idx, b in enumerate(bbox):
-        # iterate list of detections
-        old_b = b
-        it = iter(b)
-        b = list(zip(it, it))
-
-        b.insert(1, (b[1][0], b[0][1]))
-        b.insert(3, (b[0][0], b[2][1]))
-        #g.logger.Debug (1,"Past detection: {}@{}".format(saved_ls[idx],b))
-        #g.logger.Debug (1,'BOBK={}'.format(b))
-        obj = Polygon(b)
-        foundMatch = False
-        for saved_idx, saved_b in enumerate(saved_bs):
-            # compare current detection element with saved list from file
-            if saved_ls[saved_idx] != label[idx]: continue
-            it = iter(saved_b)
-            saved_b = list(zip(it, it))
-            saved_b.insert(1, (saved_b[1][0], saved_b[0][1]))
-            saved_b.insert(3, (saved_b[0][0], saved_b[2][1]))
-            saved_obj = Polygon(saved_b)
-            max_diff_pixels = max_diff_area
 
-            if saved_obj.intersects(obj):
-                if obj.contains(saved_obj):
-                    diff_area = obj.difference(saved_obj).area
-                    if use_percent:
-                        max_diff_pixels = obj.area * max_diff_area / 100
-                else:
-                    diff_area = saved_obj.difference(obj).area
-                    if use_percent:
-                        max_diff_pixels = saved_obj.area * max_diff_area / 100
-
-                if diff_area <= max_diff_pixels:
-                    g.logger.Debug(1,
-                        'past detection {}@{} approximately matches {}@{} removing'
-                        .format(saved_ls[saved_idx], saved_b, label[idx], b))
-                    foundMatch = True
-                    break
-                else:
-                    g.logger.Debug(4,'Diff area of:{} > max_diff_pixels:{} for {}@{}, allowing it'
-                    .format(diff_area, max_diff_pixels,label[idx], b))
-        if not foundMatch:
-            new_bbox.append(old_b)
-            new_label.append(label[idx])
-            new_conf.append(conf[idx])
+def filter_past_detections(bbox, label, conf, saved_bs, saved_ls, max_diff_area, use_percent):
+    # drops detections that match a saved detection of the same label.
+    # Boxes are axis aligned [x1,y1,x2,y2], so instead of shapely polygons,
+    # all (current, saved) pairs of a label are compared in one go:
+    #  - they match if they intersect (touching counts) and the area of the
+    #    larger one outside the other is <= max_diff_area (px, or % of the
+    #    area of the larger one). "Larger" is the current box if it contains
+    #    the saved one, else the saved box
+    import numpy as np
+
+    if not bbox or not saved_bs:
+        return bbox, label, conf
+
+    def _boxes(b):
+        b = np.asarray(b, dtype=np.float64).reshape(-1, 4)
+        return np.stack([np.minimum(b[:, 0], b[:, 2]), np.minimum(b[:, 1], b[:, 3]),
+                         np.maximum(b[:, 0], b[:, 2]), np.maximum(b[:, 1], b[:, 3])], axis=1)
+
+    cur = _boxes(bbox)
+    saved = _boxes(saved_bs)
+    cur_labels = np.asarray(label, dtype=object)
+    saved_labels = np.asarray(saved_ls, dtype=object)
+    removed = np.zeros(len(cur), dtype=bool)
+
+    for l in set(label) & set(saved_ls):
+        ci = np.nonzero(cur_labels == l)[0]
+        si = np.nonzero(saved_labels == l)[0]
+        c = cur[ci][:, None, :]
+        s = saved[si][None, :, :]
+        iw = np.minimum(c[..., 2], s[..., 2]) - np.maximum(c[..., 0], s[..., 0])
+        ih = np.minimum(c[..., 3], s[..., 3]) - np.maximum(c[..., 1], s[..., 1])
+        intersects = (iw >= 0) & (ih >= 0)
+        inter_area = np.clip(iw, 0, None) * np.clip(ih, 0, None)
+        c_area = (c[..., 2] - c[..., 0]) * (c[..., 3] - c[..., 1])
+        s_area = (s[..., 2] - s[..., 0]) * (s[..., 3] - s[..., 1])
+        contains = (c[..., 0] <= s[..., 0]) & (c[..., 1] <= s[..., 1]) & \
+                   (c[..., 2] >= s[..., 2]) & (c[..., 3] >= s[..., 3])
+        outer_area = np.where(contains, c_area, s_area)
+        diff_area = outer_area - inter_area
+        if use_percent:
+            max_diff_pixels = outer_area * max_diff_area / 100
+        else:
+            max_diff_pixels = max_diff_area
+        match = intersects & (diff_area <= max_diff_pixels)
 
+        for row in np.nonzero(match.any(axis=1))[0]:
+            # first saved box that matches, like a scan of the saved list would find
+            saved_idx = si[int(np.argmax(match[row]))]
+            idx = ci[row]
+            removed[idx] = True
+            g.logger.Debug(1,
+                'past detection %s@%s approximately matches %s@%s removing',
+                saved_ls[saved_idx], saved_bs[saved_idx], label[idx], bbox[idx])
+        if g.logger.enabled(4):
+            g.logger.Debug(4,'past detection: %s %s compared with %s saved, %s allowed',
+                len(ci), l, len(si), int((~match.any(axis=1)).sum()))
+
+    new_bbox = [b for b, r in zip(bbox, removed) if not r]
+    new_label = [l for l, r in zip(label, removed) if not r]
+    new_conf = [c for c, r in zip(conf, removed) if not r]
     return new_bbox, new_label, new_conf
 
 
-def processFilters(bbox, label, conf, match, model):
+def processFilters(bbox, label, conf, match, model, mid=None, size=None):
+    from zmes_hook_helpers.zone_index import get_index, scaled_polygons
     # bbox is the set of bounding boxes
     # labels are set of corresponding object names
     # conf are set of confidence scores (for face this is set to 1)
     # match contains the list of labels that will be allowed based on detect_pattern
+    # mid is the monitor, its zone index is reused across events
+    # size is the (width, height) of the image the boxes are in
     #g.logger.Debug (1,"PROCESS INTERSECTION {} AND {}".format(bbox,label))
     new_label = []
     new_bbox = []
     new_conf = []
 
-      
+    # zones each box intersects, for all boxes at once
+    polygons = scaled_polygons(g.polygons, size, g.polygons_size, mid)
+    index = get_index(polygons, mid, g.config['zone_filter_mode'])
+    zones = index.intersecting(bbox)
+    # zone whose own pattern replaced match
+    pattern_zone = None
 
     for idx, b in enumerate(bbox):
 
         doesIntersect = False
-        # cv2 rectangle only needs top left and bottom right
-        # but to check for polygon intersection, we need all 4 corners
-        # b has [a,b,c,d] -> convert to [a,b, c,b, c,d, a,d]
-        # https://stackoverflow.com/a/23286299/1361529
-        old_b = b
-        it = iter(b)
-        b = list(zip(it, it))
-        #g.logger.Debug (1,"BB={}".format(b))
-        #g.logger.Debug (1,"BEFORE INSERT: {}".format(b))
-        b.insert(1, (b[1][0], b[0][1]))
-        b.insert(3, (b[0][0], b[2][1]))
-        g.logger.Debug(2,"intersection: polygon in process={}".format(b))
-        obj = Polygon(b)
-
-       
-
-        for p in g.polygons:
-            poly = Polygon(p['value'])
-            if obj.intersects(poly):
-                if model == 'object' and p['pattern'] and p['pattern'] != g.config['object_detection_pattern']:
-                    g.logger.Debug(2, '{} polygon/zone has its own pattern of {}, using that'.format(p['name'],p['pattern']))
-                    r = re.compile(p['pattern'])
-                    match = list(filter(r.match, label))
-                if label[idx] in match:
-                    g.logger.Debug(2,'{} intersects object:{}[{}]'.format(
-                        p['name'], label[idx], b))
-                    new_label.append(label[idx])
-                    new_bbox.append(old_b)
-                    new_conf.append(conf[idx])
-                else:
-                    g.logger.Info(
-                        'discarding "{}" as it does not match your filters'.
-                        format(label[idx]))
-                    g.logger.Debug(1,
-                        '{} intersects object:{}[{}] but does NOT match your detect pattern filter'
-                        .format(p['name'], label[idx], b))
-                doesIntersect = True
-                break
+        g.logger.Debug(2,"intersection: polygon in process=%s", b)
+
+        # zones are in g.polygons order, the first one decides
+        for z in zones[idx][:1]:
+            p = polygons[z]
+            if model == 'object' and p['pattern'] and p['pattern'] != g.config['object_detection_pattern']:
+                g.logger.Debug(2, '%s polygon/zone has its own pattern of %s, using that', p['name'], p['pattern'])
+                pattern_zone = z
+            if pattern_zone is not None:
+                allowed = index.pattern_allows(label[idx])[pattern_zone]
+            else:
+                allowed = label[idx] in match
+            if allowed:
+                g.logger.Debug(2,'%s intersects object:%s[%s]', p['name'], label[idx], b)
+                new_label.append(label[idx])
+                new_bbox.append(b)
+                new_conf.append(conf[idx])
+            else:
+                g.logger.Info(
+                    'discarding "{}" as it does not match your filters'.
+                    format(label[idx]))
+                g.logger.Debug(1,
+                    '%s intersects object:%s[%s] but does NOT match your detect pattern filter',
+                    p['name'], label[idx], b)
+            doesIntersect = True
         # out of poly loop
         if not doesIntersect:
             g.logger.Info(
                 'object:{} at {} does not fall into any polygons, removing...'.
-                format(label[idx], obj))
+                format(label[idx], b))
     #out of object loop
     return new_bbox, new_label, new_conf
 
 
-def getValidPlateDetections(bbox, label, conf):
+def getValidPlateDetections(bbox, label, conf, mid=None, size=None):
+    from shapely.geometry import box
+    from zmes_hook_helpers.zone_index import get_index, scaled_polygons
     # FIXME: merge this into the function above and do it correctly
     # bbox is the set of bounding boxes
     # labels are set of corresponding object names
     # conf are set of confidence scores
+    # size is the (width, height) of the image the boxes are in
 
     if not len(label):
         return bbox, label, conf
@@ -352,60 +417,55 @@ def getValidPlateDetections(bbox, label, conf):
 
     match = list(filter(r.match, label))
 
+    polygons = scaled_polygons(g.polygons, size, g.polygons_size, mid)
+    index = get_index(polygons, mid)
+    zones = index.intersecting(bbox)
+
     for idx, b in enumerate(bbox):
         if not label[idx] in match:
             g.logger.Debug(1,
-                'discarding plate:{} as it does not match alpr filter pattern:{}'
-                .format(label[idx], g.config['alpr_detection_pattern']))
+                'discarding plate:%s as it does not match alpr filter pattern:%s',
+                label[idx], g.config['alpr_detection_pattern'])
             continue
 
-        old_b = b
-        it = iter(b)
-        b = list(zip(it, it))
-        #g.logger.Debug (1,"BB={}".format(b))
-        b.insert(1, (b[1][0], b[0][1]))
-        b.insert(3, (b[0][0], b[2][1]))
-        #g.logger.Debug (1,"valid plate: polygon in process={}".format(b))
-        obj = Polygon(b)
+        obj = box(min(b[0], b[2]), min(b[1], b[3]), max(b[0], b[2]), max(b[1], b[3]))
         doesIntersect = False
-        for p in g.polygons:
-            # g.logger.Debug (1,"valid plate: mask in process={}".format(p['value']))
-            poly = Polygon(p['value'])
+        for z in zones[idx]:
+            p = polygons[z]
+            poly = index.zones[z]
             # Lets make sure the license plate doesn't cover the full polygon area
             # if it did, its very likey a bogus reading
-
-            if obj.intersects(poly):
-                res = 'Plate:{} at {} intersects polygon:{} at {} '.format(
-                    label[idx], obj, p['name'], poly)
-                if not obj.contains(poly):
-                    res = res + 'but does not contain polgyon, assuming it to be VALID'
-                    new_label.append(label[idx])
-                    new_bbox.append(old_b)
-                    new_conf.append(conf[idx])
-                    doesIntersect = True
-                else:
-                    res = res + 'but also contains polygon, assuming it to be INVALID'
-                    g.logger.Debug(2,res)
-                if doesIntersect: break
+            res = 'Plate:{} at {} intersects polygon:{} at {} '.format(
+                label[idx], obj, p['name'], poly)
+            if not obj.contains(poly):
+                res = res + 'but does not contain polgyon, assuming it to be VALID'
+                new_label.append(label[idx])
+                new_bbox.append(b)
+                new_conf.append(conf[idx])
+                doesIntersect = True
+                break
+            else:
+                res = res + 'but also contains polygon, assuming it to be INVALID'
+                g.logger.Debug(2,res)
         # out of poly loop
         if not doesIntersect:
             g.logger.Debug(1,
-                'plate:{} at {} does not fall into any polygons, removing...'.
-                format(label[idx], obj))
+                'plate:%s at %s does not fall into any polygons, removing...',
+                label[idx], obj)
     #out of object loop
     return new_bbox, new_label, new_conf
 
 
-# draws bounding boxes of identified objects and polygons
-
-
 def draw_bbox(img,
               bbox,
               labels,
               classes,
               confidence,
               color=None,
-              write_conf=True):
+              write_conf=True,
+              mid=None):
+    import cv2
+    from zmes_hook_helpers.zone_index import scaled_polygons
 
     # g.logger.Debug (1,"DRAW BBOX={} LAB={}".format(bbox,labels))
     slate_colors = [(39, 174, 96), (142, 68, 173), (0, 129, 254),
@@ -420,8 +480,8 @@ def draw_bbox(img,
     newh, neww = img.shape[:2]
 
     if g.config['poly_thickness']:
-        for ps in g.polygons:
-            cv2.polylines(img, [np.asarray(ps['value'])],
+        for ps in scaled_polygons(g.polygons, (neww, newh), g.polygons_size, mid):
+            cv2.polylines(img, [ps['value'].astype('int32')],
                         True,
                         polycolor,
                         thickness=g.config['poly_thickness'])
@@ -1,49 +1,218 @@
-import logging
-import logging.handlers
+import os
+import sys
+import atexit
+import threading
+from collections import namedtuple, deque
 import zmes_hook_helpers.common_params as g
-import pyzm.ZMLog as zmlog
-from inspect import getframeinfo, stack
+
+# Wrapper around pyzm.ZMLog that is cheap to call:
+#  - ZMLog finds the caller with inspect.stack(), which builds every frame
+#    of the stack and reads source lines for each of them, twice per call.
+#    Here the caller comes from sys._getframe, which just follows frame
+#    pointers, and is handed to ZMLog so it does not look itself
+#  - Debug checks the level before anything else, and messages may take
+#    %-style arguments, so a message that is not logged is never built:
+#        g.logger.Debug(2, 'ml options: %s', ml_options)
+#    For arguments that are costly to compute, check enabled(level) first
+#  - with start_buffer(), records are queued in memory and a background
+#    thread hands them to ZMLog in batches, every flush interval or when the
+#    queue is half full, so file/syslog/DB writes are off the event's path.
+#    The queue is flushed by close(), Fatal/Panic and at interpreter exit,
+#    including after an uncaught exception. When the queue is full, Debug
+#    records are dropped (and counted in dropped); other records flush the
+#    queue and are written right away
+#  - with trace_id set, messages start with [trace_id], see trace.py
+# Everything else (inited, config...) is ZMLog's own.
+
+# what ZMLog uses of inspect.getframeinfo()
+Caller = namedtuple('Caller', ['filename', 'lineno'])
+
+
+def find_caller(depth=1):
+    # frame info of the function depth levels above the one calling this
+    f = sys._getframe(depth + 1)
+    return Caller(f.f_code.co_filename, f.f_lineno)
+
+
+def _message(message, args):
+    if not args:
+        return message
+    # like logging: a single dict is for %(name)s fields
+    if len(args) == 1 and isinstance(args[0], dict) and args[0]:
+        args = args[0]
+    try:
+        return message % args
+    except (TypeError, ValueError) as e:
+        return '{} {} (bad log arguments: {})'.format(message, args, e)
+
+
+class ZMLogger:
+    def __init__(self, zmlog):
+        self.zmlog = zmlog
+        self.trace_id = None  # if set, every message starts with [trace_id]
+        self.dropped = 0
+        self.buffer_size = 0
+        self._records = None  # queued (ZMLog function, args), None if unbuffered
+        self._pid = None
+
+    def __getattr__(self, name):
+        return getattr(self.zmlog, name)
+
+    def start_buffer(self, size=2000, interval_ms=250):
+        # console output stays in order with what the hook prints itself
+        if self.zmlog.config.get('dump_console') or size <= 0:
+            return
+        self.buffer_size = size
+        self.interval = interval_ms / 1000.0
+        self._reset()
+        atexit.register(self.flush)
+
+    def _reset(self):
+        # a forked child starts with an empty queue and no writer thread,
+        # what the parent queued is the parent's to write
+        self._records = deque()
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._pid = os.getpid()
+
+    def _run(self):
+        while self._records is not None and self._pid == os.getpid():
+            with self._cond:
+                if len(self._records) < self.buffer_size // 2:
+                    self._cond.wait(self.interval)
+            self.flush()
+
+    def _put(self, name, args):
+        if self._records is None:
+            return getattr(self.zmlog, name)(*args)
+        if self._pid != os.getpid():
+            self._reset()
+        with self._cond:
+            if len(self._records) < self.buffer_size:
+                self._records.append((name, args))
+                if len(self._records) >= self.buffer_size // 2:
+                    self._cond.notify()
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='zmlog-writer', daemon=True)
+                    self._thread.start()
+                return
+            if name == 'Debug':
+                self.dropped += 1
+                return
+        with self._write_lock:
+            self._drain()
+            getattr(self.zmlog, name)(*args)
+
+    def _drain(self):
+        # with _write_lock held
+        with self._cond:
+            records = self._records
+            self._records = deque()
+        for name, args in records:
+            try:
+                getattr(self.zmlog, name)(*args)
+            except Exception as e:
+                print('zmlog: could not write log record: {}'.format(e), file=sys.stderr)
+
+    def flush(self):
+        # writes everything queued so far
+        if self._records is None or self._pid != os.getpid():
+            return
+        with self._write_lock:
+            self._drain()
+
+    def close(self):
+        if self._records is not None and self._pid == os.getpid():
+            self.flush()
+            if self.dropped:
+                self.zmlog.Info('log: dropped {} debug records, the log queue was full'.format(self.dropped),
+                                find_caller())
+            self._records = None
+            with self._cond:
+                self._cond.notify()
+        self.zmlog.close()
+
+    def enabled(self, level=1):
+        # whether Debug(level, ...) would be written anywhere
+        config = self.zmlog.config
+        if not config.get('log_debug') or level > config.get('log_level_debug', 0):
+            return False
+        target = config.get('log_debug_target')
+        if target:
+            targets = [x.strip().lstrip('_') for x in target.split('|')]
+            if not any(map((self.zmlog.process_name or '').startswith, targets)):
+                return False
+        dbg = self.zmlog.levels['DBG']
+        return bool(config.get('dump_console')) or any(
+            dbg <= config.get(k, -5) for k in ('log_level_syslog', 'log_level_db', 'log_level_file'))
+
+    def _text(self, message, args):
+        message = _message(message, args)
+        if self.trace_id:
+            return '[{}] {}'.format(self.trace_id, message)
+        return message
+
+    def Debug(self, level=1, message=None, *args, caller=None):
+        if not self.enabled(level):
+            return
+        self._put('Debug', (level, self._text(message, args), caller or find_caller()))
+
+    def Info(self, message=None, *args, caller=None):
+        self._put('Info', (self._text(message, args), caller or find_caller()))
+
+    def Warning(self, message=None, *args, caller=None):
+        self._put('Warning', (self._text(message, args), caller or find_caller()))
+
+    def Error(self, message=None, *args, caller=None):
+        self._put('Error', (self._text(message, args), caller or find_caller()))
+
+    def Fatal(self, message=None, *args, caller=None):
+        self.flush()
+        self.zmlog.Fatal(self._text(message, args), caller or find_caller())
+
+    def Panic(self, message=None, *args, caller=None):
+        self.flush()
+        self.zmlog.Panic(self._text(message, args), caller or find_caller())
 
 
 class wrapperLogger():
     def __init__(self, name, override, dump_console):
+        import pyzm.ZMLog as zmlog
         zmlog.init(name=name, override=override)
+        self.log = ZMLogger(zmlog)
         self.dump_console = dump_console
 
-    
-
-    def debug(self, msg, level=1):
-        idx = min(len(stack()), 1)
-        caller = getframeinfo(stack()[idx][0])
-        zmlog.Debug(level, msg, caller)
+    def debug(self, msg, level=1, *args):
+        if not self.log.enabled(level) and not self.dump_console:
+            return
+        msg = _message(msg, args)
+        self.log.Debug(level, msg, caller=find_caller())
         if (self.dump_console):
             print('CONSOLE:' + msg)
 
-    def info(self, msg):
-        idx = min(len(stack()), 1)
-        caller = getframeinfo(stack()[idx][0])
-        zmlog.Info(msg, caller)
+    def info(self, msg, *args):
+        msg = _message(msg, args)
+        self.log.Info(msg, caller=find_caller())
         if (self.dump_console):
             print('CONSOLE:' + msg)
 
-    def error(self, msg):
-        idx = min(len(stack()), 1)
-        caller = getframeinfo(stack()[idx][0])
-        zmlog.Error(msg, caller)
+    def error(self, msg, *args):
+        msg = _message(msg, args)
+        self.log.Error(msg, caller=find_caller())
         if (self.dump_console):
             print('CONSOLE:' + msg)
 
-    def fatal(self, msg):
-        idx = min(len(stack()), 1)
-        caller = getframeinfo(stack()[idx][0])
-        zmlog.Fatal(msg, caller)
+    def fatal(self, msg, *args):
+        msg = _message(msg, args)
+        self.log.Fatal(msg, caller=find_caller())
         if (self.dump_console):
             print('CONSOLE:' + msg)
 
     def setLevel(self, level):
         pass
-    
-  
+
+
 
 def init(process_name=None, override={}, dump_console=False):
     g.logger = wrapperLogger(name=process_name, override=override, dump_console=dump_console)
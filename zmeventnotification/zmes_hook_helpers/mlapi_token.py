@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import fcntl
+import zmes_hook_helpers.common_params as g
+
+# mlapi access token, shared by all detection processes on this host.
+# The token is kept in memory for the life of the process and in
+# {{base_data_path}}/zm_login.json for other processes. When it is about to
+# expire, one process logs in while holding zm_login.json.lock, the others
+# wait for the lock and then pick up the token it wrote. The file is
+# replaced atomically, so readers never see half written JSON.
+
+# refresh this many seconds before the token expires
+REFRESH_AHEAD = 30
+# lifetime assumed for a token mlapi did not give an expiry for
+DEFAULT_EXPIRES = 300
+
+_token = None  # {'token', 'expires', 'time'}
+
+
+def _token_file():
+    return g.config['base_data_path'] + '/zm_login.json'
+
+
+def _valid(data, now):
+    if not (data and data.get('token')):
+        return False
+    try:
+        return int(now + REFRESH_AHEAD - data['time']) < float(data['expires'])
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+def _read_file():
+    try:
+        with open(_token_file()) as f:
+            data = json.load(f)
+        if data.get('token') and data.get('time') and data.get('expires'):
+            return data
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        g.logger.Error('Error loading {}: {}'.format(_token_file(), e))
+    return None
+
+
+def _write_file(data):
+    tmp_file = '{}.{}'.format(_token_file(), os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_file, _token_file())
+
+
+def _login(session, api_url):
+    g.logger.Debug(1,'Invoking remote API login')
+    r = session.post(url=api_url + '/login',
+                     data=json.dumps({
+                         'username': g.config['ml_user'],
+                         'password': g.config['ml_password'],
+                     }),
+                     headers={'content-type': 'application/json'})
+    data = r.json()
+    access_token = data.get('access_token')
+    if not access_token:
+        raise ValueError('Error getting remote API token {}'.format(data))
+    try:
+        expires = int(data['expires'])
+    except (KeyError, TypeError, ValueError):
+        g.logger.Debug(1,'remote API login did not say when the token expires, assuming %s seconds', DEFAULT_EXPIRES)
+        expires = DEFAULT_EXPIRES
+    return {
+        'token': access_token,
+        'expires': expires,
+        'time': time.time()
+    }
+
+
+def get_token(session, api_url):
+    global _token
+    now = time.time()
+    if _valid(_token, now):
+        return _token['token']
+
+    data = _read_file()
+    if not _valid(data, now):
+        with open(_token_file() + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # another process may have logged in while we waited
+                data = _read_file()
+                if not _valid(data, time.time()):
+                    data = _login(session, api_url)
+                    g.logger.Debug(2,'Writing new token for future use')
+                    _write_file(data)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    _token = data
+    g.logger.Debug(1,'Access token is valid for %s more seconds',
+        int(data['expires'] - (time.time() - data['time'])))
+    return _token['token']
+
+
+def invalidate(token):
+    # mlapi rejected token. Only drop it if nobody has replaced it yet
+    global _token
+    if _token and _token['token'] == token:
+        _token = None
+    with open(_token_file() + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            data = _read_file()
+            if data and data['token'] == token:
+                os.remove(_token_file())
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
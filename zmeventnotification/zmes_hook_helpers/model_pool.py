@@ -0,0 +1,224 @@
+import os
+import copy
+import time
+import gc
+from collections import OrderedDict
+import zmes_hook_helpers.common_params as g
+
+# Keeps loaded pyzm models (object/face/alpr) around so that they can be reused
+# across events and monitors. A model is keyed by what it takes to load it
+# (framework, weights, config, labels, processor), so monitor sections that only
+# change patterns or confidences share the same loaded network.
+# Each sequence entry gets its own shallow copy of the pooled model (see
+# _view), with the entry's options and the settings pyzm derives from them
+# in __init__. Only the network itself is shared.
+
+# options that decide which network gets loaded, per model type
+_load_keys = {
+    'object': ['object_framework', 'object_weights', 'object_config', 'object_labels', 'object_processor'],
+    'face': ['face_detection_framework', 'face_recognition_framework', 'face_processor',
+             'known_images_path', 'face_model', 'face_train_model'],
+    'alpr': ['alpr_service', 'alpr_api_type', 'alpr_url', 'alpr_key',
+             'openalpr_cmdline_binary', 'openalpr_cmdline_params'],
+}
+
+
+# parts of a key that must not be logged
+_secret_keys = ['alpr_key']
+
+
+def _rss_bytes():
+    # resident set size of this process
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        return 0
+
+
+def model_key(model_type, entry):
+    key = [model_type]
+    for k in _load_keys.get(model_type, []):
+        v = entry.get(k)
+        if isinstance(v, str):
+            v = v.strip()
+            if v.startswith('/'):
+                v = os.path.normpath(v)
+        key.append((k, v))
+    return tuple(key)
+
+
+# attributes that hold the loaded network, by pyzm class. The first one is
+# None until the model is loaded
+_network = {
+    'Yolo': ('net', 'classes'),
+    'Tpu': ('model',),
+}
+
+
+def _load_shared(model, view):
+    # load_model of a view: loads the pooled model once, the view uses its network
+    attrs = _network[type(model).__name__]
+    if getattr(model, attrs[0]) is None:
+        model.load_model()
+    for a in attrs:
+        setattr(view, a, getattr(model, a))
+
+
+def _view(model, entry):
+    # a copy of a pooled pyzm model (Object, Yolo, Tpu, Face) for one
+    # sequence entry. The pyzm classes read options in __init__ into their
+    # own fields (lock settings, model size), those follow entry here
+    view = copy.copy(model)
+    view.options = entry
+    name = type(model).__name__
+    if name == 'Object':
+        view.model = _view(model.model, entry)
+        return view
+    if name == 'Yolo':
+        view.processor = entry.get('object_processor') or 'cpu'
+        view.model_height = entry.get('model_height', 416)
+        view.model_width = entry.get('model_width', 416)
+    elif name == 'Face':
+        view.face_model = entry.get('face_model') or 'hog'
+    view.disable_locks = entry.get('disable_locks', 'no')
+    view.lock_maximum = int(entry.get(view.processor + '_max_processes') or 1)
+    view.lock_timeout = int(entry.get(view.processor + '_max_lock_wait') or 120)
+    view.lock_name = 'pyzm_uid{}_{}_lock'.format(os.getuid(), view.processor)
+    view.is_locked = False
+    if view.disable_locks == 'no':
+        import portalocker
+        view.lock = portalocker.BoundedSemaphore(maximum=view.lock_maximum, name=view.lock_name,
+                                                 timeout=view.lock_timeout)
+    if name in _network:
+        view.load_model = lambda: _load_shared(model, view)
+    return view
+
+
+def describe(key):
+    # model_key for logs, without secrets
+    return tuple(k if not (isinstance(k, tuple) and k[0] in _secret_keys and k[1]) else (k[0], '***')
+                 for k in key)
+
+
+def processor_of(model_type, entry):
+    return (entry.get('{}_processor'.format(model_type)) or 'cpu').lower()
+
+
+class ModelPool:
+    def __init__(self):
+        self.models = OrderedDict()  # key -> {'model', 'size'}
+        self.max_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_time = 0.0
+
+    def set_budget(self, max_mb):
+        self.max_bytes = int(max_mb) * 1024 * 1024 if max_mb else 0
+
+    def _create(self, model_type, entry):
+        if model_type == 'object':
+            import pyzm.ml.object as ObjectDetect
+            return ObjectDetect.Object(options=entry, logger=g.logger)
+        elif model_type == 'face':
+            import pyzm.ml.face as FaceDetect
+            return FaceDetect.Face(options=entry, logger=g.logger)
+        elif model_type == 'alpr':
+            import pyzm.ml.alpr as AlprDetect
+            return AlprDetect.Alpr(options=entry, logger=g.logger)
+        raise ValueError('Invalid model type: {}'.format(model_type))
+
+    def _load(self, model):
+        # pyzm loads networks on first detect, we want the cost (and memory) here
+        for target in (model, getattr(model, 'model', None)):
+            if target is not None and hasattr(target, 'load_model'):
+                target.load_model()
+                return
+
+    def view(self, model_type, entry):
+        # the pooled model of entry, as a model of its own for entry
+        if model_type == 'alpr':
+            # nothing is loaded for ALPR, a new one costs nothing
+            return self._create(model_type, entry)
+        return _view(self.get(model_type, entry), entry)
+
+    def _evict(self):
+        if not self.max_bytes:
+            return
+        rss = _rss_bytes()
+        # never evict the model we just loaded/used
+        while rss > self.max_bytes and len(self.models) > 1:
+            key, item = self.models.popitem(last=False)
+            rss = rss - item['size']
+            self.evictions += 1
+            g.logger.Debug(1,'model_pool: evicted %s, %s bytes over budget', describe(key), max(rss - self.max_bytes, 0))
+            del item
+        gc.collect()
+
+    def get(self, model_type, entry, load=False):
+        key = model_key(model_type, entry)
+        item = self.models.get(key)
+        if item:
+            self.hits += 1
+            self.models.move_to_end(key)
+            g.logger.Debug(2,'model_pool: reusing %s', describe(key))
+            return item['model']
+
+        self.misses += 1
+        start = time.time()
+        rss = _rss_bytes()
+        model = self._create(model_type, entry)
+        if load:
+            self._load(model)
+        diff_time = time.time() - start
+        self.load_time += diff_time
+        self.models[key] = {'model': model, 'size': max(_rss_bytes() - rss, 0)}
+        g.logger.Debug(1,'model_pool: loaded %s in %.2fs', describe(key), diff_time)
+        self._evict()
+        return model
+
+    def get_models(self, ml_options):
+        # builds a DetectSequence models dict out of views of pooled models
+        models = {}
+        disable_locks = ml_options.get('general', {}).get('disable_locks', 'no')
+        for model_type in ml_options.get('general', {}).get('model_sequence', 'object').split(','):
+            model_type = model_type.strip()
+            models[model_type] = []
+            for entry in ml_options.get(model_type, {}).get('sequence', []):
+                entry['disable_locks'] = disable_locks
+                models[model_type].append(self.view(model_type, entry))
+        return models
+
+    def warm(self, ml_options, processors=('cpu',), exclude=None):
+        # loads models ahead of time. Only for processors that are safe
+        # to load before a fork (GPU/TPU handles are not)
+        for model_type in ml_options.get('general', {}).get('model_sequence', 'object').split(','):
+            model_type = model_type.strip()
+            for entry in ml_options.get(model_type, {}).get('sequence', []):
+                if processor_of(model_type, entry) not in processors:
+                    continue
+                if exclude and exclude(model_type, entry):
+                    continue
+                try:
+                    self.get(model_type, entry, load=True)
+                except Exception as e:
+                    g.logger.Error('model_pool: could not preload {} model: {}'.format(model_type, e))
+
+    def reset_stats(self):
+        # in a forked child, so its stats are its own
+        self.hits = self.misses = self.evictions = 0
+        self.load_time = 0.0
+
+    def stats(self):
+        return {
+            'models': len(self.models),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'load_time': round(self.load_time, 2),
+            'rss_mb': round(_rss_bytes() / 1024 / 1024, 1),
+        }
+
+
+pool = ModelPool()
@@ -0,0 +1,114 @@
+import os
+import time
+import zmes_hook_helpers.common_params as g
+
+# History of past detections, used by match_past_detections.
+# Kept in an SQLite database in WAL mode at
+# {{base_data_path}}/misc/past_detections.db, so readers never wait for a
+# writer and each event is written in one transaction: a reader sees all
+# of an event's detections or none of them.
+# Every event of a monitor is recorded, even one without detections, so
+# that "the last event" means the same as it did with the pickle files.
+# Per monitor, only the last past_det_history_events events are kept and
+# events older than past_det_max_age seconds are ignored and removed.
+
+BUSY_TIMEOUT = 10
+
+_SCHEMA = '''
+create table if not exists events (
+    id integer primary key,
+    mid text not null,
+    eid text,
+    time real not null
+);
+create index if not exists events_mid on events (mid, id);
+create table if not exists detections (
+    event_id integer not null references events (id) on delete cascade,
+    label text not null,
+    confidence real,
+    x1 real, y1 real, x2 real, y2 real
+);
+create index if not exists detections_event on detections (event_id);
+'''
+
+_conn = None
+_pid = None
+
+
+def _db_file():
+    return os.path.join(g.config['base_data_path'], 'misc', 'past_detections.db')
+
+
+def _connect():
+    global _conn, _pid
+    import sqlite3
+
+    # sqlite connections must not be used across a fork
+    if _conn is not None and _pid == os.getpid():
+        return _conn
+    os.makedirs(os.path.dirname(_db_file()), exist_ok=True)
+    conn = sqlite3.connect(_db_file(), timeout=BUSY_TIMEOUT, isolation_level=None)
+    conn.execute('pragma journal_mode=wal')
+    conn.execute('pragma synchronous=normal')
+    conn.execute('pragma foreign_keys=on')
+    conn.executescript(_SCHEMA)
+    _conn, _pid = conn, os.getpid()
+    return _conn
+
+
+def _min_time():
+    max_age = g.config['past_det_max_age']
+    return time.time() - max_age if max_age else 0
+
+
+def load(mid):
+    # returns (boxes, labels, confidences) of the last
+    # past_det_history_events events of the monitor that are not too old
+    conn = _connect()
+    rows = conn.execute(
+        'select d.label, d.confidence, d.x1, d.y1, d.x2, d.y2 from detections d'
+        ' where d.event_id in (select id from events where mid = ? and time >= ?'
+        ' order by id desc limit ?) order by d.event_id desc, d.rowid',
+        (str(mid), _min_time(), g.config['past_det_history_events'])).fetchall()
+    boxes = []
+    labels = []
+    confs = []
+    for label, conf, x1, y1, x2, y2 in rows:
+        boxes.append([_num(x1), _num(y1), _num(x2), _num(y2)])
+        labels.append(label)
+        confs.append(conf)
+    return boxes, labels, confs
+
+
+def _num(v):
+    # boxes are usually ints, keep them that way
+    return int(v) if v is not None and float(v).is_integer() else v
+
+
+def save(mid, boxes, labels, confs, eid=None):
+    conn = _connect()
+    mid = str(mid)
+    cur = conn.cursor()
+    try:
+        cur.execute('begin immediate')
+        cur.execute('insert into events (mid, eid, time) values (?, ?, ?)',
+                    (mid, None if eid is None else str(eid), time.time()))
+        event_id = cur.lastrowid
+        cur.executemany(
+            'insert into detections (event_id, label, confidence, x1, y1, x2, y2)'
+            ' values (?, ?, ?, ?, ?, ?, ?)',
+            [(event_id, l, None if c is None else float(c), float(b[0]), float(b[1]), float(b[2]), float(b[3]))
+             for b, l, c in zip(boxes, labels, confs)])
+        # expire what is too old or beyond the last past_det_history_events
+        cur.execute(
+            'delete from events where mid = ? and (time < ? or id not in'
+            ' (select id from events where mid = ? order by id desc limit ?))',
+            (mid, _min_time(), mid, g.config['past_det_history_events']))
+        cur.execute('commit')
+    except Exception:
+        if conn.in_transaction:
+            cur.execute('rollback')
+        raise
+    finally:
+        cur.close()
+    g.logger.Debug(2,'past detections: saved %s detections for monitor %s', len(boxes), mid)
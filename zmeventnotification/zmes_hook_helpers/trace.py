@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+import zmes_hook_helpers.common_params as g
+
+# Per event tracing. An event gets a trace ID, taken from --trace-id or the
+# ZMES_TRACE_ID environment variable if whoever started the hook has one,
+# or made up here. The ID goes into every ZM log line of the event (see
+# ZMLogger.trace_id) and to mlapi in an X-Trace-Id request header, so one
+# event can be followed across the ES, the hook and mlapi.
+# Stages of the event are timed in nested spans:
+#     with trace.span('zones', mid=mid):
+#         ...
+# and finish() appends the event, with all of its spans and the peak RSS of
+# the process, as one JSON line to trace_file. span() does nothing if no trace was started, so helpers can be
+# instrumented whatever runs them.
+
+HEADER = 'X-Trace-Id'
+KEEP_ROTATED = 1
+
+_trace = None  # trace of the event being processed
+_local = threading.local()  # per thread stack of open spans
+
+
+def new_id():
+    return uuid.uuid4().hex[:16]
+
+
+def start(trace_id=None, **attrs):
+    # starts the trace of an event, returns its ID
+    global _trace
+    _trace = {
+        'trace_id': trace_id or os.environ.get('ZMES_TRACE_ID') or new_id(),
+        'pid': os.getpid(),
+        'start': time.time(),
+        'perf': time.perf_counter(),
+        'attrs': attrs,
+        'spans': [],
+    }
+    _local.stack = []
+    return _trace['trace_id']
+
+
+def active():
+    return _trace is not None and _trace['pid'] == os.getpid()
+
+
+def current_id():
+    return _trace['trace_id'] if active() else None
+
+
+def headers():
+    # request headers that carry the trace ID
+    return {HEADER: _trace['trace_id']} if active() else {}
+
+
+@contextmanager
+def span(name, **attrs):
+    if not active():
+        yield None
+        return
+    trace = _trace
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    s = {
+        'id': len(trace['spans']) + 1,
+        'parent': stack[-1]['id'] if stack else 0,
+        'name': name,
+        'start_ms': round((time.perf_counter() - trace['perf']) * 1000, 3),
+    }
+    if attrs:
+        s['attrs'] = attrs
+    trace['spans'].append(s)
+    stack.append(s)
+    start = time.perf_counter()
+    try:
+        yield s
+    except BaseException as e:
+        s['error'] = '{}: {}'.format(type(e).__name__, e)
+        raise
+    finally:
+        s['duration_ms'] = round((time.perf_counter() - start) * 1000, 3)
+        stack.remove(s)
+
+
+def set_attrs(**attrs):
+    # adds attributes to the trace itself
+    if active():
+        _trace['attrs'].update(attrs)
+
+
+def finish(error=None):
+    # writes the trace as one line to trace_file and ends it
+    global _trace
+    if not active():
+        return None
+    trace = _trace
+    _trace = None
+    record = {
+        'trace_id': trace['trace_id'],
+        'start': round(trace['start'], 3),
+        'duration_ms': round((time.perf_counter() - trace['perf']) * 1000, 3),
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+    record.update(trace['attrs'])
+    if error:
+        record['error'] = error
+    record['spans'] = trace['spans']
+    trace_file = g.config.get('trace_file')
+    if not trace_file:
+        return record
+    try:
+        _append(trace_file, json.dumps(record, default=str) + '\n')
+    except Exception as e:
+        g.logger.Error('trace: could not write to {}: {}'.format(trace_file, e))
+    return record
+
+
+def _peak_rss_mb():
+    # VmHWM is for this program; ru_maxrss would include the memory of
+    # whatever forked and exec'd it
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024.0, 1)
+    except OSError:
+        pass
+    return None
+
+
+def _append(trace_file, line):
+    os.makedirs(os.path.dirname(trace_file) or '.', exist_ok=True)
+    max_bytes = int(g.config.get('trace_file_max_mb') or 0) * 1024 * 1024
+    try:
+        if max_bytes and os.path.getsize(trace_file) > max_bytes:
+            os.replace(trace_file, '{}.{}'.format(trace_file, KEEP_ROTATED))
+    except FileNotFoundError:
+        pass
+    # one write per event, so lines of concurrent events do not interleave
+    fd = os.open(trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+class TracedModel:
+    # stands in for a model of a pyzm DetectSequence and times its detect()
+    def __init__(self, model, name):
+        self.model = model
+        self.name = name
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def detect(self, image=None):
+        with span('model', model=self.name) as s:
+            b, l, c = self.model.detect(image=image)
+            if s is not None:
+                s['detections'] = len(l)
+            return b, l, c
+
+
+def traced_models(models):
+    # wraps the models of a pyzm DetectSequence models dict
+    for seq, seq_models in models.items():
+        models[seq] = [TracedModel(m, '{}:{}'.format(seq, i)) for i, m in enumerate(seq_models)]
+    return models
+
+
+class TracedApi:
+    # stands in for the pyzm ZMApi a detect_stream reads frames with
+    def __init__(self, api):
+        self.api = api
+
+    def __getattr__(self, name):
+        return getattr(self.api, name)
+
+    def _make_request(self, url=None, *args, **kwargs):
+        kind = 'frame' if 'view=image' in (url or '') else 'api'
+        with span('fetch', kind=kind):
+            return self.api._make_request(url, *args, **kwargs)
@@ -2,25 +2,23 @@
 
 
 from __future__ import division
-import logging
-import logging.handlers
 import sys
+import os
 import datetime
-import ssl
 import urllib
 import json
 import time
 import re
 import ast
+import copy
+import hashlib
 import urllib.parse
 import traceback
 
 from configparser import ConfigParser
 import zmes_hook_helpers.common_params as g
+import zmes_hook_helpers.trace as trace
 
-from future import standard_library
-standard_library.install_aliases()
-from urllib.error import HTTPError
 
 #resize polygons based on analysis scale
 
@@ -126,20 +124,6 @@ def convert_config_to_ml_sequence():
         g.config['detection_mode'] = 'most_models'
     return ml_options
 
-def rescale_polygons(xfactor, yfactor):
-    newps = []
-    for p in g.polygons:
-        newp = []
-        for x, y in p['value']:
-            newx = int(x * xfactor)
-            newy = int(y * yfactor)
-            newp.append((newx, newy))
-        newps.append({'name': p['name'], 'value': newp, 'pattern': p['pattern']})
-    g.logger.Debug(2,'resized polygons x={}/y={}: {}'.format(
-        xfactor, yfactor, newps))
-    g.polygons = newps
-
-
 # converts a string of cordinates 'x1,y1 x2,y2 ...' to a tuple set. We use this
 # to parse the polygon parameters in the ini file
 
@@ -157,53 +141,184 @@ def str_split(my_str):
 
 
 
+_var_pattern = re.compile(r'{{(\w+?)}}')
+
+
+# expands {{key}} references in string values of config, in place.
+# References are collected once into a dependency graph and values are
+# expanded in topological order, each exactly once. Values that are not
+# strings are never templates and keep their type. Raises ValueError on
+# circular references, returns a list of (key, reference) for references
+# to keys that do not exist (those are left as is)
+def resolve_config_vars(config):
+    deps = {}
+    undefined = []
+    for k, v in config.items():
+        if not isinstance(v, str):
+            continue
+        refs = set(_var_pattern.findall(v))
+        if not refs:
+            continue
+        for r in refs:
+            if r not in config:
+                undefined.append((k, r))
+        deps[k] = {r for r in refs if r in config}
+
+    # Kahn's algorithm, over templated keys only
+    waiting = {k: len([r for r in d if r in deps]) for k, d in deps.items()}
+    users = {}
+    for k, d in deps.items():
+        for r in d:
+            if r in deps:
+                users.setdefault(r, []).append(k)
+    ready = [k for k, n in waiting.items() if n == 0]
+    while ready:
+        k = ready.pop()
+        config[k] = _var_pattern.sub(
+            lambda m: str(config[m.group(1)]) if m.group(1) in config else m.group(0), config[k])
+        for u in users.get(k, []):
+            waiting[u] -= 1
+            if waiting[u] == 0:
+                ready.append(u)
+        del waiting[k]
+
+    if waiting:
+        # everything left is on, or depends on, a cycle. Walk to one for the error
+        k = next(iter(waiting))
+        path = []
+        while k not in path:
+            path.append(k)
+            k = next(r for r in deps[k] if r in waiting)
+        cycle = path[path.index(k):] + [k]
+        raise ValueError('circular {{{{}}}} reference in config: {}'.format(
+            ' -> '.join(cycle)))
+    return undefined
+
+
 # credit: https://stackoverflow.com/a/5320179
 def findWholeWord(w):
     return re.compile(r'\b({0})\b'.format(w), flags=re.IGNORECASE).search
 
 
-# Imports zone definitions from ZM
-def import_zm_zones(mid, reason):
+def _zone_cache_file(mid):
+    return '{}/misc/zones/m{}.json'.format(g.config['base_data_path'], mid)
 
-    match_reason = False
-    if reason:
-        match_reason = True if g.config['only_triggered_zm_zones']=='yes' else False
-    g.logger.Debug(2,'import_zm_zones: match_reason={} and reason={}'.format(match_reason, reason))
+
+def invalidate_zone_cache(mid=None):
+    # removes cached zones of one monitor, or of all monitors
+    cache_dir = '{}/misc/zones'.format(g.config['base_data_path'])
+    if mid:
+        files = [_zone_cache_file(mid)]
+    else:
+        files = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir)] if os.path.isdir(cache_dir) else []
+    removed = []
+    for f in files:
+        try:
+            os.remove(f)
+            removed.append(f)
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def _fetch_zm_zones(mid, cached=None):
+    # returns None if zones are unchanged from cached, else (zones, validators)
+    from zmes_hook_helpers.httpclient import get_session
 
     url = g.config['portal'] + '/api/zones/forMonitor/' + mid + '.json'
-    g.logger.Debug(2,'Getting ZM zones using {}?username=xxx&password=yyy&user=xxx&pass=yyy'.format(url))
+    g.logger.Debug(2,'Getting ZM zones using %s?username=xxx&password=yyy&user=xxx&pass=yyy', url)
     url = url + '?username=' + g.config['user']
     url = url + '&password=' + urllib.parse.quote(g.config['password'], safe='')
     url = url + '&user=' + g.config['user']
     url = url + '&pass=' + urllib.parse.quote(g.config['password'], safe='')
 
-    if g.config['portal'].lower().startswith('https://'):
-        main_handler = urllib.request.HTTPSHandler(context=g.ctx)
-    else:
-        main_handler = urllib.request.HTTPHandler()
-
-    if g.config['basic_user']:
-        g.logger.Debug(2,'Basic auth config found, associating handlers')
-        password_mgr = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-        top_level_url = g.config['portal']
-        password_mgr.add_password(None, top_level_url, g.config['basic_user'],
-                                  g.config['basic_password'])
-        handler = urllib.request.HTTPBasicAuthHandler(password_mgr)
-        opener = urllib.request.build_opener(handler, main_handler)
-
-    else:
-        opener = urllib.request.build_opener(main_handler)
+    headers = {}
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
     try:
-        input_file = opener.open(url)
-    except HTTPError as e:
-        g.logger.Error(f'HTTP Error in import_zm_zones:{e}')
-        raise
+        input_file = get_session().get(url, headers=headers)
+        if input_file.status_code == 304 and cached:
+            return None
+        input_file.raise_for_status()
     except Exception as e:
-        g.logger.Error(f'General error in import_zm_zones:{e}')
+        g.logger.Error(f'Error in import_zm_zones:{e}')
         raise
 
-    c = input_file.read()
+    c = input_file.content
+    # ZM does not send validators, so also compare the body itself
+    sha1 = hashlib.sha1(c).hexdigest()
+    if cached and cached.get('sha1') == sha1:
+        return None
     j = json.loads(c)
+    zones = [{
+        'name': item['Zone']['Name'],
+        'type': item['Zone']['Type'],
+        'value': str2tuple(item['Zone']['Coords']),
+    } for item in j['zones']]
+    validators = {
+        'etag': input_file.headers.get('ETag'),
+        'last_modified': input_file.headers.get('Last-Modified'),
+        'sha1': sha1,
+    }
+    return zones, validators
+
+
+def get_zm_zones(mid):
+    # ZM zones of a monitor, parsed. They are cached per monitor in
+    # base_data_path for zm_zones_cache_ttl seconds, shared by all
+    # detection processes. After that they are revalidated with ZM
+    ttl = g.config['zm_zones_cache_ttl']
+    cache_file = _zone_cache_file(mid)
+    cached = None
+    if ttl > 0:
+        try:
+            with open(cache_file) as f:
+                cached = json.load(f)
+            for zone in cached['zones']:
+                zone['value'] = [tuple(p) for p in zone['value']]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            g.logger.Debug(1,'ignoring unreadable zone cache %s: %s', cache_file, e)
+            cached = None
+        if cached and time.time() - cached['fetched'] < ttl:
+            g.logger.Debug(2,'using cached ZM zones for monitor %s', mid)
+            return cached['zones']
+
+    try:
+        res = _fetch_zm_zones(mid, cached)
+    except Exception:
+        if cached:
+            g.logger.Error('could not revalidate ZM zones for monitor {}, using cached ones'.format(mid))
+            return cached['zones']
+        raise
+
+    if res is None:
+        g.logger.Debug(2,'ZM zones for monitor %s are unchanged', mid)
+        zones = cached['zones']
+        validators = {k: cached.get(k) for k in ('etag', 'last_modified', 'sha1')}
+    else:
+        zones, validators = res
+    if ttl > 0:
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            tmp_file = '{}.{}'.format(cache_file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump(dict(validators, fetched=time.time(), zones=zones), f)
+            os.replace(tmp_file, cache_file)
+        except Exception as e:
+            g.logger.Debug(1,'could not write zone cache %s: %s', cache_file, e)
+    return zones
+
+
+# Imports zone definitions from ZM
+def import_zm_zones(mid, reason):
+    match_reason = False
+    if reason:
+        match_reason = True if g.config['only_triggered_zm_zones']=='yes' else False
+    g.logger.Debug(2,'import_zm_zones: match_reason=%s and reason=%s', match_reason, reason)
 
     # Now lets look at reason to see if we need to
     # honor ZM motion zones
@@ -212,20 +327,20 @@ def import_zm_zones(mid, reason):
     #reason_zones = [x.strip() for x in rz.split(',')]
     #g.logger.Debug(1,'Found motion zones provided in alarm cause: {}'.format(reason_zones))
 
-    for item in j['zones']:
-        #print ('********* ITEM TYPE {}'.format(item['Zone']['Type']))
-        if item['Zone']['Type'] == 'Inactive':
-            g.logger.Debug(2, 'Skipping {} as it is inactive'.format(item['Zone']['Name']))
+    for zone in get_zm_zones(mid):
+        #print ('********* ITEM TYPE {}'.format(zone['type']))
+        if zone['type'] == 'Inactive':
+            g.logger.Debug(2, 'Skipping %s as it is inactive', zone['name'])
             continue
         if  match_reason:
-            if not findWholeWord(item['Zone']['Name'])(reason):
-                g.logger.Debug(1,'dropping {} as zones in alarm cause is {}'.format(item['Zone']['Name'], reason))
+            if not findWholeWord(zone['name'])(reason):
+                g.logger.Debug(1,'dropping %s as zones in alarm cause is %s', zone['name'], reason)
                 continue
-        item['Zone']['Name'] = item['Zone']['Name'].replace(' ','_').lower()
-        g.logger.Debug(2,'importing zoneminder polygon: {} [{}]'.format(item['Zone']['Name'], item['Zone']['Coords']))
+        name = zone['name'].replace(' ','_').lower()
+        g.logger.Debug(2,'importing zoneminder polygon: %s [%s]', name, zone['value'])
         g.polygons.append({
-            'name': item['Zone']['Name'],
-            'value': str2tuple(item['Zone']['Coords']),
+            'name': name,
+            'value': list(zone['value']),
             'pattern': None
 
         })
@@ -234,28 +349,14 @@ def import_zm_zones(mid, reason):
 
 # downloaded ZM image files for future analysis
 def download_files(args):
+    from zmes_hook_helpers.httpclient import get_session
     if int(g.config['wait']) > 0:
         g.logger.Info('Sleeping for {} seconds before downloading'.format(
             g.config['wait']))
         time.sleep(g.config['wait'])
 
 
-    if g.config['portal'].lower().startswith('https://'):
-        main_handler = urllib.request.HTTPSHandler(context=g.ctx)
-    else:
-        main_handler = urllib.request.HTTPHandler()
-
-    if g.config['basic_user']:
-        g.logger.Debug(2,'Basic auth config found, associating handlers')
-        password_mgr = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-        top_level_url = g.config['portal']
-        password_mgr.add_password(None, top_level_url, g.config['basic_user'],
-                                  g.config['basic_password'])
-        handler = urllib.request.HTTPBasicAuthHandler(password_mgr)
-        opener = urllib.request.build_opener(handler, main_handler)
-
-    else:
-        opener = urllib.request.build_opener(main_handler)
+    session = get_session()
 
     if g.config['frame_id'] == 'bestmatch':
         # download both alarm and snapshot
@@ -278,14 +379,15 @@ def download_files(args):
                     g.config['password'], safe='')
             durl = durl + '&username=' + g.config['user'] + '&password=*****'
 
-        g.logger.Debug(1,'Trying to download {}'.format(durl))
+        g.logger.Debug(1,'Trying to download %s', durl)
         try:
-            input_file = opener.open(url)
-        except HTTPError as e:
+            input_file = session.get(url)
+            input_file.raise_for_status()
+        except Exception as e:
             g.logger.Error(e)
             raise
         with open(filename1, 'wb') as output_file:
-            output_file.write(input_file.read())
+            output_file.write(input_file.content)
             output_file.close()
 
         url = g.config['portal'] + '/index.php?view=image&eid=' + args.get(
@@ -297,14 +399,15 @@ def download_files(args):
                 'user'] + '&password=' + urllib.parse.quote(
                     g.config['password'], safe='')
             durl = durl + '&username=' + g.config['user'] + '&password=*****'
-        g.logger.Debug(1,'Trying to download {}'.format(durl))
+        g.logger.Debug(1,'Trying to download %s', durl)
         try:
-            input_file = opener.open(url)
-        except HTTPError as e:
+            input_file = session.get(url)
+            input_file.raise_for_status()
+        except Exception as e:
             g.logger.Error(e)
             raise
         with open(filename2, 'wb') as output_file:
-            output_file.write(input_file.read())
+            output_file.write(input_file.content)
             output_file.close()
 
     else:
@@ -324,20 +427,321 @@ def download_files(args):
                 'user'] + '&password=' + urllib.parse.quote(
                     g.config['password'], safe='')
             durl = durl + '&username=' + g.config['user'] + '&password=*****'
-        g.logger.Debug(1,'Trying to download {}'.format(durl))
-        input_file = opener.open(url)
+        g.logger.Debug(1,'Trying to download %s', durl)
+        input_file = session.get(url)
+        input_file.raise_for_status()
         with open(filename1, 'wb') as output_file:
-            output_file.write(input_file.read())
+            output_file.write(input_file.content)
             output_file.close()
     return filename1, filename2, filename1_bbox, filename2_bbox
 
+# what init_logs needs, before process_config
+_log_keys = ['log_buffer', 'log_buffer_size', 'log_flush_interval_ms']
+
+
 def get_pyzm_config(args):
     g.config['pyzm_overrides'] = {}
+    # logs are not up yet, so only the default data path is looked at here
+    snapshot = load_config_snapshot(args, g.config_vals['base_data_path']['default'])
+    if snapshot:
+        g.config['pyzm_overrides'] = copy.deepcopy(snapshot['pyzm_overrides'])
+        g.config['base_data_path'] = snapshot['config']['base_data_path']
+        for k in _log_keys:
+            g.config[k] = snapshot['config'].get(k, g.config_vals[k]['default'])
+        return
     config_file = ConfigParser(interpolation=None, inline_comment_prefixes='#')
     config_file.read(args.get('config'))
     if config_file.has_option('general', 'pyzm_overrides'):
         pyzm_overrides = config_file.get('general', 'pyzm_overrides')
         g.config['pyzm_overrides'] =  ast.literal_eval(pyzm_overrides) if pyzm_overrides else {}
+    # needed before process_config for cached lookups
+    g.config['base_data_path'] = config_file.get('general', 'base_data_path',
+                                                 fallback=g.config_vals['base_data_path']['default'])
+    for k in _log_keys:
+        g.config[k] = config_file.get('general', k, fallback=g.config_vals[k]['default'])
+
+# Compiled config snapshots
+# process_config stores the final g.config keys it set, the monitor's
+# polygons and zone patterns (before ZM zones are imported, as those change
+# at runtime) in a file per config file and monitor. The snapshot is valid
+# as long as the config and secrets files are unchanged (same mtime and size,
+# or same sha1 if they were only touched) and config_vals is the same.
+# Parsed ml_sequence/stream_sequence are added to it on first use.
+# Secrets are not stored: keys set from a !TOKEN, and keys whose {{}}
+# templates use them, are kept as the token/template and resolved from the
+# secrets file when the snapshot is loaded. In compiled values, secrets are
+# replaced by their !TOKEN and filled in again by get_compiled. Snapshots
+# are marshal files of plain values, readable only by their owner.
+
+_SNAPSHOT_VERSION = 2
+_PLAIN_TYPES = (type(None), bool, int, float, str, bytes)
+_snapshot = None  # snapshot in use by this process
+
+
+def _file_sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _snapshot_source(path):
+    st = os.stat(path)
+    return {'path': path, 'mtime': st.st_mtime_ns, 'size': st.st_size, 'sha1': _file_sha1(path)}
+
+
+def _snapshot_schema():
+    return hashlib.sha1('{}:{}:{}'.format(_SNAPSHOT_VERSION, os.stat(__file__).st_mtime_ns,
+                        repr(g.config_vals)).encode('utf-8')).hexdigest()
+
+
+def _snapshot_file(args, base_data_path):
+    config = os.path.abspath(args.get('config'))
+    h = hashlib.sha1(config.encode('utf-8')).hexdigest()[:12]
+    return '{}/misc/config_snapshots/{}-m{}.marshal'.format(base_data_path, h, args.get('monitorid') or '')
+
+
+def _plain(value):
+    # whether value is made of plain data only: no code objects
+    if isinstance(value, _PLAIN_TYPES):
+        return True
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return all(map(_plain, value))
+    if isinstance(value, dict):
+        return all(_plain(k) and _plain(v) for k, v in value.items())
+    return False
+
+
+def _snapshot_valid(snapshot):
+    if snapshot.get('schema') != _snapshot_schema():
+        return False
+    for src in snapshot['sources']:
+        try:
+            st = os.stat(src['path'])
+            if st.st_mtime_ns == src['mtime'] and st.st_size == src['size']:
+                continue
+            if st.st_size != src['size'] or _file_sha1(src['path']) != src['sha1']:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def _write_snapshot(snapshot):
+    import marshal
+    if not _plain(snapshot):
+        raise ValueError('snapshot has values that are not plain data')
+    data = marshal.dumps(snapshot)
+    os.makedirs(os.path.dirname(snapshot['file']), mode=0o700, exist_ok=True)
+    tmp_file = '{}.{}'.format(snapshot['file'], os.getpid())
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_file, snapshot['file'])
+
+
+def load_config_snapshot(args, base_data_path=None):
+    # returns a valid snapshot for this config/monitor or None.
+    # Does not log, as it is used before logs are initialized
+    import marshal
+    global _snapshot
+    if not args.get('config'):
+        return None
+    base_data_path = base_data_path or g.config.get('base_data_path') or \
+        g.config_vals['base_data_path']['default']
+    try:
+        fname = _snapshot_file(args, base_data_path)
+        snapshot = _snapshot if _snapshot and _snapshot['file'] == fname else None
+        if not snapshot:
+            with open(fname, 'rb') as f:
+                snapshot = marshal.load(f)
+            if not isinstance(snapshot, dict) or not _plain(snapshot):
+                return None
+        if snapshot.get('file') != fname or not _snapshot_valid(snapshot):
+            return None
+    except Exception:
+        return None
+    _snapshot = snapshot
+    return snapshot
+
+
+def _secret_keys(secret_tokens, templates):
+    # keys set from a !TOKEN, and keys whose templates refer to them,
+    # directly or not -> their token or template
+    secret = dict(secret_tokens)
+    added = True
+    while added:
+        added = False
+        for k, t in templates.items():
+            if k not in secret and any(r in secret for r in _var_pattern.findall(t)):
+                secret[k] = t
+                added = True
+    return secret
+
+
+def _read_secrets():
+    # the [secrets] section of the configured secrets file, keys lower case
+    if not g.config.get('secrets'):
+        return {}
+    secrets_file = ConfigParser(interpolation=None, inline_comment_prefixes='#')
+    secrets_file.read(g.config['secrets'])
+    return dict(secrets_file.items('secrets')) if secrets_file.has_section('secrets') else {}
+
+
+def fill_secrets(value, secrets):
+    # value with the !TOKENs in its strings replaced from secrets, like
+    # pyzm's template_fill does on a string
+    if isinstance(value, str):
+        if not secrets or '!' not in value:
+            return value
+        return re.sub(r'!(\w+)', lambda m: secrets.get(m.group(1).lower(), '!{}'.format(m.group(1).lower())), value)
+    if isinstance(value, dict):
+        return {k: fill_secrets(v, secrets) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(fill_secrets(v, secrets) for v in value)
+    return value
+
+
+def _replace_in_strings(value, pairs):
+    if isinstance(value, str):
+        for old, new in pairs:
+            value = value.replace(old, new)
+        return value
+    if isinstance(value, dict):
+        return {k: _replace_in_strings(v, pairs) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_replace_in_strings(v, pairs) for v in value)
+    return value
+
+
+def _secret_tokens():
+    # token -> value of the secrets used by the config of the snapshot
+    if not _snapshot:
+        return {}
+    return {t: g.config.get(k) for k, t in _snapshot['secrets'].items()
+            if t.startswith('!') and isinstance(g.config.get(k), str) and g.config.get(k)}
+
+
+def _mask_secrets(value):
+    # value with the secrets in its strings replaced by their !TOKEN, or
+    # None if fill_secrets would not give value back
+    tokens = _secret_tokens()
+    if not tokens:
+        return value
+    pairs = sorted(((v, t) for t, v in tokens.items()), key=lambda p: -len(p[0]))
+    masked = _replace_in_strings(value, pairs)
+    secrets = {t[1:].lower(): v for t, v in tokens.items()}
+    return masked if fill_secrets(masked, secrets) == value else None
+
+
+def _load_snapshot_secrets(snapshot):
+    # sets the keys left out of the snapshot from the secrets file
+    secret = snapshot.get('secrets')
+    if not secret:
+        return
+    secrets = _read_secrets()
+    templated = False
+    for k, v in secret.items():
+        if v.startswith('!'):
+            if v[1:].lower() not in secrets:
+                raise ValueError('secret token {} not found in secrets file {}'.format(v, g.config.get('secrets')))
+            t = g.config_vals.get(k, {}).get('type', 'string')
+            val = secrets[v[1:].lower()]
+            if t == 'int':
+                val = int(val)
+            elif t == 'float':
+                val = float(val)
+            elif t in ('eval', 'dict'):
+                val = ast.literal_eval(val) if val else None
+            elif t == 'str_split':
+                val = str_split(val) if val else None
+            g.config[k] = val
+        else:
+            g.config[k] = v
+            templated = True
+    if templated:
+        # undefined references were reported when the snapshot was made
+        resolve_config_vars(g.config)
+
+
+def save_config_snapshot(args, sources, keys, poly_patterns, pyzm_overrides, secret_keys=None):
+    global _snapshot
+    _snapshot = None
+    if g.config['config_snapshot'] != 'yes':
+        return
+    secret_keys = secret_keys or {}
+    try:
+        snapshot = {
+            'file': _snapshot_file(args, g.config['base_data_path']),
+            'schema': _snapshot_schema(),
+            'sources': [_snapshot_source(os.path.abspath(s)) for s in sources],
+            'config': {k: copy.deepcopy(g.config[k]) for k in keys if k in g.config and k not in secret_keys},
+            'secrets': secret_keys,
+            'polygons': copy.deepcopy(g.polygons),
+            'poly_patterns': poly_patterns,
+            'pyzm_overrides': pyzm_overrides,
+            'compiled': {},
+        }
+        _write_snapshot(snapshot)
+        _snapshot = snapshot
+        g.logger.Debug(2,'saved config snapshot %s', snapshot['file'])
+    except Exception as e:
+        g.logger.Debug(1,'could not save config snapshot: %s', e)
+
+
+def get_compiled(name):
+    # parsed value (ml_options, stream_options) from the current snapshot
+    if _snapshot and name in _snapshot['compiled']:
+        value = copy.deepcopy(_snapshot['compiled'][name])
+        tokens = _secret_tokens()
+        if tokens:
+            value = fill_secrets(value, {t[1:].lower(): v for t, v in tokens.items()})
+        return value
+    return None
+
+
+def set_compiled(name, value):
+    if not _snapshot:
+        return
+    value = _mask_secrets(value)
+    if value is None:
+        g.logger.Debug(1,'not caching %s, its secrets could not be left out', name)
+        return
+    _snapshot['compiled'][name] = copy.deepcopy(value)
+    try:
+        _write_snapshot(_snapshot)
+    except Exception as e:
+        g.logger.Debug(1,'could not update config snapshot: %s', e)
+
+
+def get_es_version(es_script='/usr/bin/zmeventnotification.pl'):
+    # Running the ES script with --version starts perl on every event,
+    # so the answer is cached and only refreshed when the script changes
+    import subprocess
+
+    try:
+        st = os.stat(es_script)
+    except OSError:
+        return '(?)'
+    cache_file = g.config.get('base_data_path', g.config_vals['base_data_path']['default']) + '/es_version.json'
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached['mtime'] == st.st_mtime and cached['size'] == st.st_size:
+            return cached['version']
+    except Exception:
+        pass
+
+    try:
+        es_version = subprocess.check_output([es_script, '--version']).decode('ascii')
+    except Exception:
+        return '(?)'
+    try:
+        tmp_file = '{}.{}'.format(cache_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump({'mtime': st.st_mtime, 'size': st.st_size, 'version': es_version}, f)
+        os.replace(tmp_file, cache_file)
+    except Exception:
+        pass
+    return es_version
 
 
 def process_config(args, ctx):
@@ -346,6 +750,7 @@ def process_config(args, ctx):
     #g.config = {}
     has_secrets = False
     secrets_file = None
+    secret_tokens = {}  # key -> the !TOKEN it was set from
 
     def _correct_type(val, t):
         if t == 'int':
@@ -372,15 +777,16 @@ def process_config(args, ctx):
         else:
             val = v.get('default')
             g.logger.Debug(1,
-                'Section [{}] missing in config file, using key:{} default: {}'
-                .format(v['section'], k, val))
+                'Section [%s] missing in config file, using key:%s default: %s',
+                v['section'], k, val)
 
         if val and val[0] == '!':  # its a secret token, so replace
-            g.logger.Debug(2,'Secret token found in config: {}'.format(val))
+            g.logger.Debug(2,'Secret token found in config: %s', val)
             if not has_secrets:
                 raise ValueError(
                     'Secret token found, but no secret file specified')
             if secrets_file.has_option('secrets', val[1:]):
+                secret_tokens[k] = val
                 vn = secrets_file.get('secrets', val[1:])
             #g.logger.Debug (1,'Replacing {} with {}'.format(val,vn))
                 val = vn
@@ -397,107 +803,134 @@ def process_config(args, ctx):
         #g.logger.Debug (1,'Config: setting {} to {}'.format(k,dval))
 
     # main
+    snapshot = load_config_snapshot(args)
     try:
-        config_file = ConfigParser(interpolation=None, inline_comment_prefixes='#')
-        config_file.read(args.get('config'))
-
-        if config_file.has_option('general', 'secrets'):
-            secrets_filename = config_file.get('general', 'secrets')
-            g.logger.Debug(1,'secret filename: {}'.format(secrets_filename))
-            has_secrets = True
-            g.config['secrets'] = secrets_filename
-            secrets_file = ConfigParser(interpolation=None, inline_comment_prefixes='#')
-            try:
-                with open(secrets_filename) as f:
-                    secrets_file.read_file(f)
-            except:
-                raise
+        if snapshot:
+            g.logger.Debug(1,'Using config snapshot %s', snapshot['file'])
+            g.config.update(copy.deepcopy(snapshot['config']))
+            _load_snapshot_secrets(snapshot)
+            g.polygons = copy.deepcopy(snapshot['polygons'])
+            poly_patterns = snapshot['poly_patterns']
         else:
-            g.logger.Debug(1,'No secrets file configured')
-        # now read config values
-
-        # first, fill in config with default values
-        for k,v in g.config_vals.items():
-            val = v.get('default', None)
-            g.config[k] = _correct_type(val, v['type'])
-        # now iterate the file
-        for sec in config_file.sections():
-            if sec.startswith('monitor-'):
-                #g.logger.Debug(4, 'Skipping {} for now'.format(sec))
-                continue
-            if sec == 'secrets':
-                continue
-            for (k, v) in config_file.items(sec):
-                if g.config_vals.get(k):
-                    _set_config_val(k,g.config_vals[k] )
-                else:
-                    #g.logger.Debug(4, 'storing unknown attribute {}={}'.format(k,v))
-                    g.config[k] = v 
-                    #_set_config_val(k,{'section': sec, 'default': None, 'type': 'string'} )
+            config_file = ConfigParser(interpolation=None, inline_comment_prefixes='#')
+            config_file.read(args.get('config'))
+            sources = [args.get('config')]
+            # keys this function sets, these go into the snapshot
+            keys = set(g.config_vals)
+
+            if config_file.has_option('general', 'secrets'):
+                secrets_filename = config_file.get('general', 'secrets')
+                g.logger.Debug(1,'secret filename: %s', secrets_filename)
+                has_secrets = True
+                g.config['secrets'] = secrets_filename
+                secrets_file = ConfigParser(interpolation=None, inline_comment_prefixes='#')
+                try:
+                    with open(secrets_filename) as f:
+                        secrets_file.read_file(f)
+                except:
+                    raise
+                sources.append(secrets_filename)
+            else:
+                g.logger.Debug(1,'No secrets file configured')
+            # now read config values
+
+            # first, fill in config with default values
+            for k,v in g.config_vals.items():
+                val = v.get('default', None)
+                g.config[k] = _correct_type(val, v['type'])
+            # now iterate the file
+            for sec in config_file.sections():
+                if sec.startswith('monitor-'):
+                    #g.logger.Debug(4, 'Skipping {} for now'.format(sec))
+                    continue
+                if sec == 'secrets':
+                    continue
+                for (k, v) in config_file.items(sec):
+                    keys.add(k)
+                    if g.config_vals.get(k):
+                        _set_config_val(k,g.config_vals[k] )
+                    else:
+                        #g.logger.Debug(4, 'storing unknown attribute {}={}'.format(k,v))
+                        g.config[k] = v 
+                        #_set_config_val(k,{'section': sec, 'default': None, 'type': 'string'} )
+
+            g.polygons = []
+            poly_patterns = []
+
+            # Check if we have a custom overrides for this monitor
+            g.logger.Debug(4,'Now checking for monitor overrides')
+            if 'monitorid' in args and args.get('monitorid'):
+                sec = 'monitor-{}'.format(args.get('monitorid'))
+                if sec in config_file:
+                    # we have a specific section for this monitor
+                    for item in config_file[sec].items():
+                        k = item[0]
+                        v = item[1]
+                        g.config[k] = v
+                        keys.add(k)
+
+                        if k.endswith('_zone_detection_pattern'):
+                            zone_name = k.split('_zone_detection_pattern')[0]
+                            g.logger.Debug(2, 'found zone specific pattern:%s storing', zone_name)
+                            poly_patterns.append({'name': zone_name, 'pattern':v})
+                            continue
+
+                        if k in g.config_vals:
+                            # This means its a legit config key that needs to be overriden
+                            g.logger.Debug(4,
+                                '[%s] overrides key:%s with value:%s', sec, k, v)
+                            g.config[k] = _correct_type(v,
+                                                        g.config_vals[k]['type'])
+                        else:
+                            # This means its a polygon for the monitor
+                            if k.startswith(('object_','face_', 'alpr_')):
+                                g.logger.Debug(2,'assuming %s is an ML sequence, adding to config', k)
+                            else:
+                                if not g.config['only_triggered_zm_zones'] == 'yes':
+                                    try:
+                                        g.polygons.append({'name': k, 'value': str2tuple(v),'pattern': None})
+                                        g.logger.Debug(2,'adding polygon: %s [%s]', k, v)
+                                    except Exception as e:
+                                        g.logger.Debug(3,'%s=%s is not a polygon definition. Error was %s. Ignoring.', k, v, e)
+
+                                else:
+                                    g.logger.Debug (2,'ignoring polygon: %s as only_triggered_zm_zones is true', k)
+                if g.config['only_triggered_zm_zones'] == 'yes':
+                    g.config['import_zm_zones'] = 'yes'
+
+            # Now lets make sure we take care of parameter substitutions {{}}
+            # (done before zones are imported, so portal/user may use them too)
+            g.logger.Debug (4,'Finally, doing parameter substitution')
+            templates = {k: v for k, v in g.config.items() if isinstance(v, str) and '{{' in v}
+            for k, r in resolve_config_vars(g.config):
+                g.logger.Error('config key {} refers to {{{{{}}}}}, which is not defined'.format(k, r))
+
+            pyzm_overrides = config_file.get('general', 'pyzm_overrides', fallback=None)
+            pyzm_overrides = ast.literal_eval(pyzm_overrides) if pyzm_overrides else {}
+            save_config_snapshot(args, sources, keys, poly_patterns, pyzm_overrides,
+                                 _secret_keys(secret_tokens, templates))
 
         if g.config['allow_self_signed'] == 'yes':
+            import ssl
             ctx.check_hostname = False
             ctx.verify_mode = ssl.CERT_NONE
             g.logger.Debug(1,'allowing self-signed certs to work...')
         else:
             g.logger.Debug(1,'strict SSL cert checking is on...')           
 
-
-        g.polygons = []
-        poly_patterns = []
-
-
-        # Check if we have a custom overrides for this monitor
-        g.logger.Debug(4,'Now checking for monitor overrides')
         if 'monitorid' in args and args.get('monitorid'):
-            sec = 'monitor-{}'.format(args.get('monitorid'))
-            if sec in config_file:
-                # we have a specific section for this monitor
-                for item in config_file[sec].items():
-                    k = item[0]
-                    v = item[1]
-                    g.config[k] = v
-
-                    if k.endswith('_zone_detection_pattern'):
-                        zone_name = k.split('_zone_detection_pattern')[0]
-                        g.logger.Debug(2, 'found zone specific pattern:{} storing'.format(zone_name))
-                        poly_patterns.append({'name': zone_name, 'pattern':v})
-                        continue
-
-                    if k in g.config_vals:
-                        # This means its a legit config key that needs to be overriden
-                        g.logger.Debug(4,
-                            '[{}] overrides key:{} with value:{}'.format(
-                                sec, k, v))
-                        g.config[k] = _correct_type(v,
-                                                    g.config_vals[k]['type'])
-                    else:
-                        # This means its a polygon for the monitor
-                        if k.startswith(('object_','face_', 'alpr_')):
-                            g.logger.Debug(2,'assuming {} is an ML sequence, adding to config'.format(k))
-                        else:
-                            if not g.config['only_triggered_zm_zones'] == 'yes':
-                                try:
-                                    g.polygons.append({'name': k, 'value': str2tuple(v),'pattern': None})
-                                    g.logger.Debug(2,'adding polygon: {} [{}]'.format(k, v ))
-                                except Exception as e:
-                                    g.logger.Debug(3,'{}={} is not a polygon definition. Error was {}. Ignoring.'.format(k,v,e))
-
-                            else:
-                                g.logger.Debug (2,'ignoring polygon: {} as only_triggered_zm_zones is true'.format(k))
             # now import zones if needed
             # this should be done irrespective of a monitor section
-            if g.config['only_triggered_zm_zones'] == 'yes':
-                g.config['import_zm_zones'] = 'yes'
             if g.config['import_zm_zones'] == 'yes':
-                import_zm_zones(args.get('monitorid'), args.get('reason'))
+                with trace.span('zones', mid=args.get('monitorid')):
+                    import_zm_zones(args.get('monitorid'), args.get('reason'))
             
             # finally, iterate polygons and put in detection patterns
             for poly in g.polygons:
                 for poly_pat in poly_patterns:
                     if poly['name'] == poly_pat['name']:
                         poly['pattern'] = poly_pat['pattern']
-                        g.logger.Debug(2, 'replacing match pattern for polygon:{} with: {}'.format( poly['name'],poly_pat['pattern'] ))
+                        g.logger.Debug(2, 'replacing match pattern for polygon:%s with: %s', poly['name'], poly_pat['pattern'])
 
 
         else:
@@ -510,28 +943,6 @@ def process_config(args, ctx):
         g.logger.Fatal('error: Traceback:{}'.format(traceback.format_exc()))
         exit(0)
 
-    # Now lets make sure we take care of parameter substitutions {{}}
-    g.logger.Debug (4,'Finally, doing parameter substitution')
-    p = r'{{(\w+?)}}'
-    for gk, gv in g.config.items():
-        #input ('Continue')
-        #print(f"PROCESSING {gk} {gv}")
-        gv = '{}'.format(gv)
-        #if not isinstance(gv, str):
-        #    continue
-        while True:
-            matches = re.findall(p,gv)
-            replaced = False
-            for match_key in matches:
-                if match_key in g.config:
-                    replaced = True
-                    new_val = g.config[gk].replace('{{' + match_key + '}}',str(g.config[match_key]))
-                    #print ('replacing {} with {}'.format(g.config[gk], new_val))
-                    g.config[gk] = new_val
-                    gv = new_val
-            if not replaced:
-                break
-
     # Now munge config if testing args provide
     if args.get('file'):
         g.config['wait'] = 0
@@ -540,7 +951,7 @@ def process_config(args, ctx):
 
 
     if  args.get('output_path'):
-        g.logger.Debug (1,'Output path modified to {}'.format(args.get('output_path')))
+        g.logger.Debug (1,'Output path modified to %s', args.get('output_path'))
         g.config['image_path'] = args.get('output_path')
         g.config['write_debug_image'] = 'yes'
 
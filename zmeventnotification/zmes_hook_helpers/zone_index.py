@@ -0,0 +1,363 @@
+import hashlib
+import os
+import re
+from collections import OrderedDict
+import zmes_hook_helpers.common_params as g
+
+# Spatial index over a monitor's zones (g.polygons), for testing many
+# detected boxes against many zones. The zone polygons are built and
+# prepared once and put in an STRtree, so a box is only tested against the
+# zones whose bounding box it overlaps. An index is kept per monitor for the
+# life of the process and rebuilt when the monitor's zones change (e.g.
+# after they were rescaled to a different image size).
+# zone_filter_mode=raster uses RasterZoneIndex instead, see below. Both give
+# the same results and compile the zones' own detection patterns once, see
+# pattern_allows.
+#
+# g.polygons stay in the resolution they were defined for (g.polygons_size).
+# scaled_polygons hands out copies scaled to an image size, as numpy arrays,
+# cached per (monitor, width, height), so g.polygons is never rewritten and
+# scaling always starts from the source coordinates.
+
+MAX_CACHED = 16
+MAX_RASTER_FILES = 64
+RASTER_VERSION = 2
+
+_indexes = OrderedDict()  # (mid, mode, signature) -> ZoneIndex
+_scaled = OrderedDict()  # (mid, width, height) -> (source signature, polygons)
+
+
+class ZoneIndex:
+    def __init__(self, polygons):
+        self.patterns = [re.compile(p['pattern']) if p['pattern'] else None for p in polygons]
+        self._allowed = {}
+        self._build(polygons)
+
+    def pattern_allows(self, label):
+        # label -> for each zone, whether the zone's own pattern matches it.
+        # Computed once per label
+        import numpy as np
+
+        allowed = self._allowed.get(label)
+        if allowed is None:
+            allowed = np.array([bool(r and r.match(label)) for r in self.patterns], dtype=bool)
+            self._allowed[label] = allowed
+        return allowed
+
+    def _build(self, polygons):
+        import shapely
+        from shapely.geometry import Polygon
+        from shapely.strtree import STRtree
+
+        self.zones = [Polygon(_points(p['value']).tolist()) for p in polygons]
+        # shapely < 2 has no vectorized queries: prepared zones and a
+        # bounding box check instead of the tree
+        self.vectorized = int(shapely.__version__.split('.')[0]) >= 2
+        if self.vectorized:
+            shapely.prepare(self.zones)
+            self.tree = STRtree(self.zones)
+        else:
+            from shapely.prepared import prep
+            self.prepared = [prep(z) for z in self.zones]
+            self.bounds = [z.bounds for z in self.zones]
+
+    def intersecting(self, boxes):
+        # boxes is an array/list of [x1,y1,x2,y2]. Returns, for each box, the
+        # sorted indexes of the zones it intersects (touching counts)
+        import numpy as np
+
+        result = [[] for _ in range(len(boxes))]
+        if not len(boxes) or not self.zones:
+            return result
+        b = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        xmin = np.minimum(b[:, 0], b[:, 2])
+        ymin = np.minimum(b[:, 1], b[:, 3])
+        xmax = np.maximum(b[:, 0], b[:, 2])
+        ymax = np.maximum(b[:, 1], b[:, 3])
+
+        if self.vectorized:
+            import shapely
+            geoms = shapely.box(xmin, ymin, xmax, ymax)
+            box_idx, zone_idx = self.tree.query(geoms, predicate='intersects')
+            for i, z in sorted(zip(box_idx.tolist(), zone_idx.tolist())):
+                result[i].append(z)
+            return result
+
+        from shapely.geometry import box
+        for i in range(len(b)):
+            obj = box(xmin[i], ymin[i], xmax[i], ymax[i])
+            for z, (zx1, zy1, zx2, zy2) in enumerate(self.bounds):
+                if zx1 > xmax[i] or zx2 < xmin[i] or zy1 > ymax[i] or zy2 < ymin[i]:
+                    continue
+                if self.prepared[z].intersects(obj):
+                    result[i].append(z)
+        return result
+
+
+class RasterZoneIndex(ZoneIndex):
+    # Each zone is rasterized into two bitmaps of cell x cell pixel cells
+    # (zone_raster_cell), cropped to the zone: the cells it touches and the
+    # cells that are inside it, turned into integral images. All integral
+    # images of a monitor's zones are kept in one flat array, so every box is
+    # looked up in every zone at once: a box touching no cell of a zone does
+    # not intersect it, a box touching a cell inside it does. Only the few
+    # boxes that touch a zone's edge cells and nothing inside are tested with
+    # the zone polygon, so results are the same as shapely's.
+    # The array is kept in base_data_path/misc/zone_rasters, so a new process
+    # for the next event maps it instead of drawing the zones again.
+
+    def _build(self, polygons):
+        import numpy as np
+        import shapely
+
+        self.cell = max(1, int(g.config['zone_raster_cell']))
+        self.zones = polygons
+        self.shapes = None
+        self.vectorized = int(shapely.__version__.split('.')[0]) >= 2
+        if not polygons:
+            return
+        cache_file = _raster_file(polygons, self.cell)
+        data = _load_rasters(cache_file, len(polygons))
+        if data is None:
+            rasters = [self._rasterize(_points(p['value']).astype(np.float64)) for p in polygons]
+            data = _pack(rasters)
+            _save_rasters(cache_file, data)
+        count = len(polygons)
+        meta = np.asarray(data[1:1 + 4 * count], dtype=np.intp).reshape(-1, 4)
+        self.x0, self.y0, self.height, self.width = meta.T
+        self.stride = self.width + 1
+        sizes = (self.height + 1) * self.stride
+        # each zone has its touched cells' integral, then its inside cells'
+        self.touch_at = 1 + 4 * count + np.concatenate(([0], np.cumsum(2 * sizes)[:-1]))
+        self.inside_at = self.touch_at + sizes
+        self.data = np.asarray(data)
+
+    def _rasterize(self, p):
+        # ((x0, y0), touched cells, inside cells) of a zone, in cells from x0, y0
+        import cv2
+        import numpy as np
+
+        shift = 4
+        # zones may reach out of the image, x0 and y0 can be negative
+        x0 = int(np.floor(p[:, 0].min() / self.cell)) - 1
+        y0 = int(np.floor(p[:, 1].min() / self.cell)) - 1
+        width = int(np.floor(p[:, 0].max() / self.cell)) + 2 - x0
+        height = int(np.floor(p[:, 1].max() / self.cell)) + 2 - y0
+        # cell (i, j) covers pixels [j*cell, (j+1)*cell], its center is at
+        # j + 0.5 in bitmap coordinates
+        scaled = np.rint((p / self.cell - 0.5 - (x0, y0)) * (1 << shift)).astype(np.int32).reshape(-1, 1, 2)
+        fill = np.zeros((height, width), dtype=np.uint8)
+        cv2.fillPoly(fill, [scaled], 1, lineType=cv2.LINE_8, shift=shift)
+        edge = np.zeros((height, width), dtype=np.uint8)
+        cv2.polylines(edge, [scaled], True, 1, thickness=1, lineType=cv2.LINE_4, shift=shift)
+        # a line does not mark every cell it passes through
+        edge = cv2.dilate(edge, np.ones((3, 3), dtype=np.uint8))
+        return (x0, y0), fill | edge, fill & (1 - edge)
+
+    def _polygons(self):
+        # the zone polygons, made on first use
+        import numpy as np
+
+        if self.shapes is None:
+            points = [_points(p['value']).astype(np.float64) for p in self.zones]
+            if self.vectorized:
+                import shapely
+                rings = shapely.linearrings(np.concatenate(points),
+                                            indices=np.repeat(np.arange(len(points)), [len(p) for p in points]))
+                self.shapes = shapely.polygons(rings)
+            else:
+                from shapely.geometry import Polygon
+                from shapely.prepared import prep
+                self.shapes = [prep(Polygon(p.tolist())) for p in points]
+        return self.shapes
+
+    def _exact(self, box_idx, zone_idx, xmin, ymin, xmax, ymax):
+        # whether each box intersects the zone it is paired with
+        import numpy as np
+
+        shapes = self._polygons()
+        if self.vectorized:
+            import shapely
+            boxes = shapely.box(xmin[box_idx], ymin[box_idx], xmax[box_idx], ymax[box_idx])
+            return shapely.intersects(shapes[zone_idx], boxes)
+        from shapely.geometry import box
+        return np.array([shapes[z].intersects(box(xmin[i], ymin[i], xmax[i], ymax[i]))
+                         for i, z in zip(box_idx.tolist(), zone_idx.tolist())], dtype=bool)
+
+    def intersecting(self, boxes):
+        import numpy as np
+
+        result = [[] for _ in range(len(boxes))]
+        if not len(boxes) or not self.zones:
+            return result
+        b = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        xmin = np.minimum(b[:, 0], b[:, 2])
+        ymin = np.minimum(b[:, 1], b[:, 3])
+        xmax = np.maximum(b[:, 0], b[:, 2])
+        ymax = np.maximum(b[:, 1], b[:, 3])
+        # cells touched by each box, as half open ranges
+        x1 = np.floor(xmin / self.cell).astype(np.intp)
+        y1 = np.floor(ymin / self.cell).astype(np.intp)
+        x2 = np.floor(xmax / self.cell).astype(np.intp) + 1
+        y2 = np.floor(ymax / self.cell).astype(np.intp) + 1
+        # (box, zone) pairs where the box reaches into the zone's bitmaps,
+        # ordered by box, then zone
+        box_idx, zone_idx = np.nonzero((x2[:, None] > self.x0) & (x1[:, None] < self.x0 + self.width) &
+                                       (y2[:, None] > self.y0) & (y1[:, None] < self.y0 + self.height))
+        if not len(box_idx):
+            return result
+        # the ranges in the zones' cells
+        x0, y0 = self.x0[zone_idx], self.y0[zone_idx]
+        width, height = self.width[zone_idx], self.height[zone_idx]
+        zx1, zx2 = np.maximum(x1[box_idx] - x0, 0), np.minimum(x2[box_idx] - x0, width)
+        zy1, zy2 = np.maximum(y1[box_idx] - y0, 0), np.minimum(y2[box_idx] - y0, height)
+        stride = self.stride[zone_idx]
+        at = self.touch_at[zone_idx]
+        corners = (at + zy2 * stride + zx2, at + zy1 * stride + zx2, at + zy2 * stride + zx1, at + zy1 * stride + zx1)
+        d = self.data
+        touched = (d[corners[0]] - d[corners[1]] - d[corners[2]] + d[corners[3]]) > 0
+        # the inside integral follows the touched one
+        shift = self.inside_at[zone_idx] - at
+        hit = (d[corners[0] + shift] - d[corners[1] + shift] - d[corners[2] + shift] + d[corners[3] + shift]) > 0
+        edge = np.nonzero(touched & ~hit)[0]
+        if len(edge):
+            hit[edge] = self._exact(box_idx[edge], zone_idx[edge], xmin, ymin, xmax, ymax)
+        for i, z in zip(box_idx[hit].tolist(), zone_idx[hit].tolist()):
+            result[i].append(z)
+        return result
+
+
+def _integral(mask):
+    import numpy as np
+
+    integral = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int32)
+    integral[1:, 1:] = mask.cumsum(axis=0, dtype=np.int32).cumsum(axis=1, dtype=np.int32)
+    return integral
+
+
+def _pack(rasters):
+    # one int32 array: the zone count, x0, y0, height, width of each zone,
+    # then each zone's touched and inside integral images
+    import numpy as np
+
+    parts = [np.array([len(rasters)], dtype=np.int32)]
+    parts.append(np.array([(x0, y0) + touch.shape for (x0, y0), touch, _ in rasters], dtype=np.int32).reshape(-1))
+    for _, touch, inside in rasters:
+        parts.append(_integral(touch).reshape(-1))
+        parts.append(_integral(inside).reshape(-1))
+    return np.concatenate(parts)
+
+
+def _raster_file(polygons, cell):
+    h = hashlib.sha1('{} {}'.format(RASTER_VERSION, cell).encode())
+    for zone in signature(polygons):
+        for part in zone:
+            h.update(part if isinstance(part, bytes) else repr(part).encode())
+    return os.path.join(g.config['base_data_path'], 'misc', 'zone_rasters', '{}.bin'.format(h.hexdigest()))
+
+
+def _load_rasters(cache_file, count):
+    # the array _pack made for the zones, memory mapped. The file has the
+    # array's int32 values only
+    import numpy as np
+
+    try:
+        data = np.memmap(cache_file, dtype=np.int32, mode='r')
+        if int(data[0]) != count:
+            raise ValueError('wrong zone count or format')
+        meta = np.asarray(data[1:1 + 4 * count], dtype=np.int64).reshape(-1, 4)
+        if 1 + 4 * count + 2 * int(((meta[:, 2] + 1) * (meta[:, 3] + 1)).sum()) != len(data):
+            raise ValueError('wrong size')
+        return data
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        g.logger.Debug(1,'ignoring unreadable zone raster %s: %s', cache_file, e)
+        return None
+
+
+def _save_rasters(cache_file, data):
+    import numpy as np
+
+    cache_dir = os.path.dirname(cache_file)
+    tmp_file = '{}.{}'.format(cache_file, os.getpid())
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        data.astype(np.int32).tofile(tmp_file)
+        os.replace(tmp_file, cache_file)
+        # rasters of zones that changed are not used again
+        files = sorted((os.path.join(cache_dir, n) for n in os.listdir(cache_dir) if n.endswith('.bin')),
+                       key=os.path.getmtime, reverse=True)
+        for old in files[MAX_RASTER_FILES:]:
+            os.remove(old)
+    except Exception as e:
+        g.logger.Debug(1,'could not write zone raster %s: %s', cache_file, e)
+
+
+def signature(polygons):
+    # what a cached index or scaled copy was made from
+    sig = []
+    for p in polygons:
+        v = p['value']
+        if hasattr(v, 'tobytes'):
+            sig.append((p['name'], p['pattern'], v.shape, v.tobytes()))
+        else:
+            sig.append((p['name'], p['pattern'], tuple(map(tuple, v))))
+    return tuple(sig)
+
+
+def _points(value):
+    import numpy as np
+    return np.asarray(value).reshape(-1, 2)
+
+
+def _remember(cache, key, value):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > MAX_CACHED:
+        cache.popitem(last=False)
+
+
+def scaled_polygons(polygons, size=None, source=None, mid=None):
+    # polygons defined for an image of source (width, height), scaled to an
+    # image of size (width, height). Values are read only int numpy arrays.
+    # Without both sizes, or if they are equal, the polygons are not scaled
+    import numpy as np
+
+    if not size or not source or tuple(size) == tuple(source):
+        size = source = None
+    key = (mid or '', None if size is None else tuple(size))
+    sig = (signature(polygons), None if source is None else tuple(source))
+    cached = _scaled.get(key)
+    if cached and cached[0] == sig:
+        _scaled.move_to_end(key)
+        return cached[1]
+
+    scaled = []
+    for p in polygons:
+        value = _points(p['value']).astype(np.float64)
+        if size:
+            # same arithmetic as the old rescale_polygons: int(x * factor)
+            value = value * np.array([size[0] / source[0], size[1] / source[1]])
+        value = value.astype(np.int64)
+        value.setflags(write=False)
+        scaled.append({'name': p['name'], 'value': value, 'pattern': p['pattern']})
+    if size and g.logger.enabled(2):
+        g.logger.Debug(2,'resized polygons from %s to %s: %s',
+            source, size, [(p['name'], p['value'].tolist()) for p in scaled])
+    _remember(_scaled, key, (sig, scaled))
+    return scaled
+
+
+def get_index(polygons, mid=None, mode='shapely'):
+    # returns an index of the monitor's zones, building it if there is none
+    # for these zones yet. mode is shapely or raster
+    key = (mid or '', mode, signature(polygons))
+    index = _indexes.get(key)
+    if index is not None and mode == 'raster' and index.cell != max(1, int(g.config['zone_raster_cell'])):
+        index = None
+    if index is None:
+        g.logger.Debug(2,'zone_index: indexing %s zones for monitor %s, mode %s', len(polygons), mid, mode)
+        index = RasterZoneIndex(polygons) if mode == 'raster' else ZoneIndex(polygons)
+    _remember(_indexes, key, index)
+    return index